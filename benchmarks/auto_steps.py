@@ -0,0 +1,67 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (auto_steps.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Time splitting generated models with no STEP lines into steps (Submodel.populateStepsWithParts), for
+# increasing part counts.  Parts are stacked in layers, a mix of a few library parts per layer, so each
+# step boundary comes from the layer and popular part rules rather than from the maximum step size alone.
+# Only parsing and step generation run: the import stops before any display list or image is made.
+#
+#     python benchmarks/auto_steps.py [--parts 1000,2500,5000,10000] [--layer 40]
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+
+import benchutil
+import config
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--parts", default="1000,2500,5000,10000", help="comma separated part counts to time [default: %default]")
+    parser.add_option("--layer", type="int", default=40, help="parts in each layer [default: %default]")
+    parser.add_option("--kinds", type="int", default=6, help="distinct library parts used [default: %default]")
+    options, unused = parser.parse_args()
+
+    benchutil.createWindow()  # Loads LIC's settings, LDraw path included
+    partNames = benchutil.libraryParts(config.LDrawPath, options.kinds)
+    workDir = tempfile.mkdtemp(prefix="lic-steps-")
+
+    print "%8s %8s %10s %14s %12s" % ("parts", "steps", "parse", "steps & pages", "per part")
+    try:
+        for partCount in [int(s) for s in options.parts.split(",")]:
+            names = [partNames[(i // 3) % len(partNames)] for i in range(partCount)]
+            filename = os.path.join(workDir, "parts%d.ldr" % partCount)
+            benchutil.writeModel(filename, names, layerSize=options.layer)
+
+            with benchutil.parsedModel(filename) as (window, seconds):
+                report = window.instructions.profiler.report()
+                stepCount = len(window.instructions.mainModel.getCSIList())
+
+            stepSeconds = benchutil.phaseSeconds(report, "addInitialPagesAndSteps")
+            print "%8d %8d %9.2fs %13.2fs %10.3fms" % (partCount, stepCount, seconds - stepSeconds,
+                                                       stepSeconds, 1000.0 * stepSeconds / partCount)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (batch_cold_cache.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Run 'Lic.py --batch --jobs N' twice over a folder of generated models, first with an empty part cache
+# and then with the cache the first run left behind.  Each model uses more distinct library parts than
+# LDrawImporter.parallelParseThreshold, so the cold run exercises part parsing inside the (daemonic)
+# batch worker processes.  Exits with 1 if either run fails to build every book.
+#
+#     python benchmarks/batch_cold_cache.py [--models 4] [--parts 64] [--jobs 2]
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchutil
+import config
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--models", type="int", default=4, help="number of models to build [default: %default]")
+    parser.add_option("--parts", type="int", default=64, help="distinct library parts in each model [default: %default]")
+    parser.add_option("-j", "--jobs", type="int", default=2, help="batch worker processes [default: %default]")
+    parser.add_option("--keep", action="store_true", default=False, help="keep the generated working folder")
+    options, unused = parser.parse_args()
+
+    ldrawPath = benchutil.readLDrawPath()
+    if not ldrawPath:
+        raise SystemExit("LDraw path is not configured in %s - run LIC once to set it up" % benchutil.settingsFilename())
+    partNames = benchutil.libraryParts(ldrawPath, options.parts)
+
+    # Give the batch run its own, empty application data folder: its part cache starts cold
+    workDir = tempfile.mkdtemp(prefix="lic-batch-")
+    env = dict(os.environ)
+    if os.name == 'nt':
+        env["APPDATA"] = workDir
+        appDataPath = config.checkPath("licreator", workDir)
+    else:
+        appDataPath = workDir
+    for name in ('licreator.ini', 'default_template.lit'):
+        path = os.path.join(config.appDataPath(), name)
+        if os.path.isfile(path):
+            shutil.copy(path, appDataPath)
+
+    modelPath = config.checkPath("models", workDir)
+    outputPath = config.checkPath("books", workDir)
+    for i in range(options.models):
+        # Rotate the part list so each model starts its first wave with different parts
+        names = partNames[i:] + partNames[:i]
+        benchutil.writeModel(os.path.join(modelPath, "model%03d.ldr" % i), names, partsPerStep=8)
+
+    command = [sys.executable, os.path.join(benchutil.srcPath, "Lic.py"), "--batch",
+               "--jobs", str(options.jobs), "--output", outputPath, modelPath]
+
+    failed = False
+    try:
+        for run in ("cold", "warm"):
+            start = time.time()
+            exitCode = subprocess.call(command, cwd=appDataPath, env=env)
+            books = [f for f in os.listdir(outputPath) if f.endswith(".lic")]
+            print "%s cache: exit code %d, %d of %d books in %.1fs" % (run, exitCode, len(books), options.models, time.time() - start)
+            if exitCode != 0 or len(books) != options.models:
+                failed = True
+                break
+            for name in books:
+                os.remove(os.path.join(outputPath, name))
+    finally:
+        if options.keep:
+            print "Working folder kept at %s" % workDir
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (benchutil.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Shared helpers for the scripts in this folder: generate LDraw models of a given shape,
+# and import them into a hidden LicWindow, timing each import.
+#
+# Like LIC itself, these scripts read LIC's settings (licreator.ini, for the LDraw path) and keep
+# their caches in LIC's application data folder - the current directory, except on Windows.
+# Run them from there.  They need a display for their OpenGL context: use Xvfb on headless machines.
+
+import contextlib
+import os
+import sys
+import time
+
+srcPath = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+if srcPath not in sys.path:
+    sys.path.insert(0, srcPath)
+
+import config
+
+_app = None
+_window = None
+
+def settingsFilename():
+    return os.path.join(config.appDataPath(), 'licreator.ini')
+
+def readLDrawPath():
+    from PyQt4.QtCore import QSettings, QString
+    settings = QSettings(QString(settingsFilename()), QSettings.IniFormat)
+    return str(settings.value("Tools/LDrawPath").toString())
+
+def libraryParts(ldrawPath, count):
+    """ Return the filenames of the first 'count' ordinary (not moved or aliased) parts in the LDraw library. """
+    partsPath = [os.path.join(ldrawPath, d) for d in os.listdir(ldrawPath) if d.lower() == 'parts'][0]
+    names = []
+    for name in sorted(os.listdir(partsPath)):
+        if not name.lower().endswith('.dat') or name.startswith('~'):
+            continue
+        with open(os.path.join(partsPath, name)) as fh:
+            title = fh.readline()
+        if '~' in title or 'Moved to' in title:
+            continue
+        names.append(name)
+        if len(names) == count:
+            return names
+    raise ValueError("LDraw library at %s has only %d usable parts, %d requested" % (ldrawPath, len(names), count))
+
+def partLines(partNames, spacing=80, columns=20, layerSize=0, layerHeight=24, color=4):
+    """
+    Return one LDraw type 1 line per part, laid out on a grid.  With a layerSize, every layerSize parts start
+    a new layer, layerHeight LDU above the last (24 LDU is one brick), like a model built up layer by layer.
+    """
+    lines = []
+    for i, name in enumerate(partNames):
+        layer, j = divmod(i, layerSize) if layerSize else (0, i)
+        x, y, z = (j % columns) * spacing, -layer * layerHeight, (j // columns) * spacing
+        lines.append("1 %d %d %d %d 1 0 0 0 1 0 0 0 1 %s" % (color, x, y, z, name))
+    return lines
+
+def writeModel(filename, partNames, partsPerStep=0, layerSize=0, title="Benchmark model"):
+    """
+    Write an .ldr model using each part once, with a STEP every partsPerStep parts (0 for no STEPs).
+    layerSize stacks the parts in layers of that many parts, see partLines.
+    """
+    lines = ["0 " + title, "0 Name: " + os.path.basename(filename)]
+    for i, line in enumerate(partLines(partNames, layerSize=layerSize)):
+        if partsPerStep and i and i % partsPerStep == 0:
+            lines.append("0 STEP")
+        lines.append(line)
+    with open(filename, 'w') as fh:
+        fh.write("\r\n".join(lines) + "\r\n")
+    return filename
+
+def createWindow():
+    """ Return the one hidden, batch mode LicWindow these benchmarks import into. """
+    global _app, _window
+    if _window is None:
+        import Lic
+        _app = Lic.createApplication()
+        _window = Lic.LicWindow(batchMode=True)
+        if _window.needPathConfiguration:
+            raise SystemExit("LDraw path is not configured in %s - run LIC once to set it up" % settingsFilename())
+    return _window
+
+@contextlib.contextmanager
+def importedModel(filename):
+    """
+    Import filename into the benchmark window for the body of a with statement, then close it again.
+    Yields (window, seconds the import took); the import's profiler report is in window.instructions.profiler.
+    """
+    import Lic
+    window = createWindow()
+    config.writeImportProfile = True
+
+    start = time.time()
+    try:
+        window.importModel(filename, Lic.BatchProgress())
+        yield window, time.time() - start
+    finally:
+        window.glWidget.makeCurrent()
+        window.undoStack.clear()
+        window.setWindowModified(False)
+        window.fileClose(False)
+
+@contextlib.contextmanager
+def parsedModel(filename):
+    """
+    Like importedModel, but only run the first part of the import: parse filename and split it into pages
+    and steps, stopping before any display list or image is made.
+    """
+    window = createWindow()
+    config.writeImportProfile = True
+
+    loader = window.instructions.importModel(filename)
+    start = time.time()
+    try:
+        loader.next()  # Parses the model and splits it into steps, then yields the progress step count
+        yield window, time.time() - start
+    finally:
+        loader.close()
+        window.fileClose(False)
+
+def importModel(filename):
+    """ Import filename into the benchmark window and close it again.  Returns (seconds, profiler report). """
+    with importedModel(filename) as (window, seconds):
+        return seconds, window.instructions.profiler.report()
+
+def phaseSeconds(report, name):
+    for phase in report["phases"]:
+        if phase["name"] == name:
+            return phase["seconds"]
+    return 0.0
@@ -0,0 +1,103 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (csi_display_lists.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Time compiling the CSI display lists of generated single submodel models with an increasing number of
+# steps, each adding the same few parts.  Each CSI's list calls a few cumulative lists of the previous
+# steps, so compile time per step should stay flat as the step count grows, rather than grow with it.
+#
+# Drivers silently skip display lists nested too deep, so the last step is then rendered and read back:
+# its drawn size must match the size its geometry projects to, or early steps went missing.  --rotate
+# gives every CSI an extra rotation, so all steps are drawn from a view other than the default one.
+#
+#     python benchmarks/csi_display_lists.py [--steps 100,200,400] [--parts-per-step 4] [--rotate 30]
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import benchutil
+import config
+import LicGLHelpers
+from LicModel import CSI
+
+def checkRender(window, csi, size=1024):
+    """ Render csi into a size x size buffer and return True if the drawn image is as big as its geometry. """
+    extents = csi.getProjectedExtents(True)
+    csi.scaling = 0.9 * size / max(extents[2] - extents[0], extents[3] - extents[1]) / CSI.defaultScale
+    scale = CSI.defaultScale * csi.scaling
+    expected = LicGLHelpers.initImgSizeFromExtents(extents * scale)
+
+    glContext = window.glWidget
+    with LicGLHelpers.renderTargets.pixelBuffer(size, glContext) as pBuffer:
+        pBuffer.makeCurrent()
+        drawn = LicGLHelpers.initImgSize(size, csi.glDispID, csi.getDatFilename(), scale, CSI.defaultRotation, csi.rotation)
+    glContext.makeCurrent()
+
+    return drawn is not None and abs(drawn[0] - expected[0]) <= 2 and abs(drawn[1] - expected[1]) <= 2
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--steps", default="100,200,400", help="comma separated step counts to time [default: %default]")
+    parser.add_option("--parts-per-step", type="int", default=4, help="parts added by each step [default: %default]")
+    parser.add_option("--rotate", type="float", default=0.0, help="extra y rotation given to every CSI [default: %default]")
+    options, unused = parser.parse_args()
+
+    benchutil.createWindow()  # Loads LIC's settings, LDraw path included
+    partNames = benchutil.libraryParts(config.LDrawPath, options.parts_per_step)
+    workDir = tempfile.mkdtemp(prefix="lic-csi-")
+
+    print "%6s %8s %14s %14s %12s %8s" % ("steps", "parts", "import lists", "recompile all", "per step", "render")
+    failed = False
+    try:
+        for stepCount in [int(s) for s in options.steps.split(",")]:
+            filename = os.path.join(workDir, "steps%d.ldr" % stepCount)
+            benchutil.writeModel(filename, partNames * stepCount, options.parts_per_step)
+
+            with benchutil.importedModel(filename) as (window, seconds):
+                report = window.instructions.profiler.report()
+                csiList = window.instructions.mainModel.getCSIList()
+
+                # Recompile every CSI's lists from scratch, outside the rest of the import
+                window.glWidget.makeCurrent()
+                for csi in csiList:
+                    csi.deleteGLDisplayLists()
+                    csi.rotation = [0.0, options.rotate, 0.0]
+                start = time.time()
+                for csi in csiList:
+                    csi.createGLDisplayList()
+                compileSeconds = time.time() - start
+
+                rendered = checkRender(window, csiList[-1])
+                failed = failed or not rendered
+
+            print "%6d %8d %13.3fs %13.3fs %11.2fms %8s" % (len(csiList), stepCount * options.parts_per_step,
+                                                           benchutil.phaseSeconds(report, "initGLDisplayLists"),
+                                                           compileSeconds, 1000.0 * compileSeconds / len(csiList),
+                                                           "ok" if rendered else "MISSING")
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (mpd_import.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Time parsing generated MPD files with an increasing number of submodels.  The main model places every
+# submodel, and each submodel places a few library parts plus the submodel before it, so part and submodel
+# names are looked up many times over.  Those lookups go through one case folded index, so time per
+# submodel should stay flat as the submodel count grows.  Only parsing and step generation run.
+#
+#     python benchmarks/mpd_import.py [--submodels 100,250,500] [--parts 8]
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+
+import benchutil
+import config
+
+def writeMPD(filename, submodelCount, partNames):
+    """ Write an MPD whose main model places submodelCount submodels, each placing partNames and the submodel before it. """
+    names = ["Sub%04d.ldr" % i for i in range(submodelCount)]
+    lines = ["0 FILE main.ldr", "0 Benchmark MPD", "0 Name: main.ldr"]
+    for i, line in enumerate(benchutil.partLines(names, spacing=400)):
+        if i:
+            lines.append("0 STEP")
+        lines.append(line)
+
+    for i, name in enumerate(names):
+        lines += ["0 NOFILE", "0 FILE " + name, "0 " + name, "0 Name: " + name]
+        lines += benchutil.partLines(partNames)
+        if i:
+            # Mix case, as real MPDs often do, to exercise the case folded lookup
+            lines += ["0 STEP", "1 16 0 -24 0 1 0 0 0 1 0 0 0 1 " + names[i - 1].upper()]
+    lines.append("0 NOFILE")
+
+    with open(filename, 'w') as fh:
+        fh.write("\r\n".join(lines) + "\r\n")
+    return filename
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--submodels", default="100,250,500", help="comma separated submodel counts to time [default: %default]")
+    parser.add_option("--parts", type="int", default=8, help="library parts placed by each submodel [default: %default]")
+    options, unused = parser.parse_args()
+
+    benchutil.createWindow()  # Loads LIC's settings, LDraw path included
+    partNames = benchutil.libraryParts(config.LDrawPath, options.parts)
+    workDir = tempfile.mkdtemp(prefix="lic-mpd-")
+
+    print "%10s %10s %10s %14s" % ("submodels", "parts", "parse", "per submodel")
+    try:
+        for submodelCount in [int(s) for s in options.submodels.split(",")]:
+            filename = writeMPD(os.path.join(workDir, "mpd%d.mpd" % submodelCount), submodelCount, partNames)
+
+            with benchutil.parsedModel(filename) as (window, seconds):
+                report = window.instructions.profiler.report()
+
+            parseSeconds = benchutil.phaseSeconds(report, "parse")
+            print "%10d %10d %9.2fs %12.2fms" % (submodelCount, submodelCount * (options.parts + 1),
+                                                 parseSeconds, 1000.0 * parseSeconds / submodelCount)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,6 +20,10 @@
 """
 
 
+import itertools
+import multiprocessing
+import optparse
+import shutil
 import subprocess
 import sys
 import time
@@ -430,12 +434,18 @@ class LicWindow(QMainWindow):
 
     defaultTemplateFilename = "default_template.lit"
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, batchMode=False):
         QMainWindow.__init__(self, parent)
         QGL.setPreferredPaintEngine(QPaintEngine.OpenGL)
         
         self._loadTime = (0, 0)
         
+        '''
+         True when building books from the command line (see runBatch): the window is never shown,
+         and nothing may pop up a dialog and wait for a user
+        '''
+        self.batchMode = batchMode
+        
         '''
          Handle to LicAssistantWidget.LicWorker single instance
         ''' 
@@ -803,6 +813,9 @@ class LicWindow(QMainWindow):
         # tools activity
         config.writeL3PActivity = settings.value("L3PAccessLog" , False).toBool()
         config.writePOVRayActivity = settings.value("POVAccessLog" , False).toBool()
+        config.writeImportProfile = settings.value("ImportProfileLog" , False).toBool()
+        config.writeImportCProfile = settings.value("ImportCProfile" , False).toBool()
+        config.flattenLibraryParts = settings.value("FlattenLibraryParts" , False).toBool()
 
         # tools
         LDrawPath = str(settings.value("Tools/LDrawPath").toString())
@@ -844,7 +857,7 @@ class LicWindow(QMainWindow):
         updated = settings.value("latestUpdate",0).toFloat()[0]
         version = str(settings.value("installedVersion","0.0.000").toString()) == __version__
       
-        if not updated or not version:
+        if (not updated or not version) and not self.batchMode:
             self.checkUpdates()
     
     def saveSettings(self):
@@ -876,6 +889,9 @@ class LicWindow(QMainWindow):
         
         settings.setValue("L3PAccessLog" , config.writeL3PActivity)
         settings.setValue("POVAccessLog" , config.writePOVRayActivity)
+        settings.setValue("ImportProfileLog" , config.writeImportProfile)
+        settings.setValue("ImportCProfile" , config.writeImportCProfile)
+        settings.setValue("FlattenLibraryParts" , config.flattenLibraryParts)
 
         if "" == config.L3PPath.strip():
             config.L3PPath = "."
@@ -1285,12 +1301,12 @@ class LicWindow(QMainWindow):
             self.latestimportfolder = os.path.dirname(filename).__str__()
             QTimer.singleShot(50, lambda: self.importModel(filename))
 
-    def importModel(self, filename):
-        if not self.fileClose():
+    def importModel(self, filename, progress=None):
+        if not self.fileClose(not self.batchMode):
             return
 
         startTime = time.time()
-        self.progress = LicDialogs.LicProgressDialog(self, "Importing " + os.path.basename(filename))
+        self.progress = progress if progress else LicDialogs.LicProgressDialog(self, "Importing " + os.path.basename(filename))
         self.progress.setValue(2)  # Try and force dialog to show up right away
 
         self.loader = self.instructions.importModel(filename)
@@ -1299,6 +1315,8 @@ class LicWindow(QMainWindow):
         firstPage = self.instructions.mainModel.getPage(1)
         if firstPage and firstPage.isBlank():
             self.progress.cancel()
+            if self.batchMode:
+                raise IOError("Invalid or unsupported content in %s" % os.path.basename(filename))
             
             self.assistHandle = MessageDlg(self)            
             self.assistHandle.setText("Invalid or unsupported content in %s" % os.path.basename(filename))
@@ -1648,15 +1666,175 @@ def updateAllSavedLicFiles(window):
                     print "Successful save %s" % fn
                 window.fileClose()
 
+def createApplication():
+    app = QApplication(sys.argv)
+    app.setOrganizationName("BugEyedMonkeys Inc.")
+    app.setOrganizationDomain("bugeyedmonkeys.com")
+    app.setApplicationName("LICreator")
+    return app
+
+class BatchProgress(object):
+    """ Stands in for LicProgressDialog when building books from the command line.  Never cancels. """
+
+    def __init__(self):
+        self.count = 0
+        self.__maximum = 0
+
+    def setValue(self, value):
+        pass
+
+    def setMaximum(self, maximum):
+        self.__maximum = maximum
+
+    def maximum(self):
+        return self.__maximum
+
+    def incr(self, label=None):
+        self.count += 1
+
+    def wasCanceled(self):
+        return False
+
+    def cancel(self):
+        pass
+
+# Each batch worker process builds all of its books with one QApplication and one hidden LicWindow,
+# whose QGLWidget is never shown and serves as that process' own offscreen GL context
+_batchApp = None
+_batchWindow = None
+
+def initBatchWorker():
+    """
+    Runs once in each batch worker process.  Pool workers are daemonic and may not start processes
+    of their own, so parse library parts serially here - the books themselves are already built in parallel.
+    """
+    LicImporters.LDrawImporter.parallelParseThreshold = 0
+
+def buildBatchBook(task):
+    """
+    Import one model, apply the default template, save it as a .lic and optionally export its PNGs & PDF.
+    Runs inside a batch worker process.  Returns (filename, success, message); never raises.
+    """
+    global _batchApp, _batchWindow
+    filename, outputDir, exportPNG, exportPDF = task
+
+    if _batchWindow is None:
+        _batchApp = createApplication()
+        _batchWindow = LicWindow(batchMode=True)
+
+    window = _batchWindow
+    if window.needPathConfiguration:
+        return (filename, False, "LDraw path is not configured - run LIC once to set it up")
+
+    startTime = time.time()
+    try:
+        window.importModel(filename, BatchProgress())
+
+        outputDir = outputDir if outputDir else os.path.dirname(filename)
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        licFilename = os.path.join(outputDir, basename + ".lic")
+        LicBinaryWriter.saveLicFile(licFilename, window.instructions)
+        outputs = [licFilename]
+
+        if exportPNG:
+            loader = window.instructions.exportImages()
+            loader.next()  # Skip page count
+            for pageFilename in loader:
+                if outputDir != os.path.dirname(pageFilename):
+                    shutil.copy(pageFilename, outputDir)
+            outputs.append("PNG")
+
+        if exportPDF:
+            loader = window.instructions.exportToPDF()
+            pdfFilename = loader.next()
+            for unused in loader:
+                pass
+            if outputDir != os.path.dirname(pdfFilename):
+                shutil.copy(pdfFilename, outputDir)
+            outputs.append("PDF")
+
+        return (filename, True, "%s [%.1fs]" % (", ".join(outputs), time.time() - startTime))
+
+    except Exception, e:
+        logging.exception("Batch build of %s failed" % filename)
+        return (filename, False, "%s: %s" % (e.__class__.__name__, e))
+
+    finally:
+        window.glWidget.makeCurrent()
+        window.undoStack.clear()
+        window.setWindowModified(False)
+        window.fileClose(False)
+
+def findBatchFiles(paths):
+    """ Expand the files and directories passed to --batch into a sorted list of model files. """
+    fileTypes = LicImporters.getFileTypesList()
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.splitext(name)[1].lower() in fileTypes:
+                    filenames.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            filenames.append(path)
+        else:
+            print "Skipping %s: no such file or directory" % path
+    return [os.path.abspath(f) for f in filenames]
+
+def runBatch(arguments):
+    """
+    Build instruction books for many models with no window, in a pool of worker processes.
+    Returns the process exit code: 0 if every book was built, 1 otherwise.
+    """
+    parser = optparse.OptionParser(usage="%prog --batch [options] MODEL|DIRECTORY ...",
+                                   description="Import each LDraw model (or every model in each directory), "
+                                   "apply the default template and save it as an instruction book. "
+                                   "Needs a display for its OpenGL contexts - use Xvfb on headless machines.")
+    parser.add_option("-o", "--output", metavar="DIR", help="save books and exports to DIR, instead of next to each model")
+    parser.add_option("--png", action="store_true", default=False, help="also export each page as a PNG image")
+    parser.add_option("--pdf", action="store_true", default=False, help="also export each book as a PDF")
+    parser.add_option("-j", "--jobs", type="int", default=multiprocessing.cpu_count(), help="number of worker processes [default: %default]")
+    options, paths = parser.parse_args(arguments)
+
+    filenames = findBatchFiles(paths)
+    if not filenames:
+        parser.error("no model files to build")
+
+    if options.output and not os.path.isdir(options.output):
+        os.makedirs(options.output)
+    output = os.path.abspath(options.output) if options.output else None
+
+    tasks = [(f, output, options.png, options.pdf) for f in filenames]
+    jobs = max(1, min(options.jobs, len(tasks)))
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initBatchWorker)
+        results = pool.imap_unordered(buildBatchBook, tasks)
+    else:
+        results = itertools.imap(buildBatchBook, tasks)
+
+    failures = 0
+    for filename, success, message in results:
+        print "%s %s: %s" % ("OK  " if success else "FAIL", filename, message)
+        if not success:
+            failures += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print "Built %d of %d instruction books" % (len(tasks) - failures, len(tasks))
+    return 1 if failures else 0
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # LDraw part parser processes re-enter here in frozen builds
     config.checkPath("" ,config.appDataPath())
     setupExceptionLogger()
 
-    app = QApplication(sys.argv)
-    app.setOrganizationName("BugEyedMonkeys Inc.")
-    app.setOrganizationDomain("bugeyedmonkeys.com")
-    app.setApplicationName("LICreator")
+    if sys.argv[1:2] == ['--batch']:
+        sys.exit(runBatch(sys.argv[2:]))
+
+    app = createApplication()
     window = LicWindow()
     
     try:
@@ -314,15 +314,18 @@ def __readAbstractPart(stream, createSubmodel=False, createMainmodel=False):
     part.pliRotation = [stream.readFloat(), stream.readFloat(), stream.readFloat()]
 
     for unused in range(stream.readInt32()):
-        p = __readPrimitive(stream)
-        part.primitives.append(p)
+        __readPrimitive(stream, part.primitives)
+
+    if stream.licFileVersion >= 19:
+        for unused in range(stream.readInt32()):
+            part.primitives.addConditionalLine(None, [stream.readFloat() for unused in range(12)])
 
     for unused in range(stream.readInt32()):
         p = __readPart(stream)       
         part.parts.append(p)
     return part
 
-def __readPrimitive(stream):
+def __readPrimitive(stream, primitives):
     color = __readLicColor(stream)
     gl_type = stream.readInt16()
     winding = stream.readInt32()
@@ -337,7 +340,7 @@ def __readPrimitive(stream):
     points = []
     for unused in range(count):
         points.append(stream.readFloat())
-    return Primitive(color, points, gl_type, winding)
+    primitives.add(color, points, gl_type, winding)
 
 def __readPart(stream):
     
@@ -671,7 +674,7 @@ def __linkModelPartNames(model):
     for part in [p for p in model.parts if p.inCallout]:
         for callout in part.getStep().callouts:
             for cPart in callout.getPartList():
-                if (cPart.filename == part.filename) and (cPart.matrix == part.matrix) and (cPart.color == part.color):
+                if (cPart.filename == part.filename) and (list(cPart.matrix) == list(part.matrix)) and (cPart.color == part.color):
                     part.calloutPart = cPart
                     cPart.originalPart= part
                     break               
@@ -184,6 +184,11 @@ def __writeAbstractPart(stream, part):
     stream.writeInt32(len(part.primitives))
     for primitive in part.primitives:
         __writePrimitive(stream, primitive)
+
+    conditionalLines = part.primitives.conditionalLines()
+    stream.writeInt32(len(conditionalLines))
+    for point in conditionalLines.reshape(-1).tolist():
+        stream.writeFloat(point)
         
     stream.writeInt32(len(part.parts))
     for part in part.parts:
@@ -194,7 +199,7 @@ def __writePrimitive(stream, primitive):
     stream.writeInt16(primitive.type)
     stream.writeInt32(primitive.winding)
 
-    for point in primitive.points:
+    for point in primitive.points.tolist():
         stream.writeFloat(point)
 
 def __writePart(stream, part):
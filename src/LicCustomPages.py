@@ -233,6 +233,8 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
         return self.addStep(step)
 
     def removeStep(self, step):
+        self.instructions.glContext.makeCurrent()
+        step.csi.deleteGLDisplayLists()
         self.scene().removeItem(step)
         self.steps.remove(step)
         self.children.remove(step)
@@ -470,21 +472,20 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
         try:
             w = Page.PageSize.width()
             h = Page.PageSize.height()
-            bufferManager = LicGLHelpers.FrameBufferManager(w, h)
             exportedFilename = self.getGLImageFilename()
 
-            bufferManager.bindMSFB()
-            LicGLHelpers.initFreshContext(True)
+            with LicGLHelpers.renderTargets.frameBuffer(w, h) as bufferManager:
+                bufferManager.bindMSFB()
+                LicGLHelpers.initFreshContext(True)
 
-            self.drawGLItemsOffscreen(QRectF(0, 0, w, h), 0.9)
-            bufferManager.blitMSFB()
-            data = bufferManager.readFB()
+                self.drawGLItemsOffscreen(QRectF(0, 0, w, h), 0.9)
+                bufferManager.blitMSFB()
+                data = bufferManager.readFB()
             
             image = Image.frombytes("RGBA", (w, h), data)
             image = image.transpose(Image.FLIP_TOP_BOTTOM)
             image.save(exportedFilename)
         finally:
-            bufferManager.cleanup()
             if self.scene().notificationArea:
                 self.scene().notificationArea.setText("Saved to: %s" % exportedFilename)
         
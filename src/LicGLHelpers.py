@@ -19,6 +19,11 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import contextlib
+import logging
+import math
+
+import numpy
 import OpenGL
 from OpenGL.GL import *
 from OpenGL.GL.EXT.framebuffer_blit import *
@@ -26,7 +31,7 @@ from OpenGL.GL.EXT.framebuffer_multisample import *
 from OpenGL.GL.EXT.framebuffer_object import *
 from OpenGL.GLU import *
 from PyQt4.QtCore import QPointF
-from PyQt4.QtOpenGL import QGLFormat, QGL
+from PyQt4.QtOpenGL import QGLFormat, QGL, QGLPixelBuffer
 
 from PIL import Image, ImageChops
 
@@ -36,6 +41,10 @@ OpenGL.ERROR_CHECKING = False
 OpenGL.ERROR_LOGGING = False
 UNINIT_GL_DISPID = -1
 
+# Size CSIs from their projected geometry, and skip rendering parts in buffers they can't fit in.
+# Turn off to dimension everything by rendering it and reading the pixels back.
+analyticDimensions = True
+
 def IdentityMatrix():
     return [1.0, 0.0, 0.0, 0.0,
             0.0, 1.0, 0.0, 0.0,
@@ -275,6 +284,103 @@ class FrameBufferManager(object):
         glDeleteRenderbuffersEXT(1, [self.multisampleDepthBuffer])
         glDeleteRenderbuffersEXT(1, [self.multisampleColorBuffer])
 
+class RenderTargetPool(object):
+    """
+    Offscreen render targets kept alive between uses, so sizing and exporting images doesn't create and
+    destroy a pixel buffer or frame buffer every time.  Targets are keyed by (kind, width, height, multisample):
+    pixelBuffer() hands out QGLPixelBuffers sharing a context's display lists, frameBuffer() FrameBufferManagers.
+
+    Released targets stay idle for reuse, the least recently used ones evicted once the idle ones hold more than
+    maxIdlePixels.  Targets bigger than maxTargetPixels, like high resolution export buffers, are deleted on release.
+    evict() drops every idle target; leaks() lists targets handed out but never released.
+
+    Frame buffers aren't shared between contexts, and eviction can happen while a pooled pixel buffer's context
+    is current, so evicted frame buffers are only deleted once their own context is current again: when
+    frameBuffer() lends or takes back a target, or in evict().
+    """
+
+    maxIdlePixels = 2048 * 2048 * 2
+    maxTargetPixels = 2048 * 2048
+
+    def __init__(self):
+        self.__idle = []  # [(key, target)], least recently released first
+        self.__busy = {}  # {id(target): (key, target)}
+        self.__staleFrameBuffers = []  # Evicted FrameBufferManagers, waiting for their context to be current
+        self.createdCount = 0
+        self.reusedCount = 0
+        self.evictedCount = 0
+
+    def __acquire(self, key, create):
+        for i in range(len(self.__idle) - 1, -1, -1):
+            if self.__idle[i][0] == key:
+                target = self.__idle.pop(i)[1]
+                self.reusedCount += 1
+                break
+        else:
+            target = create()
+            self.createdCount += 1
+
+        self.__busy[id(target)] = (key, target)
+        return target
+
+    def __release(self, target):
+        key, target = self.__busy.pop(id(target))
+        if key[1] * key[2] > self.maxTargetPixels:
+            self.__delete(key, target)
+            return
+
+        self.__idle.append((key, target))
+        while self.__idle and sum(key[1] * key[2] for key, unused in self.__idle) > self.maxIdlePixels:
+            self.__delete(*self.__idle.pop(0))
+
+    def __delete(self, key, target):
+        if key[0] == 'frameBuffer':
+            self.__staleFrameBuffers.append(target)  # Frame buffers belong to the GL context, so must be deleted explicitly
+        self.evictedCount += 1
+
+    def __deleteStaleFrameBuffers(self):
+        while self.__staleFrameBuffers:
+            self.__staleFrameBuffers.pop().cleanup()
+
+    @contextlib.contextmanager
+    def pixelBuffer(self, size, shareContext):
+        """ Lend a size x size multisampled QGLPixelBuffer that shares display lists with shareContext. """
+        key = ('pixelBuffer', size, size, True, shareContext)
+        target = self.__acquire(key, lambda: QGLPixelBuffer(size, size, getGLFormat(), shareContext))
+        try:
+            yield target
+        finally:
+            self.__release(target)
+
+    @contextlib.contextmanager
+    def frameBuffer(self, width, height):
+        """ Lend a multisampled FrameBufferManager of width x height, in the current GL context. """
+        key = ('frameBuffer', width, height, True)
+        self.__deleteStaleFrameBuffers()
+        target = self.__acquire(key, lambda: FrameBufferManager(width, height))
+        try:
+            yield target
+        finally:
+            self.__release(target)
+            self.__deleteStaleFrameBuffers()
+
+    def evict(self):
+        """
+        Delete every idle target, and log any target still handed out.
+        For frame buffers, the context they were created in must be current.
+        """
+        while self.__idle:
+            self.__delete(*self.__idle.pop())
+        self.__deleteStaleFrameBuffers()
+        for key in self.leaks():
+            logging.error('------------------------------------------------------\n RenderTargetPool => %s %dx%d was never released' % key[:3])
+
+    def leaks(self):
+        """ Return the (kind, width, height, multisample) of every target handed out and not yet released. """
+        return [key[:4] for key, unused in self.__busy.values()]
+
+renderTargets = RenderTargetPool()
+
 def _checkImgBounds(top, bottom, left, right, size):
     if (top == 0) or (bottom == size):
         return True
@@ -358,6 +464,10 @@ def initImgSize(size, glDispID, filename, scale, rotation, partRotation):
     if _checkImgBounds(top, bottom, left, right, size):
         return None  # Drew at least one edge out of bounds - try next buffer size
     
+    return _getImgSize(size, left, top, right, bottom, leftInset, bottomInset)
+
+def _getImgSize(size, left, top, right, bottom, leftInset, bottomInset):
+
     imgWidth = right - left + 1
     imgHeight = bottom - top
     
@@ -366,3 +476,104 @@ def initImgSize(size, glDispID, filename, scale, rotation, partRotation):
     imgCenter = QPointF(-w, h - 1)
 
     return (imgWidth, imgHeight, imgCenter, leftInset, bottomInset)
+
+def _getPixelBounds(extents, size):
+    """ Return the (left, top, right, bottom) box _getBounds would find for geometry projecting to extents, centered in a size buffer. """
+    pad = __LIC_GL_LINE_THICKNESS / 2.0
+    half = size / 2
+    left = int(math.floor(extents[0] - pad)) + half
+    top = int(math.floor(extents[1] - pad)) + half
+    right = int(math.floor(extents[2] + pad)) + half + 1
+    bottom = int(math.floor(extents[3] + pad)) + half + 1
+    return (left, top, right, bottom)
+
+def extentsFitImage(extents, size):
+    """ Return True if geometry projecting to extents (scaled, like LicGeometry.projectedExtents returns) renders in frame in a size buffer. """
+    left, top, right, bottom = _getPixelBounds(extents, size)
+    return left > 0 and top > 0 and right < size and bottom < size
+
+# Buffer size parts are tiled into when dimensioning many at once, see initImgSizeAtlas.  0 dimensions each part on its own.
+atlasSize = 2048
+
+# Room to spare around an item's projected extents, as a fraction of its size, when predicting its buffer size
+bufferSizeMargin = 0.1
+
+def predictBufferSize(extents, sizes):
+    """
+    Return the index of the smallest of sizes that geometry projecting to extents (scaled, like extentsFitImage takes)
+    should render into in frame, with bufferSizeMargin to spare, so it usually needs rendering only once.
+    Returns 0, the bottom of the ladder, when extents is None or analytic dimensioning is off.
+    """
+    if extents is None or not analyticDimensions or not sizes:
+        return 0
+
+    margin = bufferSizeMargin * max(extents[2] - extents[0], extents[3] - extents[1]) + 1.0
+    padded = (extents[0] - margin, extents[1] - margin, extents[2] + margin, extents[3] + margin)
+    for i, size in enumerate(sizes):
+        if extentsFitImage(padded, size):
+            return i
+    return len(sizes) - 1
+
+def initImgSizeAtlas(size, tileSize, items):
+    """
+    Dimension many images with a single readback: each of items, a (glDispID, scale, rotation, partRotation) tuple,
+    is drawn into its own tileSize square of the current size x size buffer, which is read back once.
+    Every tile is then scanned for its bounding box and corner insets at once, with NumPy.
+    At most (size / tileSize) ** 2 items fit.
+
+    Returns a list holding, for each item, what initImgSize would return for it in a tileSize buffer:
+    None if it rendered out of frame, otherwise (width, height, centerPoint, leftInset, bottomInset).
+    """
+    perRow = size / tileSize
+
+    # Clear the whole atlas with white, then draw each piece in black, clipped to its own tile
+    glClearColor(1.0, 1.0, 1.0, 1.0)
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glPushAttrib(GL_SCISSOR_BIT)
+    glEnable(GL_SCISSOR_TEST)
+
+    for i, (glDispID, scale, rotation, partRotation) in enumerate(items):
+        x, y = (i % perRow) * tileSize, (i / perRow) * tileSize
+        glScissor(x, y, tileSize, tileSize)
+        glColor3f(0, 0, 0)
+        adjustGLViewport(x, y, tileSize, tileSize)
+        rotateToView(rotation, scale)
+        rotateView(*partRotation)
+        glCallList(glDispID)
+
+    glPopAttrib()
+
+    # Same rows and columns as the PIL image _getBounds builds: tile i at row i / perRow, column i % perRow
+    pixels = numpy.frombuffer(glReadPixels(0, 0, size, size, GL_RGB, GL_UNSIGNED_BYTE), numpy.uint8)
+    ink = (pixels.reshape(size, size, 3) != 255).any(2)
+    tiles = ink.reshape(perRow, tileSize, perRow, tileSize).swapaxes(1, 2).reshape(-1, tileSize, tileSize)[:len(items)]
+
+    rows, columns = tiles.any(2), tiles.any(1)  # Whether each row / column of each tile has any ink
+    drawn = rows.any(1)
+    top, left = rows.argmax(1), columns.argmax(1)
+    bottom = tileSize - rows[:, ::-1].argmax(1)
+    right = tileSize - columns[:, ::-1].argmax(1)
+
+    # Insets: first ink along the box's top row, and down the box's left column
+    indexes = numpy.arange(len(tiles))
+    leftInset = tiles[indexes, top, :].argmax(1) - left
+    bottomInset = tiles[indexes, :, left].argmax(1) - top
+
+    results = []
+    for i in range(len(tiles)):
+        if not drawn[i] or _checkImgBounds(top[i], bottom[i], left[i], right[i], tileSize):
+            results.append(None)  # Rendered entirely or partly out of its tile
+        else:
+            results.append(_getImgSize(tileSize, int(left[i]), int(top[i]), int(right[i]), int(bottom[i]),
+                                       int(leftInset[i]), int(bottomInset[i])))
+    return results
+
+def initImgSizeFromExtents(extents):
+    """
+    Return the (width, height, centerPoint, leftInset, bottomInset) initImgSize would find for an image whose geometry
+    projects to extents, the scaled [min x, min y, max x, max y] LicGeometry.projectedExtents returns.
+    Nothing is rendered, and the image can never fall out of frame.  Corner insets need pixels, so they're left at 0.
+    """
+    size = 2 * (int(max(abs(e) for e in extents) + __LIC_GL_LINE_THICKNESS) + 2)
+    left, top, right, bottom = _getPixelBounds(extents, size)
+    return _getImgSize(size, left, top, right, bottom, 0, 0)
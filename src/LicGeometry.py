@@ -0,0 +1,530 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (LicGeometry.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import math
+import weakref
+
+import numpy
+from OpenGL import GL
+
+
+# Not a GL type: LDraw type 5 lines (2 end points + 2 control points), drawn only where they outline the part
+ConditionalLines = -1
+
+# Number of floats (3 per vertex) in one primitive of each supported GL type
+PointCounts = {GL.GL_LINES: 6, GL.GL_TRIANGLES: 9, GL.GL_QUADS: 12, ConditionalLines: 12}
+PrimitiveTypes = (GL.GL_LINES, GL.GL_TRIANGLES, GL.GL_QUADS)
+
+# Draw conditional lines in CSIs and PLIs.  Turn off to draw only regular edges.
+conditionalLinesEnabled = True
+
+# Crease angle in degrees for smooth shading: vertex normals are averaged over the faces meeting at that vertex
+# whose normals differ by less than this angle.  None draws every face flat, with its own normal.
+creaseAngle = None
+
+class PrimitiveStore(object):
+    """
+    Holds every line, triangle and quad of one AbstractPart in packed arrays, one set per GL type:
+        points: float32 array of shape (count, vertices per primitive, 3)
+        colors: int16 array of indexes into self.colors, the palette of LicColors used by this part
+        windings: int32 array of GL.GL_CW / GL.GL_CCW, one per primitive
+
+    Primitives added during import go into compact builder arrays first, and are packed into
+    numpy arrays the first time the packed arrays are needed.  Iterating or indexing the store
+    yields Primitive views, for code that wants to deal with one primitive at a time.
+
+    The packed arrays are drawn as client side vertex arrays, and only ever while a part display
+    list compiles.  GL copies vertex data into the list then, so there is no vertex buffer object
+    renderer: buffers would only be read at compile time, doubling the memory the geometry uses.
+    """
+
+    def __init__(self):
+        self.colors = []  # Palette of distinct LicColor instances (or None) used by this part
+        self.__colorIndexes = {}  # {id(LicColor): index into self.colors}
+        self.__builders = {}  # {GL type: (float points array, color index array, winding array)}
+        self.__arrays = {}  # {GL type: (points, colors, windings) numpy arrays}
+        self.__faces = None  # {GL type: (points, colors, normals)} of triangles & quads, see faces()
+        self.__boundingBox = None
+
+    def __len__(self):
+        count = 0
+        for t in PrimitiveTypes:
+            count += len(self.arrays(t)[1])
+        return count
+
+    def __iter__(self):
+        for t in PrimitiveTypes:
+            for i in range(len(self.arrays(t)[1])):
+                yield Primitive(self, t, i)
+
+    def __getitem__(self, index):
+        count = len(self)
+        if index < 0:
+            index += count
+        if index < 0 or index >= count:
+            raise IndexError("primitive index out of range")
+        for t in PrimitiveTypes:
+            typeCount = len(self.arrays(t)[1])
+            if index < typeCount:
+                return Primitive(self, t, index)
+            index -= typeCount
+
+    def colorIndex(self, color):
+        index = self.__colorIndexes.get(id(color))
+        if index is None:
+            index = self.__colorIndexes[id(color)] = len(self.colors)
+            self.colors.append(color)
+        return index
+
+    def add(self, color, points, gltype, winding=GL.GL_CW):
+        """ Add one primitive.  points is a flat list of 6, 9 or 12 floats, depending on gltype. """
+        builder = self.__builders.get(gltype)
+        if builder is None:
+            builder = self.__builders[gltype] = (array.array('f'), array.array('h'), array.array('i'))
+
+        builder[0].extend(points[:PointCounts[gltype]])
+        builder[1].append(self.colorIndex(color))
+        builder[2].append(winding)
+        self.__boundingBox = None
+        self.__faces = None
+
+    def addConditionalLine(self, color, points):
+        """ Add one conditional line.  points is a flat list of 12 floats: 2 end points then 2 control points. """
+        self.add(color, points, ConditionalLines)
+
+    def conditionalLines(self):
+        """ Return every conditional line as a (count, 4, 3) array of end points and control points. """
+        return self.arrays(ConditionalLines)[0]
+
+    def append(self, primitive):
+        self.add(primitive.color, list(primitive.points), primitive.type, primitive.winding)
+
+    def arrays(self, gltype):
+        """ Return the packed (points, colors, windings) numpy arrays for every primitive of this GL type. """
+        builder = self.__builders.pop(gltype, None)
+        packed = self.__arrays.get(gltype)
+
+        if builder is not None:
+            points = numpy.frombuffer(builder[0], numpy.float32).reshape(-1, PointCounts[gltype] / 3, 3)
+            colors = numpy.frombuffer(builder[1], numpy.int16)
+            windings = numpy.frombuffer(builder[2], numpy.int32)
+            if packed is not None:
+                points = numpy.concatenate((packed[0], points))
+                colors = numpy.concatenate((packed[1], colors))
+                windings = numpy.concatenate((packed[2], windings))
+            packed = self.__arrays[gltype] = (points.copy(), colors.copy(), windings.copy())
+
+        elif packed is None:
+            packed = (numpy.zeros((0, PointCounts[gltype] / 3, 3), numpy.float32),
+                      numpy.zeros(0, numpy.int16), numpy.zeros(0, numpy.int32))
+        return packed
+
+    def extend(self, other, matrix=None, flipWinding=False):
+        """
+        Add every primitive of the PrimitiveStore other, with its points transformed by matrix, a (4, 4) array
+        like glMatrices returns.  flipWinding swaps clockwise and counter clockwise, for geometry that was drawn inverted.
+        """
+        for t in PointCounts:
+            points, colors, windings = other.arrays(t)
+            if not len(colors):
+                continue
+
+            if matrix is not None:
+                points = (numpy.dot(points, matrix[:3, :3]) + matrix[3, :3]).astype(numpy.float32)
+            if flipWinding:
+                windings = numpy.where(windings == GL.GL_CW, GL.GL_CCW, GL.GL_CW).astype(numpy.int32)
+            palette = numpy.array([self.colorIndex(c) for c in other.colors], numpy.int16)
+
+            packed = self.arrays(t)
+            self.__arrays[t] = (numpy.concatenate((packed[0], points)),
+                                numpy.concatenate((packed[1], palette[colors])),
+                                numpy.concatenate((packed[2], windings)))
+        self.__boundingBox = None
+        self.__faces = None
+
+    def vertexCount(self):
+        count = 0
+        for t in PrimitiveTypes:
+            points = self.arrays(t)[0]
+            count += points.shape[0] * points.shape[1]
+        return count
+
+    def drawCallCount(self):
+        """ Return the number of glDrawArrays calls callGLDisplayList makes for faces and edges together. """
+        count = 1 if len(self.arrays(GL.GL_LINES)[1]) else 0
+        for t in (GL.GL_TRIANGLES, GL.GL_QUADS):
+            count += len(numpy.unique(self.arrays(t)[1]))
+        return count
+
+    def duplicate(self):
+        store = PrimitiveStore()
+        store.colors = list(self.colors)
+        store.__colorIndexes = dict(self.__colorIndexes)
+        for t in PointCounts:
+            points, colors, windings = self.arrays(t)
+            if len(colors):
+                store.__arrays[t] = (points.copy(), colors.copy(), windings.copy())
+        return store
+
+    def getBoundingBox(self):
+        """ Return the (min corner, max corner) of all points in this store as two numpy arrays, or None if empty. """
+        if self.__boundingBox is None:
+            corners = []
+            for t in PrimitiveTypes:
+                points = self.arrays(t)[0]
+                if len(points):
+                    points = points.reshape(-1, 3)
+                    corners += [points.min(0), points.max(0)]
+            if corners:
+                corners = numpy.array(corners)
+                self.__boundingBox = (corners.min(0), corners.max(0))
+        return self.__boundingBox
+
+    def pointsChanged(self):
+        """ Call after editing points in place through a Primitive view, to drop the box and faces derived from them. """
+        self.__boundingBox = None
+        self.__faces = None
+
+    def faces(self, gltype):
+        """
+        Return (points, colors, normals) for every triangle or quad in this store, ready to draw:
+        clockwise faces have their vertex order reversed, and normals holds one unit normal per vertex,
+        shaped like points.  Resolved once for all face types, then kept until the store changes.
+        """
+        if self.__faces is None:
+            self.__faces = self.__resolveFaces()
+        return self.__faces[gltype]
+
+    def __resolveFaces(self):
+        faces = {}
+        for t in (GL.GL_TRIANGLES, GL.GL_QUADS):
+            points, colors, windings = self.arrays(t)
+
+            # Clockwise faces get their vertex order reversed, like LDraw BFC expects
+            cw = windings == GL.GL_CW
+            if cw.any():
+                points = points.copy()
+                points[cw, 1:] = points[cw, :0:-1]
+
+            normals = numpy.cross(points[:, 1] - points[:, 0], points[:, 2] - points[:, 0])
+            lengths = numpy.sqrt((normals * normals).sum(1))
+            lengths[lengths == 0] = 1.0
+            normals /= lengths[:, numpy.newaxis]
+            faces[t] = (points, colors, numpy.repeat(normals[:, numpy.newaxis], points.shape[1], 1).astype(numpy.float32))
+
+        if creaseAngle is not None:
+            tris, quads = faces[GL.GL_TRIANGLES], faces[GL.GL_QUADS]
+            points = numpy.concatenate((tris[0].reshape(-1, 3), quads[0].reshape(-1, 3)))
+            normals = numpy.concatenate((tris[2].reshape(-1, 3), quads[2].reshape(-1, 3)))
+            normals = smoothNormals(points, normals, creaseAngle).astype(numpy.float32)
+            split = tris[0].shape[0] * 3
+            faces[GL.GL_TRIANGLES] = (tris[0], tris[1], normals[:split].reshape(tris[0].shape))
+            faces[GL.GL_QUADS] = (quads[0], quads[1], normals[split:].reshape(quads[0].shape))
+        return faces
+
+    def callGLDisplayList(self, paintingEdge):
+
+        # must be called inside a glNewList/EndList pair
+        # Vertex arrays are dereferenced when compiled into a display list, so each type / color
+        # batch becomes one glDrawArrays call instead of a glBegin / glEnd pair per primitive.
+        GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+
+        if paintingEdge:
+            points = self.arrays(GL.GL_LINES)[0]
+            if len(points):
+                GL.glVertexPointer(3, GL.GL_FLOAT, 0, numpy.ascontiguousarray(points))
+                GL.glDrawArrays(GL.GL_LINES, 0, len(points) * 2)
+        else:
+            GL.glEnableClientState(GL.GL_NORMAL_ARRAY)
+            for t in (GL.GL_TRIANGLES, GL.GL_QUADS):
+                points, colors, normals = self.faces(t)
+                if len(points):
+                    self.__drawFaces(t, points, colors, normals)
+
+        GL.glPopClientAttrib()
+
+    def __drawFaces(self, gltype, points, colors, normals):
+
+        for colorIndex in numpy.unique(colors):
+            selected = colors == colorIndex
+            vertices = numpy.ascontiguousarray(points[selected].reshape(-1, 3))
+            vertexNormals = numpy.ascontiguousarray(normals[selected].reshape(-1, 3))
+
+            color = self.colors[colorIndex]
+            if color is not None:
+                GL.glPushAttrib(GL.GL_CURRENT_BIT)
+                GL.glColor4fv(color.rgba)
+
+            GL.glVertexPointer(3, GL.GL_FLOAT, 0, vertices)
+            GL.glNormalPointer(GL.GL_FLOAT, 0, vertexNormals)
+            GL.glDrawArrays(gltype, 0, len(vertices))
+
+            if color is not None:
+                GL.glPopAttrib()
+
+class Primitive(object):
+    """
+    Not a primitive in the LDraw sense, just a single line/triangle/quad.
+    A lightweight view of one entry in a PrimitiveStore; points is a writable view into the store.
+    """
+
+    __slots__ = ('store', 'type', 'index')
+
+    def __init__(self, store, gltype, index):
+        self.store = store
+        self.type = gltype
+        self.index = index
+
+    @property
+    def color(self):
+        return self.store.colors[self.store.arrays(self.type)[1][self.index]]
+
+    @property
+    def winding(self):
+        return int(self.store.arrays(self.type)[2][self.index])
+
+    @property
+    def points(self):
+        return self.store.arrays(self.type)[0][self.index].reshape(-1)
+
+class TransformTable(object):
+    """
+    Holds the 4x4 placement matrix of every Part of a model, 16 floats per row, in contiguous float64 blocks.
+    A Part keeps a writable (16,) view of its row, so part.matrix[12] = x updates the table in place, and
+    batch operations gather many parts' matrices with one fancy index per block instead of a Python loop.
+    Blocks are never resized, so views stay valid as the table grows.
+    """
+
+    blockSize = 4096
+
+    def __init__(self):
+        self.__blocks = []
+        self.__free = []  # Released rows, reused before the table grows
+        self.__owners = {}  # {row: weakref to the object owning that row}, see allocate
+        self.__rowCount = 0
+
+    def __len__(self):
+        return self.__rowCount - len(self.__free)
+
+    def allocate(self, owner=None):
+        """
+        Return (row, view) of a new row, set to identity.  If owner is given, the row is released
+        once owner is garbage collected, so rows of deleted Parts don't stay in use for the whole session.
+        """
+        if self.__free:
+            row = self.__free.pop()
+        else:
+            row = self.__rowCount
+            self.__rowCount += 1
+            if row >= len(self.__blocks) * self.blockSize:
+                self.__blocks.append(numpy.zeros((self.blockSize, 16)))
+
+        view = self.view(row)
+        view[:] = IdentityRow
+        if owner is not None:
+            self.__owners[row] = weakref.ref(owner, lambda ref, row=row: self.__ownerCollected(row, ref))
+        return row, view
+
+    def release(self, row):
+        self.__owners.pop(row, None)
+        self.__free.append(row)
+
+    def __ownerCollected(self, row, ref):
+        if self.__owners.get(row) is ref:  # Unless the row was already released, maybe even reused since
+            self.release(row)
+
+    def view(self, row):
+        return self.__blocks[row // self.blockSize][row % self.blockSize]
+
+    def gather(self, rows):
+        """ Return a copy of the matrices at rows as one (count, 4, 4) array, like glMatrices returns. """
+        rows = numpy.asarray(rows, numpy.intp)
+        result = numpy.empty((len(rows), 16))
+        blocks, offsets = rows // self.blockSize, rows % self.blockSize
+        for block in numpy.unique(blocks):
+            selected = blocks == block
+            result[selected] = self.__blocks[block][offsets[selected]]
+        return result.reshape(-1, 4, 4)
+
+IdentityRow = numpy.identity(4).reshape(16)
+
+# The table new Parts store their matrix in.  Replaced by resetTransformTable() whenever a new model is
+# loaded; Parts of the old model keep their views (and so their blocks) alive for as long as they live.
+transformTable = TransformTable()
+
+def resetTransformTable():
+    global transformTable
+    transformTable = TransformTable()
+
+def composeTransforms(local, parents):
+    """
+    Place every matrix of local (count, 4, 4) under every matrix of parents (instances, 4, 4) in one pass.
+    Return the (instances * count, 4, 4) result grouped by instance.  Like glMatrices, matrices multiply row vectors.
+    """
+    return numpy.einsum('mij,njk->nmik', local, parents).reshape(-1, 4, 4)
+
+def rotationMatrix(x, y, z):
+    """ Return the 3x3 rotation matrix LicGLHelpers.rotateView(x, y, z) applies, as glRotatef calls about x then y then z. """
+    matrix = numpy.identity(3)
+    for angle, (i, j) in ((x, (1, 2)), (y, (2, 0)), (z, (0, 1))):
+        c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        r = numpy.identity(3)
+        r[i, i], r[i, j], r[j, i], r[j, j] = c, -s, s, c
+        matrix = numpy.dot(matrix, r)
+    return matrix
+
+def viewTransform(*rotations):
+    """
+    Return the 3x3 linear part of the view LicGLHelpers.rotateToView sets up, followed by
+    each of the passed [x, y, z] rotations.  The view's translation and (uniform, positive)
+    scale are left out, since they can't change which side of a line a point projects to.
+    """
+    matrix = numpy.diag([1.0, -1.0, -1.0])  # gluLookAt from -z, then 180 degrees about z
+    for rotation in rotations:
+        matrix = numpy.dot(matrix, rotationMatrix(*rotation))
+    return matrix
+
+def linearTransform(transform, matrix):
+    """ Return transform combined with the rotation / scale part of a column major GL matrix. """
+    if matrix is None:
+        return transform
+    return numpy.dot(transform, numpy.array(matrix, numpy.float64).reshape(4, 4)[:3, :3].T)
+
+def transformPoints(points, matrix):
+    """ Transform an array of points, shaped (..., 3), by a column major GL matrix. """
+    if matrix is None:
+        return points
+    m = numpy.array(matrix, numpy.float64).reshape(4, 4)
+    return (numpy.dot(points, m[:3, :3]) + m[3, :3]).astype(numpy.float32)
+
+# Which of a box's (min, max) corners to use on each axis, for each of its 8 corners
+BoxCornerIndexes = numpy.array([[(i >> 2) & 1, (i >> 1) & 1, i & 1] for i in range(8)])
+
+def glMatrices(matrices):
+    """ Return a list of column major GL matrices (16 floats each) as one (count, 4, 4) array, to multiply row vectors by. """
+    return numpy.array(matrices, numpy.float64).reshape(-1, 4, 4)
+
+def transformBoxes(boxes, matrices):
+    """
+    Return the axis aligned bounds of each box after transforming it by its own matrix.
+    boxes is (count, 2, 3), a min and max corner per box; matrices is (count, 4, 4), like glMatrices returns.
+    All 8 corners of every box are transformed in one pass, so the bounds are exact under any rotation or mirroring.
+    """
+    boxes = numpy.asarray(boxes, numpy.float64)
+    if not len(boxes):
+        return numpy.zeros((0, 2, 3))
+
+    corners = boxes[:, BoxCornerIndexes, numpy.arange(3)]  # (count, 8, 3)
+    corners = numpy.einsum('nki,nij->nkj', corners, matrices[:, :3, :3]) + matrices[:, numpy.newaxis, 3, :3]
+    return numpy.concatenate((corners.min(1)[:, numpy.newaxis], corners.max(1)[:, numpy.newaxis]), 1)
+
+def unionBoxes(boxes):
+    """ Return the (2, 3) min and max corner enclosing every box of a (count, 2, 3) array. """
+    return numpy.array([boxes[:, 0].min(0), boxes[:, 1].max(0)])
+
+def uniquePoints(points):
+    """ Return the distinct rows of an array of points, as one (count, 3) float32 array in no particular order. """
+    points = numpy.ascontiguousarray(points, numpy.float32).reshape(-1, 3)
+    if not len(points):
+        return points
+    rows = points.view(numpy.dtype((numpy.void, points.dtype.itemsize * 3))).ravel()
+    return points[numpy.unique(rows, return_index=True)[1]]
+
+def placePoints(points, matrices):
+    """ Return points, a (count, 3) array, placed by each of matrices, like glMatrices returns, as one (n * count, 3) array. """
+    placed = numpy.einsum('vi,nij->nvj', points, matrices[:, :3, :3]) + matrices[:, numpy.newaxis, 3, :3]
+    return placed.reshape(-1, 3)
+
+def projectedExtents(points, view):
+    """
+    Return the [min x, min y, max x, max y] window extents of points, a (count, 3) array, seen through view,
+    a 3x3 array like viewTransform returns, or None if there are no points.  Like view, extents are unscaled.
+    """
+    if not len(points):
+        return None
+    xy = numpy.dot(points, view[:2].T)
+    return numpy.concatenate((xy.min(0), xy.max(0)))
+
+def unionExtents(extents):
+    """ Return the extents enclosing every one of a list of projectedExtents results, or None if they're all None. """
+    extents = numpy.array([e for e in extents if e is not None])
+    if not len(extents):
+        return None
+    return numpy.concatenate((extents[:, :2].min(0), extents[:, 2:].max(0)))
+
+def smoothNormals(points, normals, angle):
+    """
+    Return smoothed copies of per vertex normals: each vertex's normal becomes the average of the normals of
+    every vertex at the same position (within 1/1000 LDU) that differs from its own by less than angle degrees.
+    points and normals are (count, 3) arrays.  All vertex pairs sharing a position are compared in one pass.
+    """
+    if not len(points):
+        return normals
+
+    keys = numpy.ascontiguousarray(numpy.round(points * 1000.0).astype(numpy.int64))
+    keys = keys.view(numpy.dtype((numpy.void, keys.dtype.itemsize * 3))).ravel()
+    unused, groups = numpy.unique(keys, return_inverse=True)
+
+    # Build every (i, j) pair of vertices in the same group
+    order = numpy.argsort(groups, kind='mergesort')
+    counts = numpy.bincount(groups)
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    repeats = counts[groups[order]]
+    i = numpy.repeat(order, repeats)
+    offsets = numpy.arange(len(i)) - numpy.repeat(numpy.cumsum(repeats) - repeats, repeats)
+    j = order[numpy.repeat(starts[groups[order]], repeats) + offsets]
+
+    close = (normals[i] * normals[j]).sum(1) >= math.cos(math.radians(angle))
+    smooth = numpy.zeros(normals.shape, numpy.float64)
+    numpy.add.at(smooth, i[close], normals[j[close]])
+
+    lengths = numpy.sqrt((smooth * smooth).sum(1))
+    lengths[lengths == 0] = 1.0
+    return smooth / lengths[:, numpy.newaxis]
+
+def visibleConditionalLines(lines, transform):
+    """
+    Return the (count, 2, 3) end points of the conditional lines that are visible under transform.
+    All lines are projected in one pass; a line is visible when both its control points
+    project to the same side of it.  With an orthographic view only x & y of the transform matter.
+    """
+    if not len(lines):
+        return lines[:, :2]
+
+    xy = numpy.dot(lines, numpy.asarray(transform)[:2].T)  # (count, 4, 2)
+    d = xy[:, 1] - xy[:, 0]
+    c0 = xy[:, 2] - xy[:, 0]
+    c1 = xy[:, 3] - xy[:, 0]
+    side0 = d[:, 0] * c0[:, 1] - d[:, 1] * c0[:, 0]
+    side1 = d[:, 0] * c1[:, 1] - d[:, 1] * c1[:, 0]
+    return lines[side0 * side1 > 0, :2]
+
+def drawLines(segments):
+    """ Draw a (count, 2, 3) array of line segments in one glDrawArrays call, in the current color. """
+    if not len(segments):
+        return
+    GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+    GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+    GL.glVertexPointer(3, GL.GL_FLOAT, 0, numpy.ascontiguousarray(segments, numpy.float32))
+    GL.glDrawArrays(GL.GL_LINES, 0, len(segments) * 2)
+    GL.glPopClientAttrib()
@@ -25,6 +25,8 @@ import os.path
 import re
 import unicodedata
 
+import numpy
+
 from PyQt4.Qt import qGray, qRgb
 from PyQt4.QtCore import Qt, QPointF, QString, QSettings
 from PyQt4.QtGui import QPainterPath
@@ -146,6 +148,47 @@ class LicColorDict(dict):
         print color_error
         return black
 
+class PartDictionary(dict):
+    """
+    Dictionary of parts keyed by their original filename, which can also be searched 
+    regardless of case.  LDraw filenames are case insensitive, so 3001.DAT, 3001.dat and
+    3001.Dat all refer to the same part.  A lower case key index is kept on the side, so
+    findKey / find answer a case insensitive lookup with a single dict hit.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.__foldedKeys = {}
+        for key in self.keys():
+            self.__foldedKeys.setdefault(key.lower(), key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.__foldedKeys.setdefault(key.lower(), key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        folded = key.lower()
+        if self.__foldedKeys.get(folded) == key:
+            del self.__foldedKeys[folded]
+            for k in self.keys():  # Another key may differ from this one only by case
+                if k.lower() == folded:
+                    self.__foldedKeys[folded] = k
+                    break
+
+    def clear(self):
+        dict.clear(self)
+        self.__foldedKeys.clear()
+
+    def findKey(self, filename):
+        """ Return the key stored for filename, regardless of case, or None if there is none. """
+        if dict.__contains__(self, filename):
+            return filename
+        return self.__foldedKeys.get(filename.lower())
+
+    def find(self, filename):
+        key = self.findKey(filename)
+        return None if key is None else self[key]
+
 def writeLogEntry(message , sender="UnknownDeliverer"):
     logging.error('------------------------------------------------------\n {0} => {1}'.format(sender , message))
 
@@ -170,16 +213,8 @@ def determinant3x3(m):
 def multiplyMatrices(matrix1, matrix2):
     # m1 & m2 must be in the form [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
     # ie, matrix list straigth from a Part
-    m1 = listToMatrix(matrix1)
-    m2 = listToMatrix(matrix2)
-    m = [[0] * 4, [0] * 4, [0] * 4, [0] * 4]
-    
-    for i in range(4):
-        for j in range(4):
-            for k in range(4):
-                m[i][j] += m1[i][k] * m2[k][j]
-        
-    return matrixToList(m)
+    m = numpy.dot(numpy.reshape(matrix1, (4, 4)), numpy.reshape(matrix2, (4, 4)))
+    return m.reshape(16).tolist()
 
 def listToMatrix(l):
     return [l[0:4], l[4:8], l[8:12], l[12:16]]
@@ -228,20 +263,22 @@ def determinePartCode(strdata):
 
 def compareParts(p1, p2):
     if p1 and p2:
-        b1 = p1.getPartBoundingBox()
-        b2 = p2.getPartBoundingBox()
+        return compareBoxes(p1.getPartBoundingBox(), p2.getPartBoundingBox())
+    return -1
+
+def compareBoxes(b1, b2):
+    """ Order two part bounding boxes top to bottom, then back to front, then left to right. """
+    if abs(b1.y1 - b2.y1) < 6.0:  # tops equal enough - 6 to handle technic pins in holes
         
-        if abs(b1.y1 - b2.y1) < 6.0:  # tops equal enough - 6 to handle technic pins in holes
-            
-            if abs(b1.y2 - b2.y2) < 4.0:  # bottoms equal enough too
-                return cmp((-b1.z1, b1.x1), (-b2.z1, b2.x1))  # back to front, left to right
-            
-            if b1.y2 < b2.y2:  # compare bottoms
-                return 1
-            return -1
-            
-        if b1.y1 < b2.y1:  # compare tops
+        if abs(b1.y2 - b2.y2) < 4.0:  # bottoms equal enough too
+            return cmp((-b1.z1, b1.x1), (-b2.z1, b2.x1))  # back to front, left to right
+        
+        if b1.y2 < b2.y2:  # compare bottoms
             return 1
+        return -1
+        
+    if b1.y1 < b2.y1:  # compare tops
+        return 1
     return -1
 
 def getOffsetFromBox(direction, box):
@@ -0,0 +1,625 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (LDrawCache.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import contextlib
+import hashlib
+import logging
+import os.path
+import sys
+
+from PyQt4.QtCore import QDataStream, QFile, QIODevice, QString
+
+import config
+
+
+# Record types produced by LDrawImporter.lineListToRecords.  A parsed LDraw file
+# is nothing more than an ordered list of these records, which is what gets cached.
+StepRecord = 0
+PartRecord = 1
+PrimitiveRecord = 2
+WindingRecord = 3
+InvertNextRecord = 4
+ConditionalLineRecord = 5
+
+MagicNumber = 0x4C504331  # 'LPC1'
+CacheVersion = 3
+
+def writeLogEntry(message):
+    logging.error('------------------------------------------------------\n LDrawCache => %s' % message)
+
+def _readQString(stream):
+    s = QString()
+    stream >> s
+    return unicode(s)
+
+def _toBytes(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf8')
+    return path
+
+def _replaceFile(source, target):
+    if sys.platform == 'win32':
+        # os.rename won't overwrite an existing file on Windows, MoveFileEx can
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(target), MOVEFILE_REPLACE_EXISTING):
+            raise OSError("Could not replace %s" % target)
+    else:
+        os.rename(source, target)
+
+@contextlib.contextmanager
+def _atomicWrite(filename):
+    """
+    Yield a QDataStream writing to a temporary file beside filename, renamed over filename once the stream is done.
+    Readers, batch workers writing the same cache included, then only ever see a complete file: a crash or an
+    error part way leaves the previous file in place.  Yields None if the temporary file can't be created.
+    """
+    tempFilename = "%s.%d.tmp" % (filename, os.getpid())
+    fh = QFile(tempFilename)
+    if not fh.open(QIODevice.WriteOnly):
+        yield None
+        return
+
+    replaced = False
+    try:
+        stream = QDataStream(fh)
+        stream.setVersion(QDataStream.Qt_4_3)
+        yield stream
+
+        fh.close()
+        if stream.status() == QDataStream.Ok and fh.error() == QFile.NoError:
+            try:
+                _replaceFile(tempFilename, filename)
+                replaced = True
+            except OSError:
+                writeLogEntry("Could not replace %s" % filename)
+    finally:
+        fh.close()
+        if not replaced:
+            try:
+                os.remove(tempFilename)
+            except OSError:
+                pass
+
+class ParsedPart(object):
+    """ The result of parsing one LDraw file: its name, whether it's a primitive, and its record list. """
+
+    def __init__(self, name, isPrimitive, records):
+        self.name = name
+        self.isPrimitive = isPrimitive
+        self.records = records
+
+class ParsedPartCache(object):
+    """
+    Persistent, on disk cache of parsed LDraw library files.
+
+    Each file is stored in its own small binary file under partsCachePath()/parsed, named after
+    the hash of the file's resolved path.  Each cache file records the source path, modification
+    time and size it was built from; if any of those no longer match, the entry is rebuilt.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.__cachePath = None
+
+    def __getCachePath(self):
+        if self.__cachePath is None:
+            self.__cachePath = config.checkPath('parsed', config.partsCachePath())
+        return self.__cachePath
+
+    def __cacheFilename(self, fullPath):
+        key = _toBytes(os.path.normcase(os.path.abspath(fullPath)))
+        return os.path.join(self.__getCachePath(), hashlib.md5(key).hexdigest() + '.bin')
+
+    @staticmethod
+    def __fileStamp(fullPath):
+        st = os.stat(fullPath)
+        return (st.st_mtime, st.st_size)
+
+    def get(self, fullPath):
+        """ Return the cached ParsedPart for this file, or None if missing or out of date. """
+        if not self.enabled:
+            return None
+
+        try:
+            mtime, size = self.__fileStamp(fullPath)
+            fh = QFile(self.__cacheFilename(fullPath))
+            if not fh.exists() or not fh.open(QIODevice.ReadOnly):
+                return None
+        except (OSError, IOError):
+            return None
+
+        try:
+            stream = QDataStream(fh)
+            stream.setVersion(QDataStream.Qt_4_3)
+            if stream.readInt32() != MagicNumber or stream.readInt16() != CacheVersion:
+                return None
+
+            path = stream.readBytes()
+            if path != _toBytes(fullPath) or stream.readDouble() != mtime or stream.readInt64() != size:
+                return None  # Source file has changed since it was cached
+
+            name = _readQString(stream)
+            isPrimitive = stream.readBool()
+            records = self.__readRecords(stream)
+            if stream.status() != QDataStream.Ok:
+                return None
+            return ParsedPart(name, isPrimitive, records)
+        finally:
+            fh.close()
+
+    def put(self, fullPath, parsedPart):
+        if not self.enabled:
+            return
+
+        try:
+            mtime, size = self.__fileStamp(fullPath)
+        except (OSError, IOError):
+            return
+
+        with _atomicWrite(self.__cacheFilename(fullPath)) as stream:
+            if stream is None:
+                writeLogEntry("Could not write parsed part cache for %s" % fullPath)
+                return
+
+            stream.writeInt32(MagicNumber)
+            stream.writeInt16(CacheVersion)
+            stream.writeBytes(_toBytes(fullPath))
+            stream.writeDouble(mtime)
+            stream.writeInt64(size)
+            stream << QString(parsedPart.name)
+            stream.writeBool(parsedPart.isPrimitive)
+            self.__writeRecords(stream, parsedPart.records)
+
+    @staticmethod
+    def __writeRecords(stream, records):
+        stream.writeInt32(len(records))
+        for record in records:
+            recordType = record[0]
+            stream.writeInt16(recordType)
+
+            if recordType == PartRecord:
+                unused, filename, color, matrix, rgba = record
+                stream << QString(filename)
+                stream.writeInt32(color)
+                for v in matrix:
+                    stream.writeDouble(v)
+                stream.writeBool(bool(rgba))
+                for v in rgba:
+                    stream.writeDouble(v)
+
+            elif recordType == PrimitiveRecord:
+                unused, shape, color, points = record
+                stream.writeInt32(shape)
+                stream.writeInt32(color)
+                stream.writeInt16(len(points))
+                for v in points:
+                    stream.writeDouble(v)
+
+            elif recordType == WindingRecord:
+                stream.writeInt32(record[1])
+
+            elif recordType == ConditionalLineRecord:
+                unused, color, points = record
+                stream.writeInt32(color)
+                for v in points:
+                    stream.writeDouble(v)
+
+    @staticmethod
+    def __readRecords(stream):
+        records = []
+        for unused in range(stream.readInt32()):
+            recordType = stream.readInt16()
+
+            if recordType == PartRecord:
+                filename = _readQString(stream)
+                color = stream.readInt32()
+                matrix = [stream.readDouble() for unused in range(16)]
+                rgba = ()
+                if stream.readBool():
+                    rgba = tuple([stream.readDouble() for unused in range(4)])
+                records.append((PartRecord, filename, color, matrix, rgba))
+
+            elif recordType == PrimitiveRecord:
+                shape = stream.readInt32()
+                color = stream.readInt32()
+                points = [stream.readDouble() for unused in range(stream.readInt16())]
+                records.append((PrimitiveRecord, shape, color, points))
+
+            elif recordType == WindingRecord:
+                records.append((WindingRecord, stream.readInt32()))
+
+            elif recordType == ConditionalLineRecord:
+                color = stream.readInt32()
+                points = [stream.readDouble() for unused in range(12)]
+                records.append((ConditionalLineRecord, color, points))
+
+            else:
+                records.append((recordType,))
+        return records
+
+class LibraryPathIndex(object):
+    """
+    Case-insensitive index of every file in the LDraw library folders, mapping a lower
+    case LDraw reference like 3001.dat or s\\3001s01.dat to the full path of that file.
+
+    Each indexed directory is scanned once, and its contents are persisted to
+    partsCachePath()/pathindex.bin together with the directory's modification time.
+    Directories are re-stat'ed at most once per import (see checkForChanges), and only
+    the ones whose mtime changed are listed again.  A lookup is then a single dict hit.
+    """
+
+    enabled = True
+    fileExtensions = ('.dat', '.ldr', '.mpd', '.l3b')
+
+    def __init__(self):
+        self.__dirs = {}  # {directory: (mtime, [file names], [sub directory names])}
+        self.__indexes = {}  # {tuple of root directories: {lower case name: full path}}
+        self.__loaded = False
+        self.__stale = True
+        self.__dirty = False
+
+    def __getIndexFilename(self):
+        return os.path.join(config.partsCachePath(), 'pathindex.bin')
+
+    def checkForChanges(self):
+        """ Have the next lookup check every indexed directory's mtime for changes. """
+        self.__stale = True
+
+    def lookup(self, filename, roots):
+        """
+        Find filename in the first of the root directories (or their immediate sub directories) that contains it.
+
+        Returns the full path to the file, or None if it's not in the index.
+        """
+        if not self.__loaded:
+            self.__load()
+            self.__loaded = True
+
+        if self.__stale:
+            self.__refresh()
+            self.__stale = False
+
+        roots = tuple(roots)
+        index = self.__indexes.get(roots)
+        if index is None:
+            index = self.__indexes[roots] = self.__buildIndex(roots)
+            if self.__dirty:
+                self.__save()
+
+        return index.get(filename.replace('/', '\\').lower())
+
+    def __scanDirectory(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.__dirs.pop(path, None)
+            return None
+
+        entry = self.__dirs.get(path)
+        if entry and entry[0] == mtime:
+            return entry
+
+        files, subdirs = [], []
+        for name in os.listdir(path):
+            # Avoid a stat for every single part: anything with an LDraw extension is a file
+            if os.path.splitext(name)[1].lower() in self.fileExtensions:
+                files.append(name)
+            elif os.path.isdir(os.path.join(path, name)):
+                subdirs.append(name)
+            else:
+                files.append(name)
+
+        entry = self.__dirs[path] = (mtime, files, subdirs)
+        self.__dirty = True
+        return entry
+
+    def __buildIndex(self, roots):
+        index = {}
+        for root in roots:
+            entry = self.__scanDirectory(root)
+            if entry is None:
+                continue
+
+            unused, files, subdirs = entry
+            for name in files:
+                index.setdefault(name.lower(), os.path.join(root, name))
+
+            for subdir in subdirs:
+                subpath = os.path.join(root, subdir)
+                subentry = self.__scanDirectory(subpath)
+                if subentry is None:
+                    continue
+                for name in subentry[1]:
+                    index.setdefault((subdir + '\\' + name).lower(), os.path.join(subpath, name))
+        return index
+
+    def __refresh(self):
+        changed = False
+        for path in self.__dirs.keys():
+            mtime = self.__dirs[path][0]
+            entry = self.__scanDirectory(path)
+            if entry is None or entry[0] != mtime:
+                changed = True
+
+        if changed:
+            self.__indexes = {}  # Rebuild merged indexes lazily, from the updated directory listings
+        if self.__dirty:
+            self.__save()
+
+    def __load(self):
+        fh = QFile(self.__getIndexFilename())
+        if not fh.exists() or not fh.open(QIODevice.ReadOnly):
+            return
+
+        try:
+            stream = QDataStream(fh)
+            stream.setVersion(QDataStream.Qt_4_3)
+            if stream.readInt32() != MagicNumber or stream.readInt16() != CacheVersion:
+                return
+
+            dirs = {}
+            for unused in range(stream.readInt32()):
+                path = stream.readBytes()
+                mtime = stream.readDouble()
+                files = [stream.readBytes() for unused in range(stream.readInt32())]
+                subdirs = [stream.readBytes() for unused in range(stream.readInt32())]
+                dirs[path] = (mtime, files, subdirs)
+
+            if stream.status() == QDataStream.Ok:
+                self.__dirs = dirs
+        finally:
+            fh.close()
+
+    def __save(self):
+        with _atomicWrite(self.__getIndexFilename()) as stream:
+            if stream is None:
+                writeLogEntry("Could not write LDraw library path index")
+                return
+
+            stream.writeInt32(MagicNumber)
+            stream.writeInt16(CacheVersion)
+            stream.writeInt32(len(self.__dirs))
+            for path, (mtime, files, subdirs) in self.__dirs.items():
+                stream.writeBytes(_toBytes(path))
+                stream.writeDouble(mtime)
+                stream.writeInt32(len(files))
+                for name in files:
+                    stream.writeBytes(_toBytes(name))
+                stream.writeInt32(len(subdirs))
+                for name in subdirs:
+                    stream.writeBytes(_toBytes(name))
+            self.__dirty = False
+
+class ColorTableCache(object):
+    """
+    Cache of the parsed LDConfig.ldr colour table: a list of (code, r, g, b, a, name, er, eg, eb) tuples.
+
+    The table is kept in memory for the life of the process, and on disk in partsCachePath()/ldconfig.bin.
+    Both are keyed by LDConfig.ldr's path, modification time and size, so editing it rebuilds the table.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.__key = None
+        self.__colors = None
+
+    def __getCacheFilename(self):
+        return os.path.join(config.partsCachePath(), 'ldconfig.bin')
+
+    @staticmethod
+    def __fileKey(fullPath):
+        st = os.stat(fullPath)
+        return (_toBytes(fullPath), st.st_mtime, st.st_size)
+
+    def get(self, fullPath):
+        """ Return the cached colour table built from this LDConfig.ldr, or None if missing or out of date. """
+        if not self.enabled:
+            return None
+
+        try:
+            key = self.__fileKey(fullPath)
+        except OSError:
+            return None
+
+        if self.__key == key:
+            return self.__colors
+
+        fh = QFile(self.__getCacheFilename())
+        if not fh.exists() or not fh.open(QIODevice.ReadOnly):
+            return None
+
+        try:
+            stream = QDataStream(fh)
+            stream.setVersion(QDataStream.Qt_4_3)
+            if stream.readInt32() != MagicNumber or stream.readInt16() != CacheVersion:
+                return None
+            if (stream.readBytes(), stream.readDouble(), stream.readInt64()) != key:
+                return None  # LDConfig.ldr has changed since it was cached
+
+            colors = []
+            for unused in range(stream.readInt32()):
+                code = stream.readInt32()
+                r, g, b, a = [stream.readDouble() for unused in range(4)]
+                name = _readQString(stream)
+                er, eg, eb = [stream.readDouble() for unused in range(3)]
+                colors.append((code, r, g, b, a, name, er, eg, eb))
+
+            if stream.status() != QDataStream.Ok:
+                return None
+        finally:
+            fh.close()
+
+        self.__key, self.__colors = key, colors
+        return colors
+
+    def put(self, fullPath, colors):
+        if not self.enabled:
+            return
+
+        try:
+            key = self.__fileKey(fullPath)
+        except OSError:
+            return
+        self.__key, self.__colors = key, colors
+
+        fh = QFile(self.__getCacheFilename())
+        if not fh.open(QIODevice.WriteOnly):
+            writeLogEntry("Could not write LDConfig colour cache")
+            return
+
+        try:
+            stream = QDataStream(fh)
+            stream.setVersion(QDataStream.Qt_4_3)
+            stream.writeInt32(MagicNumber)
+            stream.writeInt16(CacheVersion)
+            stream.writeBytes(key[0])
+            stream.writeDouble(key[1])
+            stream.writeInt64(key[2])
+            stream.writeInt32(len(colors))
+            for code, r, g, b, a, name, er, eg, eb in colors:
+                stream.writeInt32(code)
+                for v in (r, g, b, a):
+                    stream.writeDouble(v)
+                stream << QString(name)
+                for v in (er, eg, eb):
+                    stream.writeDouble(v)
+        finally:
+            fh.close()
+
+class PartDimensionCache(object):
+    """
+    Persistent cache of rendered part dimensions: (width, height, center x, center y, leftInset, bottomInset).
+    Keys are (filename, geometry hash, default rotation, default scale, extra rotation, extra scale, line thickness)
+    tuples, see AbstractPart.getDimensionKey, so a part is only measured again when its geometry or view changes.
+
+    Entries are kept in least recently used order, capped at maxEntries, and stored in partsCachePath()/dimensions.bin.
+    The file is read on first use and written back by save(), once new entries were added.  Batch workers share
+    the file, so save() merges in whatever other processes saved meanwhile, then replaces the file atomically.
+    """
+
+    enabled = True
+    maxEntries = 20000
+
+    def __init__(self):
+        self.__entries = None  # OrderedDict {key: dimensions}, least recently used first
+        self.__dirty = False
+
+    def __getCacheFilename(self):
+        return os.path.join(config.partsCachePath(), 'dimensions.bin')
+
+    def __getEntries(self):
+        if self.__entries is None:
+            self.__entries = self.__load()
+        return self.__entries
+
+    def get(self, key):
+        """ Return the cached dimensions stored under key, or None. """
+        if not self.enabled:
+            return None
+
+        entries = self.__getEntries()
+        dimensions = entries.pop(key, None)
+        if dimensions is not None:
+            entries[key] = dimensions  # Now the most recently used
+        return dimensions
+
+    def put(self, key, dimensions):
+        if not self.enabled:
+            return
+
+        entries = self.__getEntries()
+        entries.pop(key, None)
+        entries[key] = dimensions
+        while len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+        self.__dirty = True
+
+    def save(self):
+        if not self.__dirty:
+            return
+
+        # Keep entries other processes saved since this one loaded; this process' entries are the most recently used
+        entries = self.__load()
+        for key, dimensions in self.__entries.items():
+            entries.pop(key, None)
+            entries[key] = dimensions
+        while len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+        self.__entries = entries
+
+        with _atomicWrite(self.__getCacheFilename()) as stream:
+            if stream is None:
+                writeLogEntry("Could not write part dimension cache")
+                return
+
+            stream.writeInt32(MagicNumber)
+            stream.writeInt16(CacheVersion)
+            stream.writeInt32(len(self.__entries))
+            for (filename, geometryHash, rotation, scale, extraRotation, extraScale, lineThickness), dimensions in self.__entries.items():
+                stream << QString(filename)
+                stream.writeBytes(geometryHash)
+                for v in rotation + (scale,) + extraRotation + (extraScale, lineThickness):
+                    stream.writeDouble(v)
+                width, height, x, y, leftInset, bottomInset = dimensions
+                stream.writeInt32(width)
+                stream.writeInt32(height)
+                stream.writeDouble(x)
+                stream.writeDouble(y)
+                stream.writeInt32(leftInset)
+                stream.writeInt32(bottomInset)
+            self.__dirty = False
+
+    def __load(self):
+        """ Return an OrderedDict of the entries in the cache file, least recently used first; empty if it can't be read. """
+        fh = QFile(self.__getCacheFilename())
+        if not fh.exists() or not fh.open(QIODevice.ReadOnly):
+            return collections.OrderedDict()
+
+        try:
+            stream = QDataStream(fh)
+            stream.setVersion(QDataStream.Qt_4_3)
+            if stream.readInt32() != MagicNumber or stream.readInt16() != CacheVersion:
+                return collections.OrderedDict()
+
+            entries = collections.OrderedDict()
+            for unused in range(stream.readInt32()):
+                filename = _readQString(stream)
+                geometryHash = stream.readBytes()
+                values = tuple(stream.readDouble() for unused in range(9))
+                key = (filename, geometryHash, values[:3], values[3], values[4:7], values[7], values[8])
+                dimensions = (stream.readInt32(), stream.readInt32(), stream.readDouble(), stream.readDouble(),
+                              stream.readInt32(), stream.readInt32())
+                entries[key] = dimensions
+
+            if stream.status() != QDataStream.Ok:
+                return collections.OrderedDict()
+            return entries
+        finally:
+            fh.close()
+
+partCache = ParsedPartCache()
+pathIndex = LibraryPathIndex()
+colorCache = ColorTableCache()
+dimensionCache = PartDimensionCache()
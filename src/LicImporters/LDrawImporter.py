@@ -20,17 +20,27 @@
 """
 
 import code
+import itertools
 import logging
+import mmap
+import multiprocessing
 import os.path
+import re
 
 from OpenGL import GL
 
+import LDrawCache
+from LDrawCache import StepRecord, PartRecord, PrimitiveRecord, WindingRecord, InvertNextRecord, ConditionalLineRecord
 import LDrawColors
-from LicHelpers import LicColor
+from LicHelpers import LicColor, PartDictionary
 
 
 LDrawPath = None  # This will be set by the object calling this importer
 
+# Referenced library files are parsed by a pool of worker processes when at
+# least this many of them need parsing at once.  Set to 0 to always parse serially.
+parallelParseThreshold = 48
+
 def importModel(filename, instructions):
     LDrawImporter(filename, instructions)
 
@@ -48,27 +58,118 @@ class LDrawImporter(object):
         self.custompath = instructions.partImportDirectory
         self.instructions = instructions
 
+        # Pick up any parts added to or removed from the library since the last import
+        LDrawCache.pathIndex.checkForChanges()
         self.loadLDConfig(instructions)
 
-        ldrawFile = LDrawFile(filename,self.custompath)
-        
-        self.lineList = ldrawFile.lineList
-        self.submodels = ldrawFile.getSubmodels(filename)
-        if parent:
-            parent.name = ldrawFile.name
-
-        self.loadAbstractPartFromStartStop(parent, *self.submodels[self.filename])
+        self.ldrawFile = LDrawFile(filename,self.custompath)
+        try:
+            self.submodels = PartDictionary(self.ldrawFile.getSubmodels(filename))
+            if parent:
+                parent.name = self.ldrawFile.name
+
+            # {full path: LDrawCache.ParsedPart} for every library file this model references
+            self.parsedParts = {}
+            self.preParseReferencedParts()
+
+            self.loadAbstractPartFromStartStop(parent, *self.submodels[self.filename])
+        finally:
+            self.ldrawFile.close()
+
+    def getReferencedLibraryFiles(self):
+        """ Return the names of all library files referenced by the submodels reachable from the main model. """
+        filenames = []
+        visited, toVisit = set(), [self.filename]
+        while toVisit:
+            submodelName = toVisit.pop()
+            if submodelName in visited:
+                continue
+            visited.add(submodelName)
+
+            for line in self.ldrawFile.iterLines(*self.submodels[submodelName]):
+                if isFileLine(line):
+                    break
+                if isPartLine(line):
+                    filename = ' '.join(line[15:])
+                    name = self.submodels.findKey(filename)
+                    if name is None:
+                        filenames.append(filename)
+                    else:
+                        toVisit.append(name)
+        return filenames
+
+    def preParseReferencedParts(self):
+        """
+        Find every library file this model references, directly or through other library files,
+        and parse them all up front.  Files missing from the parsed part cache are parsed in parallel
+        by a pool of worker processes, so the actual import only has to wire AbstractParts together.
+        """
+        pending = self.getReferencedLibraryFiles()
+        seen = set()
+        pool = None
+
+        try:
+            while pending:
+                resolved, toParse = [], []
+                for filename in pending:
+                    if (filename.lower() in seen) or (self.submodels.findKey(filename) is not None):
+                        continue
+                    seen.add(filename.lower())
+
+                    fullPath = LDrawFile.getPartFilePath(filename ,self.custompath)
+                    if fullPath is None or fullPath in self.parsedParts:
+                        continue  # Missing files are reported by createNewPart
+
+                    parsedPart = LDrawCache.partCache.get(fullPath)
+                    if parsedPart is None:
+                        toParse.append(fullPath)
+                    else:
+                        self.parsedParts[fullPath] = parsedPart
+                    resolved.append(fullPath)
+
+                if toParse:
+                    if pool is None and 0 < parallelParseThreshold <= len(toParse):
+                        pool = self.__createParserPool()
+
+                    if pool is not None:
+                        results = pool.map(parsePartFile, toParse)
+                    else:
+                        results = [parsePartFile(fullPath) for fullPath in toParse]
+
+                    for fullPath, parsedPart in zip(toParse, results):
+                        LDrawCache.partCache.put(fullPath, parsedPart)
+                        self.parsedParts[fullPath] = parsedPart
+
+                # The next wave is every file referenced by the files just resolved
+                pending = []
+                for fullPath in resolved:
+                    pending += [r[1] for r in self.parsedParts[fullPath].records if r[0] == PartRecord]
+                pending = [fn for fn in pending if fn.lower() not in seen]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def __createParserPool(self):
+        if multiprocessing.current_process().daemon:
+            # Daemonic processes (like batch build workers) may not start children of their own
+            LDrawImporter.writeLogEntry("Running inside a daemonic process, parsing parts serially")
+            return None
+        try:
+            return multiprocessing.Pool(multiprocessing.cpu_count())
+        except (OSError, NotImplementedError, AssertionError), e:
+            LDrawImporter.writeLogEntry("Could not start part parser processes, parsing serially: %s" % e)
+            return None
 
     def createNewPartFromLine(self, line, parent):
+        return self.createNewPart(parent, *lineToPart(line))
 
-        filename, color, matrix, rgba = lineToPart(line)
-        
-        isSubmodel = False
-        for key in self.submodels.keys():
-            isSubmodel = key.lower() == filename.lower()
-            if isSubmodel:
-                filename = key
-                break
+    def createNewPart(self, parent, filename, color, matrix, rgba):
+
+        submodelName = self.submodels.findKey(filename)
+        isSubmodel = submodelName is not None
+        if isSubmodel:
+            filename = submodelName
         
         if (not isSubmodel) and (LDrawFile.getPartFilePath(filename ,self.custompath) is None):
             error_message = "Could not find Part File - ignoring: %s" % filename
@@ -88,27 +189,36 @@ class LDrawImporter(object):
         return part
     
     def loadAbstractPartFromFile(self, part, filename):
-        ldrawFile = LDrawFile(filename)
-        part.isPrimitive = ldrawFile.isPrimitive
-        part.name = ldrawFile.name
-        self.loadAbstractPartFromLineList(part, ldrawFile.lineList)
 
-    def loadAbstractPartFromStartStop(self, part, start, stop):
-        lineList = self.lineList[start + 1 : stop]  # + 1 to skip over introductory FILE line
+        # Library files almost never change between runs, so try the parsed part cache first
+        fullPath = LDrawFile.getPartFilePath(filename ,self.custompath)
+        parsedPart = self.parsedParts.get(fullPath) or LDrawCache.partCache.get(fullPath)
+
+        if parsedPart is None:
+            parsedPart = parsePartFile(fullPath)
+            LDrawCache.partCache.put(fullPath, parsedPart)
+
+        part.isPrimitive = parsedPart.isPrimitive
+        part.name = parsedPart.name
+        self.loadAbstractPartFromRecords(part, parsedPart.records)
+
+    def loadAbstractPartFromStartStop(self, part, start, stop, firstLineNumber=1):
+        lineList = self.ldrawFile.iterLines(start, stop, firstLineNumber)  # Skips over introductory FILE line
         self.loadAbstractPartFromLineList(part, lineList)
     
     def loadAbstractPartFromLineList(self, parentPart, lineList):
+        self.loadAbstractPartFromRecords(parentPart, iterLineRecords(lineList))
+
+    def loadAbstractPartFromRecords(self, parentPart, records):
     
-        for line in lineList:
-    
-            if isFileLine(line):  # A FILE line means we're finished loading this part
-                return
+        for record in records:
+            recordType = record[0]
     
-            elif isStepLine(line):
+            if recordType == StepRecord:
                 self.instructions.addBlankPage(parentPart)
 
-            elif isPartLine(line):
-                newPart = self.createNewPartFromLine(line, parentPart)
+            elif recordType == PartRecord:
+                newPart = self.createNewPart(parentPart, *record[1:])
                 if newPart is not None:
                     if parentPart:
                         newPart.setInversion(parentPart.invertNext)
@@ -116,16 +226,17 @@ class LDrawImporter(object):
                         parentPart.invertNext = False
                     self.instructions.addPart(newPart, parentPart)
     
-            elif isPrimitiveLine(line):
-                shape, color, points = lineToPrimitive(line)
-                self.instructions.addPrimitive(shape, color, points, parentPart)
+            elif recordType == PrimitiveRecord:
+                self.instructions.addPrimitive(record[1], record[2], record[3], parentPart)
+
+            elif recordType == ConditionalLineRecord:
+                self.instructions.addConditionalLine(record[1], record[2], parentPart)
                 
-            elif parentPart and isBFCLine(line):
-                if line[3] == 'CERTIFY':
-                    isCW = (len(line) == 5 and line[4] == 'CW')
-                    parentPart.winding = GL.GL_CW if isCW else GL.GL_CCW
-                elif line [3] == 'INVERTNEXT':
-                    parentPart.invertNext = True
+            elif parentPart and recordType == WindingRecord:
+                parentPart.winding = record[1]
+
+            elif parentPart and recordType == InvertNextRecord:
+                parentPart.invertNext = True
 
     def configureBlackPartColor(self, filename, part, invertNext):
         fn, pn = filename.lower(), part.filename
@@ -144,24 +255,40 @@ class LDrawImporter(object):
 
     @staticmethod
     def loadLDConfig(instructions):
-        ldConfigFile = file(os.path.join(LDrawPath, 'LDConfig.ldr'))
-        
-        for l in ldConfigFile:
-            if l.startswith('0 !COLOUR'):
-                l = l.split()
-                code = int(l[4])
-                rgb = l[6].replace('#', '')
-                r, g, b = [float(i) / 256 for i in [int(rgb[0:2], 16), int(rgb[2:4], 16), int(rgb[4:6], 16)]]
-                rgb = l[8].replace('#', '')
-                er, eg, eb = [float(i) / 256 for i in [int(rgb[0:2], 16), int(rgb[2:4], 16), int(rgb[4:6], 16)]]
-                a = float(l[10]) / 256 if (len(l) > 10 and l[9] == 'ALPHA') else 1.0
-                name = l[2].replace('_', ' ')
-                instructions.addColor(code, r, g, b, a, name, er, eg, eb)
-                if not LDrawColors.colors.has_key(code):
-                    LDrawColors.colors[ code ] = (r, g, b, a, name)
+        ldConfigPath = os.path.join(LDrawPath, 'LDConfig.ldr')
+
+        colors = LDrawCache.colorCache.get(ldConfigPath)
+        if colors is None:
+            colors = parseLDConfig(ldConfigPath)
+            LDrawCache.colorCache.put(ldConfigPath, colors)
+
+        instructions.addColors(colors)
+        for code, r, g, b, a, name, unused, unused, unused in colors:
+            if code not in LDrawColors.colors:
+                LDrawColors.colors[ code ] = (r, g, b, a, name)
                     
         instructions.addColor(16, None)  # Set special 'CurrentColor' to None
 
+def parseLDConfig(filename):
+    """ Parse every colour in an LDConfig.ldr file into a list of (code, r, g, b, a, name, er, eg, eb) tuples. """
+    colors = []
+    ldConfigFile = file(filename)
+    
+    for l in ldConfigFile:
+        if l.startswith('0 !COLOUR'):
+            l = l.split()
+            code = int(l[4])
+            rgb = l[6].replace('#', '')
+            r, g, b = [float(i) / 256 for i in [int(rgb[0:2], 16), int(rgb[2:4], 16), int(rgb[4:6], 16)]]
+            rgb = l[8].replace('#', '')
+            er, eg, eb = [float(i) / 256 for i in [int(rgb[0:2], 16), int(rgb[2:4], 16), int(rgb[4:6], 16)]]
+            a = float(l[10]) / 256 if (len(l) > 10 and l[9] == 'ALPHA') else 1.0
+            name = l[2].replace('_', ' ')
+            colors.append((code, r, g, b, a, name, er, eg, eb))
+
+    ldConfigFile.close()
+    return colors
+
 Comment = '0'
 PartCommand = '1'
 LineCommand = '2'
@@ -216,6 +343,57 @@ def lineToPart(line):
     matrix = LDToGLMatrix(line[3:15])
     return (filename, color, matrix, rgba)
 
+def iterLineRecords(lineList):
+    """
+    Convert tokenized LDraw lines into plain, picklable records, one at a time.
+    Stops at the first FILE line, since that means we're finished loading this part.
+    
+    Yields tuples, each starting with one of the LDrawCache record types:
+        (StepRecord,)
+        (PartRecord, filename, color, matrix, rgba)
+        (PrimitiveRecord, shape, color, points)
+        (ConditionalLineRecord, color, points)
+        (WindingRecord, winding)
+        (InvertNextRecord,)
+    """
+    for line in lineList:
+
+        if isFileLine(line):
+            break
+
+        elif isStepLine(line):
+            yield (StepRecord,)
+
+        elif isPartLine(line):
+            yield (PartRecord,) + lineToPart(line)
+
+        elif isPrimitiveLine(line):
+            shape, color, points = lineToPrimitive(line)
+            yield (PrimitiveRecord, int(shape), color, points)
+
+        elif isConditionalLine(line):
+            yield (ConditionalLineRecord,) + lineToConditionalLine(line)
+
+        elif isBFCLine(line):
+            if line[3] == 'CERTIFY':
+                isCW = (len(line) == 5 and line[4] == 'CW')
+                yield (WindingRecord, int(GL.GL_CW if isCW else GL.GL_CCW))
+            elif line[3] == 'INVERTNEXT':
+                yield (InvertNextRecord,)
+
+def lineListToRecords(lineList):
+    """ Convert a list of tokenized LDraw lines into a list of records.  See iterLineRecords. """
+    return list(iterLineRecords(lineList))
+
+def parsePartFile(fullPath):
+    """
+    Read and parse one LDraw library file into an LDrawCache.ParsedPart.
+    This is the unit of work handed to the pre-parse worker processes, so it relies
+    on nothing but its argument and returns only plain, picklable data.
+    """
+    lineList = LDrawFile.readLineList(fullPath)
+    return LDrawCache.ParsedPart(LDrawFile.lineListName(lineList), LDrawFile.isPrimitivePath(fullPath), lineListToRecords(lineList))
+
 def createSubmodelLines(filename):
     filename = os.path.basename(filename)
     return [' '.join([Comment, FileCommand, filename]) + lineTerm]
@@ -255,11 +433,9 @@ def isConditionalLine(line):
     return (len(line) == 15) and (line[1] == ConditionalLineCommand)
 
 def lineToConditionalLine(line):
-    d = {}
-    d['color'] = float(line[2])
-    d['points'] = [float(x) for x in line[3:9]]
-    d['control points'] = [float(x) for x in line[9:]]
-    return d
+    color = int(line[2] , base=0)
+    points = [float(x) for x in line[3:]]  # 2 end points, then 2 control points
+    return (color, points)
 
 def isFileLine(line):
     return (len(line) > 2) and (line[1] == Comment) and (line[2] == FileCommand)
@@ -271,6 +447,15 @@ def createStepLine():
     return ' '.join([Comment, StepCommand]) + lineTerm
 
 class LDrawFile(object):
+    """
+    Read-only view of an LDraw model file.  The file is memory mapped rather than read into memory,
+    and only the byte offsets of its 0 FILE boundaries are recorded up front.  The lines of a submodel
+    are tokenized lazily, and only when that submodel is actually iterated (see iterLines), so huge
+    MPD files cost little more than the submodels the main model reaches.
+    """
+
+    # Matches an entire '0 FILE <name>' line, capturing the name
+    fileLineRE = re.compile(r'^[ \t]*0[ \t]+FILE[ \t]+([^\r\n]*)', re.MULTILINE)
 
     def __init__(self, filename, custompath=""):
         """
@@ -286,12 +471,33 @@ class LDrawFile(object):
         self.custompath = custompath  # custom additional lookup path  
         self.isPrimitive = False  # Anything in the 'P' or 'Parts\S' directories
         
-        self.lineList = []
-        self.readFileToLineList()  # Read the file from disk, and copy it to the line list
+        self.__file = None
+        self.__data = ''  # Memory mapped file content
+        self.openFile()
+
+    @property
+    def lineList(self):
+        """ The entire file as a list of tokenized lines, each prefixed with its line number. """
+        return list(self.iterLines(0, len(self.__data), skipFirstLine=False))
 
     @staticmethod
     def getPartFilePath(filename,custompath=""):
 
+        # Lookup paths, in order of precedence
+        rootList = [custompath] if custompath else []
+        rootList += [os.path.join(LDrawPath, 'MODELS')
+                    ,os.path.join(LDrawPath, 'UNOFFICIAL', 'PARTS')
+                    ,os.path.join(LDrawPath, 'UNOFFICIAL', 'P')
+                    ,os.path.join(LDrawPath, 'PARTS')
+                    ,os.path.join(LDrawPath, 'P')]
+
+        if LDrawCache.pathIndex.enabled:
+            path = LDrawCache.pathIndex.lookup(filename, rootList)
+            if path:
+                return path
+            # Not in the library - could still be a full path to a model file
+            return filename if os.path.isfile(filename) else None
+
         # Change hardcoded path separators in some LDraw lines to platform specific separator
         if (filename[:2] == 's\\'):
             filename = os.path.join('s', filename[2:])
@@ -299,59 +505,95 @@ class LDrawFile(object):
             filename = os.path.join('48', filename[3:])
 
         # Build list of possible lookup paths
-        pathList = [filename
-                    ,os.path.join(custompath, filename)
-                    ,os.path.join(LDrawPath, 'MODELS', filename)
-                    ,os.path.join(LDrawPath, 'UNOFFICIAL', 'PARTS', filename)
-                    ,os.path.join(LDrawPath, 'UNOFFICIAL', 'P', filename)
-                    ,os.path.join(LDrawPath, 'PARTS', filename)
-                    ,os.path.join(LDrawPath, 'P', filename)]
+        pathList = [filename] + [os.path.join(root, filename) for root in rootList]
 
         for p in pathList:
             if os.path.isfile(p):
                 return p
         return None
     
-    def readFileToLineList(self):
+    @staticmethod
+    def isPrimitivePath(fullPath):
+        # Anything in the 'P' or 'Parts\S' directories is an LDraw primitive
+        sep = os.path.sep
+        return (sep + 's' + sep in fullPath) or (sep + 'P' + sep in fullPath)
+
+    @staticmethod
+    def readLineList(fullPath):
+        # Copy the file into an internal array, for easier access
+        lineList = []
+        f = file(fullPath)
+        i = 1
+        for l in f:
+            lineList.append([i] + l.split())
+            i += 1
+        f.close()
+        return lineList
+
+    @staticmethod
+    def lineListName(lineList):
+        if lineList:
+            return ' '.join(lineList[0][2:]).decode("utf8" , "replace")
+        return ' '
+
+    def openFile(self):
         # Check if part is in LDraw library locations or in custom location
         fullPath = LDrawFile.getPartFilePath(self.filename ,self.custompath)
         
         if fullPath:
-        # Check if this part is an LDraw primitive
-            sep = os.path.sep
-            if (sep + 's' + sep in fullPath) or (sep + 'P' + sep in fullPath):
-                self.isPrimitive = True
-
-        # Copy the file into an internal array, for easier access
-            f = file(fullPath)
-            i = 1
-            for l in f:
-                self.lineList.append([i] + l.split())
-                i += 1
-            f.close()
-        
-            if self.lineList:
-                self.name = ' '.join(self.lineList[0][2:]).decode("utf8" , "replace")
-            else:
-                self.name = ' '
+            self.isPrimitive = LDrawFile.isPrimitivePath(fullPath)
+            self.__file = open(fullPath, 'rb')
+            if os.fstat(self.__file.fileno()).st_size > 0:  # Can't map an empty file
+                self.__data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.name = LDrawFile.lineListName(list(itertools.islice(self.iterLines(0, len(self.__data), skipFirstLine=False), 1)))
         else:
             error_message = "Could not check correctly Model File: %s" % self.filename
             LDrawImporter.writeLogEntry(error_message)
             print error_message
             return None            
 
+    def close(self):
+        if isinstance(self.__data, mmap.mmap):
+            self.__data.close()
+        self.__data = ''
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+    def iterLines(self, start, stop, firstLineNumber=1, skipFirstLine=True):
+        """
+        Generate the tokenized lines between the start and stop byte offsets, each prefixed with its line
+        number in the file, firstLineNumber being the number of the line at start (see getSubmodels).
+        By default the first line, which introduces a submodel, is skipped.
+        """
+        data = self.__data
+        pos, lineNumber = start, firstLineNumber
+        while pos < stop:
+            end = data.find('\n', pos, stop)
+            if end < 0:
+                end = stop
+            if pos > start or not skipFirstLine:
+                yield [lineNumber] + data[pos:end].split()
+            pos, lineNumber = end + 1, lineNumber + 1
+
     def getSubmodels(self, filename):
-        # Loop through the file array searching for sub model FILE declarations
-        submodels = [(filename, 0)]
-        for i, l in enumerate(self.lineList[1:]):
-            if isFileLine(l):
-                submodels.append((' '.join(l[3:]), i + 1))  # + 1 because we start at line 1 not 0
+        # Search the file for sub model FILE declarations, skipping the very first line.  Count the lines
+        # between declarations as we go, so each submodel's lines can be numbered from the top of the file
+        data = self.__data
+        firstLineEnd = data.find('\n')
+        submodels = [(filename, 0, 1)]
+        if firstLineEnd >= 0:
+            pos, lineNumber = 0, 1
+            for match in self.fileLineRE.finditer(data, firstLineEnd + 1):
+                lineNumber += data.count('\n', pos, match.start())
+                pos = match.start()
+                submodels.append((' '.join(match.group(1).split()), match.start(), lineNumber))
         
-        # Fixup submodel list by calculating the ending line number from the file
+        # Fixup submodel list by calculating the ending offset from the next submodel's start
         for i in range(0, len(submodels) - 1):
-            submodels[i] = (submodels[i][0], [submodels[i][1], submodels[i + 1][1]])
+            submodels[i] = (submodels[i][0], [submodels[i][1], submodels[i + 1][1], submodels[i][2]])
         
-        # Last submodel is special case: its ending line is end of file array
-        submodels[-1] = (submodels[-1][0], [submodels[-1][1], len(self.lineList)])
+        # Last submodel is special case: it ends at the end of the file
+        submodels[-1] = (submodels[-1][0], [submodels[-1][1], len(data), submodels[-1][2]])
         
-        return dict(submodels)  # {filename: (start index, stop index)}
+        return dict(submodels)  # {filename: (start offset, stop offset, line number at start)}
@@ -19,16 +19,20 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import logging
 import sys
 
 from PyQt4.QtCore import *
 
 from LicCustomPages import *
+from LicImporters import LDrawCache
 from LicModel import *
+import LicProfiler
 
 
 class Instructions(QObject):
     itemClassName = "Instructions"
+    instanceThreshold = 16  # Sub parts used this often stay instanced when flattening library parts
 
     def __init__(self, parent, scene, glWidget):
         QObject.__init__(self, parent)
@@ -38,9 +42,11 @@ class Instructions(QObject):
         # Dict of all valid LicColor instances for this particular model, indexed by LDraw color code
         self.colorDict = LicHelpers.LicColorDict()  
         # x = AbstractPart("3005.dat"); partDictionary[x.filename] == x
-        self.partDictionary = {}    
+        self.partDictionary = LicHelpers.PartDictionary()
         # custom Directory from which we import parts
         self.partImportDirectory = "."  
+        # Times and counts each phase of the current import; disabled unless config.writeImportProfile is set
+        self.profiler = LicProfiler.ImportProfiler(None)
 
         self.glContext = glWidget
         self.glContext.makeCurrent()
@@ -65,10 +71,15 @@ class Instructions(QObject):
 
         # Remove everything from the graphics scene
         if self.mainModel:
+            self.glContext.makeCurrent()
+            for csi in self.mainModel.getCSIList():
+                csi.deleteGLDisplayLists()
+            CSI.deleteCumulativeGLDisplayLists()
             self.mainModel.deleteAllPages(self.scene)
 
         self.mainModel = None
-        self.partDictionary = {}
+        self.partDictionary = LicHelpers.PartDictionary()
+        LicGeometry.resetTransformTable()
         Page.PageSize = Page.defaultPageSize
         Page.Resolution = Page.defaultResolution
         CSI.defaultScale = PLI.defaultScale = SubmodelPreview.defaultScale = 1.0
@@ -78,52 +89,84 @@ class Instructions(QObject):
         SubmodelPreview.defaultRotation = [20.0, 45.0, 0.0]
         LicGLHelpers.resetLightParameters()
         self.glContext.makeCurrent()
+        LicGLHelpers.renderTargets.evict()
 
     def importModel(self, filename):
 
+        profiler = self.profiler = LicProfiler.ImportProfiler(filename, config.writeImportProfile, config.writeImportCProfile)
+
         # Create and fill with data main model instance
-        self.mainModel = Mainmodel(self, self, filename)
-        self.mainModel.appendBlankPage()
-        self.mainModel.importModel()
+        with profiler.phase("parse"):
+            self.mainModel = Mainmodel(self, self, filename)
+            self.mainModel.appendBlankPage()
+            self.mainModel.importModel()
+        self.countImportedObjects("parse")
 
         # Initializing Pages and Steps
-        self.mainModel.syncPageNumbers()
-        self.mainModel.addInitialPagesAndSteps()
+        with profiler.phase("addInitialPagesAndSteps"):
+            self.mainModel.syncPageNumbers()
+            self.mainModel.addInitialPagesAndSteps()
                     
         submodelCount = self.mainModel.submodelCount()
         pageList = self.mainModel.getPageList()
         pageList.sort(key=lambda x: x._number)
         totalCount = len(self.partDictionary) + len(self.mainModel.getCSIList()) + submodelCount  # Rough count only
+        self.countImportedObjects("addInitialPagesAndSteps")
 
         yield totalCount  # Special first value is maximum number of progression steps in load process
         
+        if config.flattenLibraryParts:
+            yield "Flattening library parts"
+            with profiler.phase("flattenLibraryParts"):
+                self.flattenLibraryParts()
+
         yield "Initializing GL display lists"
-        for label in self.initGLDisplayLists():  # generate all part GL display lists on the general glWidget
+        for label in profiler.timeGenerator("initGLDisplayLists", self.initGLDisplayLists()):  # generate all part GL display lists on the general glWidget
             yield label
 
-        for label in self.initPartDimensions():  # Calculate width and height of each abstractPart in the part dictionary
+        for label in profiler.timeGenerator("initPartDimensions", self.initPartDimensions()):  # Calculate width and height of each abstractPart in the part dictionary
             yield label
 
         yield "Initializing CSI Dimensions"
-        for label in self.initCSIDimensions():  # Calculate width and height of each CSI in this instruction book
+        for label in profiler.timeGenerator("initCSIDimensions", self.initCSIDimensions()):  # Calculate width and height of each CSI in this instruction book
             yield label
 
         yield "Initializing Submodel Images"
-        self.mainModel.addSubmodelImages()
+        with profiler.phase("addSubmodelImages"):
+            self.mainModel.addSubmodelImages()
                 
         yield "Laying out Pages"
-        for page in pageList:
-            page.initLayout()
+        with profiler.phase("initLayout"):
+            for page in pageList:
+                page.initLayout()
 
         yield "Reconfiguring Page Layouts"
-        self.mainModel.mergeInitialPages()
-        self.mainModel.reOrderSubmodelPages()
-        self.mainModel.syncPageNumbers()
+        with profiler.phase("mergeInitialPages"):
+            self.mainModel.mergeInitialPages()
+        with profiler.phase("reOrderSubmodelPages"):
+            self.mainModel.reOrderSubmodelPages()
+            self.mainModel.syncPageNumbers()
 
         for page in pageList:
-            for label in page.adjustSubmodelImages():
+            for label in profiler.timeGenerator("adjustSubmodelImages", page.adjustSubmodelImages()):
                 yield label
-            page.resetPageNumberPosition()
+            with profiler.phase("resetPageNumberPosition"):
+                page.resetPageNumberPosition()
+
+        self.countImportedObjects("finished")
+        profiler.writeReport()
+
+    def countImportedObjects(self, phase):
+        if not self.profiler.enabled:
+            return
+        partDictionary = self.partDictionary.values()
+        self.profiler.count(phase,
+                            abstractParts=len(partDictionary),
+                            primitives=sum([len(part.primitives) for part in partDictionary]),
+                            parts=len(self.mainModel.getFullPartList()),
+                            csis=len(self.mainModel.getCSIList()),
+                            pages=self.mainModel.pageCount(),
+                            submodels=self.mainModel.submodelCount())
 
     def getQuantitativeSizeMeasure(self):  # Get some arbitrary measure of how big / complex this file is (useful for progress bars)
         count = len(self.partDictionary)
@@ -170,11 +213,53 @@ class Instructions(QObject):
             csi.createGLDisplayList()
             i += 1
 
+    def flattenLibraryParts(self):
+        """
+        Bake the sub parts of every library part used by the model into that part's own geometry (see AbstractPart.flatten).
+        Sub parts used at least instanceThreshold times across all those parts, like studs, are kept as instanced child
+        Parts, so each brick draws its own geometry in a handful of calls plus one display list call per stud.
+        """
+        partList = [part for part in self.partDictionary.values() if not part.isPrimitive and not part.isSubmodel]
+
+        useCounts = {}
+        def countUses(abstractPart):
+            for part in abstractPart.parts:
+                useCounts[part.abstractPart.filename] = useCounts.get(part.abstractPart.filename, 0) + 1
+                countUses(part.abstractPart)
+        for part in partList:
+            countUses(part)
+        instanced = set(name for name, count in useCounts.items() if count >= self.instanceThreshold)
+
+        before = self.__drawStats(partList)
+        for part in partList:
+            part.flatten(instanced)
+        after = self.__drawStats(partList)
+
+        self.profiler.count("flattenLibraryParts", parts=len(partList), instancedPrimitives=len(instanced),
+                            verticesBefore=before[0], drawCallsBefore=before[1], matrixChangesBefore=before[2],
+                            verticesAfter=after[0], drawCallsAfter=after[1], matrixChangesAfter=after[2])
+        logging.info("Flattened %d library parts: %d vertices, %d draw calls, %d matrix changes before; %d, %d, %d after"
+                     % ((len(partList),) + before + after))
+
+    @staticmethod
+    def __drawStats(partList):
+        stats = {}
+        totals = [0, 0, 0]
+        for part in partList:
+            for i, value in enumerate(part.getDrawStats(stats)):
+                totals[i] += value
+        return tuple(totals)
+
     def getPartDimensionListAndCount(self, reset=False):
         if reset:
             partList = [part for part in self.partDictionary.values() if (not part.isPrimitive)]
         else:
             partList = [part for part in self.partDictionary.values() if (not part.isPrimitive) and (part.width == part.height == -1)]
+
+        # Parts already measured in an earlier session, at the same rotation and scale, need no rendering at all
+        count = len(partList)
+        partList = [part for part in partList if not part.initSizeFromCache()]
+        self.profiler.increment("partDimensionCacheHits", count - len(partList))
         partList.append(self.mainModel)
 
         partDivCount = 25
@@ -193,33 +278,64 @@ class Instructions(QObject):
         if not partList:
             return  # If there's no parts to initialize, we're done here
 
-        partList2 = []
         # Frame buffer sizes to try - could make configurable by user, if they've got lots of big submodels
         sizes = [128, 256, 512, 1024, 2048] 
 
-        for size in sizes:
+        # Each part starts at the size predicted from its geometry, so nearly every part renders just once
+        pending = self.__predictBufferSizes(partList, sizes)
 
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), self.glContext)
-            pBuffer.makeCurrent()
+        for i, size in enumerate(sizes):
+            if not pending[i]:
+                continue
 
-            # Render each image and calculate their sizes
-            for abstractPart in partList:
+            # Small parts are tiled many at a time into one atlas buffer, read back once
+            bufferSize = LicGLHelpers.atlasSize if LicGLHelpers.atlasSize >= size * 4 else size
 
-                if abstractPart.initSize(size, pBuffer):  # Draw image and calculate its size:                    
-                    currentPartCount += 1
-                    if not currentPartCount % partDivCount:
-                        currentPartCount = 0
-                        currentCount += 1
-                        yield "Initializing Part Dimensions (%d/%d)" % (currentCount, partStepCount)
-                else:
-                    partList2.append(abstractPart)
-
-            if len(partList2) < 1:
-                break  # All images initialized successfully
-            else:
-                partList = partList2  # Some images rendered out of frame - loop and try bigger frame
-                partList2 = []
+            # Borrow a pooled buffer tied to the existing GLWidget, to get access to its display lists
+            with LicGLHelpers.renderTargets.pixelBuffer(bufferSize, self.glContext) as pBuffer:
+                pBuffer.makeCurrent()
+
+                # Render each image and calculate their sizes
+                for abstractPart, initialized in self.__initPartSizes(pending[i], size, bufferSize, pBuffer):
+
+                    if initialized:  # Drew image and calculated its size
+                        currentPartCount += 1
+                        if not currentPartCount % partDivCount:
+                            currentPartCount = 0
+                            currentCount += 1
+                            yield "Initializing Part Dimensions (%d/%d)" % (currentCount, partStepCount)
+                    elif i + 1 < len(sizes):
+                        pending[i + 1].append(abstractPart)  # Rendered out of frame - try a bigger frame
+                        self.profiler.increment("bufferRetries")
+
+        LDrawCache.dimensionCache.save()
+
+    def __initPartSizes(self, partList, size, bufferSize, pBuffer):
+        """
+        Yield (AbstractPart, True if initialized) for each part in partList, dimensioned as if drawn in a size buffer.
+        When the current bufferSize buffer is bigger than size, parts are tiled into it and read back together.
+        """
+        if bufferSize == size:
+            for abstractPart in partList:
+                yield abstractPart, abstractPart.initSize(size, pBuffer)
+            return
+
+        tileCount = (bufferSize / size) ** 2
+        for start in range(0, len(partList), tileCount):
+            batch = partList[start:start + tileCount]
+            results = LicGLHelpers.initImgSizeAtlas(bufferSize, size, [p.getRenderParameters() for p in batch])
+            self.profiler.increment("atlasReadbacks")
+            for abstractPart, params in zip(batch, results):
+                yield abstractPart, abstractPart.setSize(params)
+
+    def __predictBufferSizes(self, items, sizes):
+        """ Sort AbstractParts or CSIs into one list per buffer size in sizes, by the size each is predicted to need. """
+        pending = [[] for unused in sizes]
+        for item in items:
+            index = item.predictBufferSize(sizes)
+            pending[index].append(item)
+            self.profiler.increment("bufferRetriesAvoided", index)
+        return pending
 
     def setAllCSIDirty(self):
         csiList = self.mainModel.getCSIList()
@@ -250,35 +366,47 @@ class Instructions(QObject):
         # if they've got lots of big submodels or steps
         sizes = [512, 1024, 2048] 
 
-        for size in sizes:
-
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), self.glContext)
-
-            # Render each CSI and calculate its size
-            for csi in csiList:
-                pBuffer.makeCurrent()
-                oldRect = csi.rect()
-                result = csi.initSize(size, pBuffer)
-                if result:
-                    yield result
-                    if repositionCSI:
-                        newRect = csi.rect()
-                        dx = oldRect.width() - newRect.width()
-                        dy = oldRect.height() - newRect.height()
-                        csi.moveBy(dx / 2.0, dy / 2.0)
-                else:
-                    csiList2.append(csi)
-
-            if len(csiList2) < 1:
-                break  # All images initialized successfully
+        # Most CSIs can be sized from their geometry alone; only the rest need a frame buffer
+        for csi in csiList:
+            oldRect = csi.rect()
+            result = csi.initSizeFromGeometry()
+            if result:
+                yield result
+                if repositionCSI:
+                    self.__repositionCSI(csi, oldRect)
             else:
-                # Some images rendered out of frame - loop and try bigger frame
-                csiList = csiList2  
-                csiList2 = []
+                csiList2.append(csi)
+        pending = self.__predictBufferSizes(csiList2, sizes)
+
+        for i, size in enumerate(sizes):
+            if not pending[i]:
+                continue
+
+            # Borrow a pooled buffer tied to the existing GLWidget, to get access to its display lists
+            with LicGLHelpers.renderTargets.pixelBuffer(size, self.glContext) as pBuffer:
+
+                # Render each CSI and calculate its size
+                for csi in pending[i]:
+                    pBuffer.makeCurrent()
+                    oldRect = csi.rect()
+                    result = csi.initSize(size, pBuffer)
+                    if result:
+                        yield result
+                        if repositionCSI:
+                            self.__repositionCSI(csi, oldRect)
+                    elif i + 1 < len(sizes):
+                        pending[i + 1].append(csi)  # Rendered out of frame - try a bigger frame
+                        self.profiler.increment("bufferRetries")
 
         self.glContext.makeCurrent()
 
+    @staticmethod
+    def __repositionCSI(csi, oldRect):
+        newRect = csi.rect()
+        dx = oldRect.width() - newRect.width()
+        dy = oldRect.height() - newRect.height()
+        csi.moveBy(dx / 2.0, dy / 2.0)
+
     def exportToPOV(self):
         self.mainModel.createPng()
         self.mainModel.exportImagesToPov()
@@ -296,7 +424,6 @@ class Instructions(QObject):
         yield len(pageList)  # Special first value is number of steps in export process
 
         currentPageNumber = self.scene.currentPage._number  # Store this so we can restore selection later
-        bufferManager = None
 
         if scaleFactor > 1.0:  # Make part lines a bit thicker for higher res output
             lineWidth = LicGLHelpers.getLightParameters()[2]
@@ -304,52 +431,50 @@ class Instructions(QObject):
 
         try:
             w, h = int(Page.PageSize.width() * scaleFactor), int(Page.PageSize.height() * scaleFactor)
-            bufferManager = LicGLHelpers.FrameBufferManager(w, h)
+            with LicGLHelpers.renderTargets.frameBuffer(w, h) as bufferManager:
 
-            # Render & save each page as an image
-            for page in pageList:
+                # Render & save each page as an image
+                for page in pageList:
 
-                page.lockIcon.hide()
-                exportedFilename = page.getGLImageFilename()
+                    page.lockIcon.hide()
+                    exportedFilename = page.getGLImageFilename()
 
-                bufferManager.bindMSFB()
-                LicGLHelpers.initFreshContext(True)
+                    bufferManager.bindMSFB()
+                    LicGLHelpers.initFreshContext(True)
 
-                page.drawGLItemsOffscreen(QRectF(0, 0, w, h), scaleFactor)
-                bufferManager.blitMSFB()
-                data = bufferManager.readFB()
+                    page.drawGLItemsOffscreen(QRectF(0, 0, w, h), scaleFactor)
+                    bufferManager.blitMSFB()
+                    data = bufferManager.readFB()
 
-                # Create an image from raw pixels and save to disk - would be nice to create QImage directly here
-                image = Image.frombytes("RGBA", (w, h), data)
-                image = image.transpose(Image.FLIP_TOP_BOTTOM)
-                image.save(exportedFilename)
+                    # Create an image from raw pixels and save to disk - would be nice to create QImage directly here
+                    image = Image.frombytes("RGBA", (w, h), data)
+                    image = image.transpose(Image.FLIP_TOP_BOTTOM)
+                    image.save(exportedFilename)
 
-                # Create new blank image
-                image = QImage(w, h, QImage.Format_ARGB32)
-                painter = QPainter()
-                painter.begin(image)
+                    # Create new blank image
+                    image = QImage(w, h, QImage.Format_ARGB32)
+                    painter = QPainter()
+                    painter.begin(image)
 
-                self.scene.selectPage(page._number)
-                self.scene.renderMode = 'background'
-                self.scene.render(painter, QRectF(0, 0, w, h))
+                    self.scene.selectPage(page._number)
+                    self.scene.renderMode = 'background'
+                    self.scene.render(painter, QRectF(0, 0, w, h))
 
-                glImage = QImage(exportedFilename)
-                painter.drawImage(QPoint(0, 0), glImage)
+                    glImage = QImage(exportedFilename)
+                    painter.drawImage(QPoint(0, 0), glImage)
 
-                self.scene.selectPage(page._number)
-                self.scene.renderMode = 'foreground'
-                self.scene.render(painter, QRectF(0, 0, w, h))
+                    self.scene.selectPage(page._number)
+                    self.scene.renderMode = 'foreground'
+                    self.scene.render(painter, QRectF(0, 0, w, h))
     
-                painter.end()
-                newName = page.getExportFilename()
-                image.save(newName)
+                    painter.end()
+                    newName = page.getExportFilename()
+                    image.save(newName)
 
-                yield newName
-                page.lockIcon.show()    
+                    yield newName
+                    page.lockIcon.show()    
 
         finally:
-            if bufferManager is not None:
-                bufferManager.cleanup()
             self.scene.renderMode = 'full'
             self.scene.setPagesToDisplay(pagesToDisplay)
             self.scene.selectPage(currentPageNumber)
@@ -423,13 +548,7 @@ class InstructionsProxy(object):
             color = self.__instructions.colorDict[colorCode]
             
         part = Part(fn, color, matrix, invert)
-
-        if fn in partDictionary:
-            part.abstractPart = partDictionary[fn]
-        elif fn.upper() in partDictionary:
-            part.abstractPart = partDictionary[fn.upper()]
-        elif fn.lower() in partDictionary:
-            part.abstractPart = partDictionary[fn.lower()]
+        part.abstractPart = partDictionary.find(fn)
         return part
 
     def createAbstractPart(self, fn):
@@ -451,6 +570,10 @@ class InstructionsProxy(object):
         cd = self.__instructions.colorDict
         cd[colorCode] = None if r is None else LicColor(r, g, b, a, name, colorCode, er, eg, eb)
 
+    def addColors(self, colors):
+        """ Add a whole colour table at once: colors is a list of (code, r, g, b, a, name, er, eg, eb) tuples. """
+        self.__instructions.colorDict.update([(c[0], LicColor(c[1], c[2], c[3], c[4], c[5], c[0], c[6], c[7], c[8])) for c in colors])
+
     def addPart(self, part, parent=None):
         if parent is None:
             parent = self.__instructions.mainModel
@@ -458,6 +581,7 @@ class InstructionsProxy(object):
         parent.parts.append(part)
 
         if parent.isSubmodel:
+            parent.partsChanged()
             parent.pages[-1].steps[-1].addPart(part)
 
             if part.abstractPart.isSubmodel and not part.abstractPart.used:
@@ -472,8 +596,13 @@ class InstructionsProxy(object):
         if parent is None:
             parent = self.__instructions.mainModel
         color = self.__instructions.colorDict[colorCode]
-        primitive = Primitive(color, points, shape, parent.winding)
-        parent.primitives.append(primitive)
+        parent.primitives.add(color, points, shape, parent.winding)
+
+    def addConditionalLine(self, colorCode, points, parent=None):
+        if parent is None:
+            parent = self.__instructions.mainModel
+        color = self.__instructions.colorDict[colorCode]
+        parent.primitives.addConditionalLine(color, points)
 
     def addBlankPage(self, parent):
         if parent is None:
@@ -20,8 +20,10 @@
 """
 
 import collections
+import hashlib
 import os  # for output path creation
 
+import numpy
 import OpenGL
 
 from OpenGL.GL import *
@@ -32,6 +34,9 @@ from PyQt4.QtGui import *
 from PyQt4.QtOpenGL import *
 
 import LicDialogs
+import LicGeometry
+from LicGeometry import PrimitiveStore
+from LicImporters import LDrawCache
 from LicImporters import LDrawImporter
 import LicImporters
 import LicL3PWrapper
@@ -50,7 +55,7 @@ import config  # for modelCachePath
 # OpenGL.ERROR_CHECKING = False
 # OpenGL.ERROR_LOGGING = False
 MagicNumber = 0x14768126
-FileVersion = 18
+FileVersion = 19
 
 NoFlags = QGraphicsItem.GraphicsItemFlags()
 NoMoveFlags = QGraphicsItem.ItemIsSelectable | QGraphicsItem.ItemIsFocusable
@@ -299,6 +304,8 @@ class Callout(CalloutTreeManager, GraphicsRoundRectItem):
         self.syncStepNumbers()
 
     def removeStep(self, step):
+        self.getPage().instructions.glContext.makeCurrent()
+        step.csi.deleteGLDisplayLists()
         self.scene().removeItem(step)
         self.steps.remove(step)
         self.syncStepNumbers()
@@ -750,6 +757,8 @@ class Step(StepTreeManager, QGraphicsRectItem):
         self.setFlags(AllFlags)
         
     def _setNumber(self, number):
+        if number != self._number:
+            CSI._staleCSIs.add(self.csi)  # Cumulative display lists are laid out by step number
         self._number = number
         if self.numberItem:
             self.numberItem.setText("%d" % self._number)
@@ -1829,6 +1838,32 @@ class PLI(PLITreeManager, GraphicsRoundRectItem):
         
         stock.push(SetBrushCommand(self ,self.brush() ,defaultBrush))
 
+class CumulativeGLDisplayLists(object):
+    """
+    The display lists drawing every step up to a given step of one step sequence - a submodel's or a callout's -
+    as seen from one view.  A CSI's own display list calls the prefix list of the step before it.
+
+    Lists are laid out as a Fenwick tree over step numbers.  block(n) draws steps n - lowbit(n) + 1 to n by calling
+    the blocks of n - lowbit(n) / 2, ..., n - 2, n - 1 then drawing step n's parts.  prefix(n) draws steps 1 to n by
+    calling the blocks of n, n - lowbit(n), and so on down to 0, oldest first.  So lists never nest more than
+    log2(steps) + 2 deep: GL silently skips glCallLists nested past GL_MAX_LIST_NESTING, only 64 on most drivers.
+
+    Lists belong to step numbers, not CSIs.  When the parts or the CSI at a step number change, only that number's
+    block is recompiled, in place, and every list calling it draws the change.
+    """
+
+    def __init__(self, owner, viewKey):
+        self.owner = owner  # Submodel or Callout whose steps these lists draw
+        self.viewKey = viewKey
+        self.blocks = {}  # {step number: block display list}
+        self.prefixes = {}  # {step number: prefix display list}
+        self.users = set()  # CSIs whose own display list calls one of the prefixes
+
+    def delete(self):
+        for dispID in self.blocks.values() + self.prefixes.values():
+            GL.glDeleteLists(dispID, 1)
+        self.blocks, self.prefixes = {}, {}
+
 class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
     """ Construction Step Image.  Includes border and positional info. """
     itemClassName = "CSI"
@@ -1837,11 +1872,19 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
     defaultRotation = [20.0, 45.0, 0.0]
     highlightNewParts = False
 
+    # CSIs whose parts or step number changed since the cumulative lists drawing them were compiled
+    _staleCSIs = set()
+
+    # {(steps owner, view key): CumulativeGLDisplayLists}, dropped once no CSI calls them
+    _cumulativeGLDisplayLists = {}
+
     def __init__(self, step):
         QGraphicsRectItem.__init__(self, step)
 
         self.center = QPointF()
         self.glDispID = LicGLHelpers.UNINIT_GL_DISPID
+        self.cumulativeLists = None  # CumulativeGLDisplayLists glDispID calls to draw the previous steps
+        self._partExtents = {}  # {rotation: projected extents of this CSI's own parts}, see getProjectedExtents
         self.setFlags(AllFlags)
         self.setPen(QPen(Qt.NoPen))
 
@@ -1852,6 +1895,17 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         self.isDirty = True
         self.nextCSIIsDirty = False
 
+    def __getIsDirty(self):
+        return self.__isDirty
+
+    def __setIsDirty(self, isDirty):
+        # A dirty CSI's parts changed, so the cumulative lists drawing them are out of date too
+        self.__isDirty = isDirty
+        if isDirty:
+            CSI._staleCSIs.add(self)
+
+    isDirty = property(__getIsDirty, __setIsDirty)
+
     def getPartList(self):
         partList = []
         for partItem in self.parts:
@@ -1863,6 +1917,11 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         for partItem in self.parts:
             partCount += len(partItem.parts)
         return partCount
+
+    def getPartBoundingBoxes(self):
+        """ Return a [(Part, BoundingBox)] list for every part in this CSI, boxes computed in one batch. """
+        partList = self.getPartList()
+        return zip(partList, getPartBoundingBoxes(partList))
     
     def data(self, index):
         if index in [Qt.WhatsThisRole, Qt.AccessibleTextRole]:
@@ -1876,6 +1935,7 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         view runs from (0,0) to page width & height with (0,0) in the bottom left corner.
         """
 
+        CSI.updateCumulativeGLDisplayLists()
         if self.isDirty:
             self.resetPixmap()
             if self.nextCSIIsDirty:
@@ -1921,15 +1981,7 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
     def containsSubmodel(self):
         return any(part.isSubmodel() for part in self.getPartList())
 
-    def __callPreviousGLDisplayLists(self, isCurrent=False):
-
-        # Call all previous step's CSI display list
-        prevStep = self.parentItem().getPrevStep()
-        if prevStep:
-            # if prevStep.csi.glDispID == LicGLHelpers.UNINIT_GL_DISPID:
-            prevStep.csi.__callPreviousGLDisplayLists(False)
-            # else:
-            #    GL.glCallList(prevStep.csi.glDispID)
+    def __callPartGLDisplayLists(self, isCurrent=False, conditionalView=None):
 
         # Draw all the parts in this CSI
         # First their edges
@@ -1939,7 +1991,7 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         
         for partItem in self.parts:
             for part in partItem.parts:
-                part.callGLDisplayList(isCurrent, True)
+                part.callGLDisplayList(isCurrent, True, conditionalView)
                 
         GL.glPopAttrib()
         
@@ -1948,25 +2000,178 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
             for part in partItem.parts:
                 part.callGLDisplayList(isCurrent, False)
 
+    def __getPrevCSI(self):
+        prevStep = self.parentItem().getPrevStep()
+        return prevStep.csi if prevStep else None
+
+    def __getStepsOwner(self):
+        # The submodel or callout whose steps are numbered in sequence with this CSI's step
+        container = self.parentItem().parentItem()
+        return getattr(container, 'submodel', container)
+
+    def __getViewKey(self):
+        # Conditional lines compiled into a list depend on the view, so steps seen from different views can't share lists
+        if LicGeometry.conditionalLinesEnabled:
+            return (tuple(CSI.defaultRotation), tuple(self.rotation))
+        return None
+
+    @staticmethod
+    def __getConditionalView(viewKey):
+        if viewKey is None:
+            return None
+        defaultRotation, rotation = viewKey
+        if any(rotation):
+            return LicGeometry.viewTransform(list(defaultRotation), list(rotation))
+        return LicGeometry.viewTransform(list(defaultRotation))
+
+    @staticmethod
+    def __getCSIsByNumber(owner):
+        steps = owner.steps if isinstance(owner, Callout) else [step for page in owner.pages for step in page.steps]
+        return dict((step.number, step.csi) for step in steps)
+
+    @staticmethod
+    def __compileBlock(lists, csis, number):
+        # Children first: no list may be compiled while another one is
+        lowBit = number & -number
+        children = []
+        bit = lowBit / 2
+        while bit >= 1:
+            children.append(CSI.__getBlock(lists, csis, number - bit))
+            bit /= 2
+
+        if number not in lists.blocks:
+            lists.blocks[number] = GL.glGenLists(1)
+        GL.glNewList(lists.blocks[number], GL.GL_COMPILE)
+        for dispID in children:
+            GL.glCallList(dispID)
+        csi = csis.get(number)
+        if csi is not None:
+            csi.__callPartGLDisplayLists(False, CSI.__getConditionalView(lists.viewKey))
+        GL.glEndList()
+
+    @staticmethod
+    def __getBlock(lists, csis, number):
+        if number not in lists.blocks:
+            CSI.__compileBlock(lists, csis, number)
+        return lists.blocks[number]
+
+    @staticmethod
+    def __getPrefix(lists, csis, number):
+        # A prefix only calls blocks, and block display list IDs never change, so it never needs recompiling
+        if number not in lists.prefixes:
+            blocks = []
+            n = number
+            while n > 0:
+                blocks.insert(0, CSI.__getBlock(lists, csis, n))
+                n -= n & -n
+
+            dispID = lists.prefixes[number] = GL.glGenLists(1)
+            GL.glNewList(dispID, GL.GL_COMPILE)
+            for blockID in blocks:
+                GL.glCallList(blockID)
+            GL.glEndList()
+        return lists.prefixes[number]
+
+    def getPreviousGLDisplayList(self):
+        """
+        Return the display list drawing the parts of every previous step, as seen from this CSI's view, or None for the first step.
+        Missing lists are compiled, so this must not be called while another display list is being compiled.
+        """
+        number = self.parentItem().number
+        if number <= 1:
+            self.__setCumulativeLists(None)
+            return None
+
+        owner = self.__getStepsOwner()
+        key = (owner, self.__getViewKey())
+        lists = CSI._cumulativeGLDisplayLists.get(key)
+        if lists is None:
+            lists = CSI._cumulativeGLDisplayLists[key] = CumulativeGLDisplayLists(*key)
+        self.__setCumulativeLists(lists)
+        return CSI.__getPrefix(lists, CSI.__getCSIsByNumber(owner), number - 1)
+
+    def __setCumulativeLists(self, lists):
+        oldLists, self.cumulativeLists = self.cumulativeLists, lists
+        if lists is not None:
+            lists.users.add(self)
+        if oldLists is not None and oldLists is not lists:
+            oldLists.users.discard(self)
+            if not oldLists.users:  # No CSI is drawn from that view any more
+                oldLists.delete()
+                del CSI._cumulativeGLDisplayLists[(oldLists.owner, oldLists.viewKey)]
+
+    @staticmethod
+    def updateCumulativeGLDisplayLists():
+        """
+        Recompile, in place, the blocks holding every CSI whose parts or step number changed since they were compiled.
+        Later steps call those blocks whenever they are drawn, whether or not the changed CSI itself is ever painted
+        again, so this runs before any CSI display list is compiled or drawn.  Assumes a GL context sharing the
+        instructions' lists.
+        """
+        staleCSIs, CSI._staleCSIs = CSI._staleCSIs, set()
+        staleNumbers = {}  # {steps owner: set of step numbers}
+        for csi in staleCSIs:
+            if csi.scene() is None:
+                CSI._staleCSIs.add(csi)  # Removed, maybe only until an undo puts it back in place of another step
+            else:
+                staleNumbers.setdefault(csi.__getStepsOwner(), set()).add(csi.parentItem().number)
+
+        csisByOwner = {}
+        for lists in CSI._cumulativeGLDisplayLists.values():
+            numbers = [number for number in staleNumbers.get(lists.owner, ()) if number in lists.blocks]
+            if numbers and lists.owner not in csisByOwner:
+                csisByOwner[lists.owner] = CSI.__getCSIsByNumber(lists.owner)
+            for number in numbers:
+                CSI.__compileBlock(lists, csisByOwner[lists.owner], number)
+
+    @staticmethod
+    def deleteCumulativeGLDisplayLists():
+        """ Free every cumulative display list, when the instructions are cleared.  Assumes the instructions' GL context is current. """
+        for lists in CSI._cumulativeGLDisplayLists.values():
+            lists.delete()
+            for csi in lists.users:
+                csi.cumulativeLists = None
+        CSI._cumulativeGLDisplayLists = {}
+        CSI._staleCSIs = set()
+
+    def deleteGLDisplayLists(self):
+        """ Free this CSI's display list, when its step is removed.  Assumes the instructions' GL context is current. """
+        if self.glDispID != LicGLHelpers.UNINIT_GL_DISPID:
+            GL.glDeleteLists(self.glDispID, 1)
+        self.glDispID = LicGLHelpers.UNINIT_GL_DISPID
+        self.__setCumulativeLists(None)
+        self.isDirty = True
+
     def createGLDisplayList(self):
         """
-        Create a display list that includes all previous CSIs plus this one,
+        Create a display list that calls the cumulative list of every previous step, then draws this CSI's own parts,
         for a single display list giving a full model rendering up to this step.
         """
+        CSI.updateCumulativeGLDisplayLists()
+        prevDispID = self.getPreviousGLDisplayList()
 
         if self.glDispID == LicGLHelpers.UNINIT_GL_DISPID:
             self.glDispID = GL.glGenLists(1)
         GL.glNewList(self.glDispID, GL.GL_COMPILE)
         # LicGLHelpers.drawCoordLines()
-        self.__callPreviousGLDisplayLists(True)
+        if prevDispID is not None:
+            GL.glCallList(prevDispID)
+        self.__callPartGLDisplayLists(True, CSI.__getConditionalView(self.__getViewKey()))
         GL.glEndList()
+        self._partExtents = {}
 
     def resetPixmap(self):
 
         if not self.parts:
             self.center = QPointF()
             self.setRect(QRectF())
-            self.glDispID = LicGLHelpers.UNINIT_GL_DISPID
+            self._partExtents = {}
+            self.getPage().instructions.glContext.makeCurrent()
+            CSI.updateCumulativeGLDisplayLists()  # Later steps still call this step's block, which must drop the removed parts
+            if self.glDispID != LicGLHelpers.UNINIT_GL_DISPID:
+                GL.glDeleteLists(self.glDispID, 1)
+                self.glDispID = LicGLHelpers.UNINIT_GL_DISPID
+            self.__setCumulativeLists(None)
             return  # No parts = reset pixmap
         # Temporarily enlarge CSI, in case recent changes pushed image out of existing bounds.
         oldWidth, oldHeight = self.rect().width(), self.rect().height()
@@ -1976,16 +2181,17 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         glContext = self.getPage().instructions.glContext
         glContext.makeCurrent()
         self.createGLDisplayList()
-        sizes = [512, 1024, 2048]
+        sizes = [] if self.initSizeFromGeometry() else [512, 1024, 2048]
+        sizes = sizes[self.predictBufferSize(sizes):]
 
         for size in sizes:
 
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), glContext)
-            pBuffer.makeCurrent()
+            # Borrow a pooled buffer tied to the existing GLWidget, to get access to its display lists
+            with LicGLHelpers.renderTargets.pixelBuffer(size, glContext) as pBuffer:
+                pBuffer.makeCurrent()
 
-            if self.initSize(size, pBuffer):
-                break
+                if self.initSize(size, pBuffer):
+                    break
 
         # Move CSI so its new center matches its old
         dx = (self.rect().width() - oldWidth) / 2.0
@@ -2030,6 +2236,59 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         self.isDirty = False
         return result
 
+    def initSizeFromGeometry(self):
+        """
+        Like initSize, but computes this CSI's width, height and center point from its projected geometry, without rendering.
+        Returns False if analytic dimensioning is off, or if this CSI draws more than its parts and must be rendered.
+        """
+        if not LicGLHelpers.analyticDimensions:
+            return False
+
+        pageNumber, stepNumber = self.getPageStepNumberPair()
+        result = "Rendering CSI Page %d Step %d" % (pageNumber, stepNumber)
+        if not self.parts:
+            return result  # A CSI with no parts is already initialized
+
+        extents = self.getProjectedExtents()
+        if extents is None:
+            return False
+
+        w, h, self.center, unused1, unused2 = LicGLHelpers.initImgSizeFromExtents(extents * CSI.defaultScale * self.scaling)
+        self.setRect(0.0, 0.0, w, h)
+        self.isDirty = False
+        return result
+
+    def predictBufferSize(self, sizes):
+        """ Return the index of the buffer size in sizes this CSI should first render at, see LicGLHelpers.predictBufferSize. """
+        if not sizes or not LicGLHelpers.analyticDimensions:
+            return 0
+        extents = self.getProjectedExtents(True)
+        return LicGLHelpers.predictBufferSize(extents * CSI.defaultScale * self.scaling if extents is not None else None, sizes)
+
+    def getProjectedExtents(self, partsOnly=False):
+        """
+        Return the unscaled [min x, min y, max x, max y] window extents of this CSI as it renders: its own parts displaced,
+        plus every previous step's parts.  None if it also draws arrows or highlight boxes, or has no geometry at all.
+        partsOnly returns the extents of the parts even then, leaving the arrows and boxes out.
+        """
+        partList = self.getPartList()
+        if not partsOnly and (CSI.highlightNewParts or any(part.arrows or part.isSelected() for part in partList)):
+            return None
+
+        rotation = tuple(CSI.defaultRotation) + tuple(self.rotation)
+        view = LicGeometry.viewTransform(CSI.defaultRotation, self.rotation)
+        extents = [getPartExtents(partList, view, True)]
+
+        # Previous steps draw their parts undisplaced, so their extents are kept until their display lists change
+        csi = self.__getPrevCSI()
+        while csi is not None:
+            if rotation not in csi._partExtents:
+                csi._partExtents[rotation] = getPartExtents(csi.getPartList(), view)
+            extents.append(csi._partExtents[rotation])
+            csi = csi.__getPrevCSI()
+
+        return LicGeometry.unionExtents(extents)
+
     def createPng(self):
 
         csiName = self.getDatFilename()
@@ -2179,18 +2438,26 @@ class AbstractPart(object):
     in common when present in a model; everything inside 3001.dat.
     """
 
+    # Views whose visible conditional lines are kept per part.  Instances of one part are usually
+    # drawn at a handful of orientations, so a few views cover every instance in a CSI or PLI
+    visibleConditionalLinesCacheSize = 8
+
     def __init__(self, filename=None):
 
         self.name = self.filename = filename
         self.invertNext = False
         self.winding = GL.GL_CCW
         self.parts = []
-        self.primitives = []
+        self.primitives = PrimitiveStore()
         self.glDispID = LicGLHelpers.UNINIT_GL_DISPID
         self.glEdgeDispID = LicGLHelpers.UNINIT_GL_DISPID
         self.isPrimitive = False  # primitive here means sub-part or part that's internal to another part
         self.isSubmodel = False
         self._boundingBox = None
+        self._boundingBoxCached = False  # True once _boundingBox holds this part's box, even when that box is None
+        self._vertices = None  # Distinct vertices of this part and its sub parts, see getVertices
+        self._conditionalLines = None  # All conditional lines of this part and its sub parts, see getConditionalLines
+        self._visibleConditionalLines = collections.OrderedDict()  # {view transform: visible lines}, least recently drawn first
         
         self.pliScale = 1.0
         self.pliRotation = [0.0, 0.0, 0.0]
@@ -2207,12 +2474,14 @@ class AbstractPart(object):
         newPart.invertNext = self.invertNext
         newPart.winding = self.winding
         newPart.parts = list(self.parts)
-        newPart.primitives = list(self.primitives)
+        newPart.primitives = self.primitives.duplicate()
         newPart.glDispID = self.glDispID
         newPart.glEdgeDispID = self.glEdgeDispID
         newPart.isPrimitive = self.isPrimitive
         newPart.isSubmodel = self.isSubmodel
         newPart._boundingBox = self._boundingBox.duplicate() if self._boundingBox else None
+        newPart._boundingBoxCached = self._boundingBoxCached
+        newPart._vertices = self._vertices
         newPart.pliScale, newPart.pliRotation = self.pliScale, list(self.pliRotation)
         newPart.width, newPart.height = self.width, self.height
         newPart.leftInset, newPart.bottomInset = self.leftInset, self.bottomInset
@@ -2235,8 +2504,7 @@ class AbstractPart(object):
         for part in self.parts:
             part.callGLDisplayList(False, False)
 
-        for primitive in self.primitives:
-            primitive.callGLDisplayList(False)
+        self.primitives.callGLDisplayList(False)
 
         GL.glEndList()
         
@@ -2249,18 +2517,88 @@ class AbstractPart(object):
         for part in self.parts:
             part.callGLDisplayList(False, True)
             
-        for primitive in self.primitives:
-            primitive.callGLDisplayList(True)
+        self.primitives.callGLDisplayList(True)
         
         GL.glEndList()
         
 
-    def drawConditionalLines(self):
+    def flatten(self, instanced=()):
+        """
+        Bake the primitives of every sub part, all the way down, into this part's own PrimitiveStore, transformed
+        into this part's coordinates, so drawing it needs no nested display lists or matrix changes.
+        Sub parts whose filename is in instanced (like studs), and sub parts with a color of their own, are
+        kept as child Parts instead, placed directly under this part.  Only use on library parts.
+        """
+        store = self.primitives.duplicate()
+        parts = []
+
+        def bake(abstractPart, matrix, inverted):
+            for part in abstractPart.parts:
+                m = getPartMatrices([part])[0] if matrix is None else numpy.dot(getPartMatrices([part])[0], matrix)
+                partInverted = inverted or part.inverted  # Nested parts draw with GL_CW if any parent set it
+                if part.color is not None or part.abstractPart.filename in instanced:
+                    newPart = Part(part.filename, part.color, m.reshape(16), partInverted)
+                    newPart.abstractPart = part.abstractPart
+                    parts.append(newPart)
+                else:
+                    store.extend(part.abstractPart.primitives, m, partInverted)
+                    bake(part.abstractPart, m, partInverted)
+
+        bake(self, None, False)
         for part in self.parts:
-            part.abstractPart.drawConditionalLines()
-            
-        for primitive in self.primitives:
-            primitive.drawConditionalLines()
+            part.matrix = None  # Nothing draws the replaced sub parts any more, so give back their transform table rows
+        self.primitives = store
+        self.parts = parts
+        self._conditionalLines = None
+        self._visibleConditionalLines.clear()
+        self.resetBoundingBox()
+
+    def getDrawStats(self, stats=None):
+        """
+        Return (vertices, draw calls, matrix changes) needed to draw this part once, sub parts included.
+        stats is an optional {AbstractPart: stats} dict, to share results across many calls.
+        """
+        stats = {} if stats is None else stats
+        if self not in stats:
+            vertices, drawCalls, matrixCount = self.primitives.vertexCount(), self.primitives.drawCallCount(), 0
+            for part in self.parts:
+                v, d, m = part.abstractPart.getDrawStats(stats)
+                vertices, drawCalls, matrixCount = vertices + v, drawCalls + d, matrixCount + m + 1
+            stats[self] = (vertices, drawCalls, matrixCount)
+        return stats[self]
+
+    def getConditionalLines(self):
+        """
+        Return every conditional line in this part and all its sub parts, in this part's
+        coordinates, as one (count, 4, 3) array.  Library parts never change, so this is built once.
+        """
+        if self._conditionalLines is None:
+            lines = [self.primitives.conditionalLines()]
+            for part in self.parts:
+                subLines = part.abstractPart.getConditionalLines()
+                if len(subLines):
+                    lines.append(LicGeometry.transformPoints(subLines, part.matrix))
+            self._conditionalLines = numpy.concatenate(lines)
+        return self._conditionalLines
+
+    def drawConditionalLines(self, transform):
+        """
+        Draw the conditional lines visible when this part is seen through transform, the 3x3 rotation
+        from this part's coordinates to the view.  Must be called while painting edges.
+        """
+        if self.isSubmodel:
+            for part in self.parts:  # Submodels change, so don't flatten them - let each part draw its own
+                part.callConditionalLines(transform)
+            return
+
+        key = transform.tostring()
+        lines = self._visibleConditionalLines.pop(key, None)
+        if lines is None:
+            lines = LicGeometry.visibleConditionalLines(self.getConditionalLines(), transform)
+            if len(self._visibleConditionalLines) >= AbstractPart.visibleConditionalLinesCacheSize:
+                self._visibleConditionalLines.popitem(last=False)
+        self._visibleConditionalLines[key] = lines
+        LicGeometry.drawLines(lines)
 
     def buildSubAbstractPartDict(self, partDict):
 
@@ -2276,16 +2614,20 @@ class AbstractPart(object):
         sizes = [128, 256, 512, 1024, 2048]
         self.width, self.height, self.center, self.leftInset, self.bottomInset = [0] * 5
 
+        rotation = extraRotation if extraRotation else self.pliRotation
+        scaling = extraScale if extraScale else self.pliScale
+        if self.initSizeFromCache(rotation, scaling):
+            sizes = []
+        sizes = sizes[self.predictBufferSize(sizes, rotation, scaling):]
+
         for size in sizes:
 
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), glContext)
-            pBuffer.makeCurrent()
+            # Borrow a pooled buffer tied to the existing GLWidget, to get access to its display lists
+            with LicGLHelpers.renderTargets.pixelBuffer(size, glContext) as pBuffer:
+                pBuffer.makeCurrent()
 
-            rotation = extraRotation if extraRotation else self.pliRotation
-            scaling = extraScale if extraScale else self.pliScale
-            if self.initSize(size, pBuffer, rotation, scaling):
-                break
+                if self.initSize(size, pBuffer, rotation, scaling):
+                    break
 
         glContext.makeCurrent()
 
@@ -2305,13 +2647,61 @@ class AbstractPart(object):
 
         #TODO: If a part is rendered at a size > 256, draw it smaller in the PLI
         # - this sounds like a great way to know when to shrink a PLI image...
+        glDispID, scale, rotation, extraRotation = self.getRenderParameters(extraRotation, extraScale)
+        params = LicGLHelpers.initImgSize(size, glDispID, self.filename, scale, rotation, extraRotation)
+        return self.setSize(params, extraRotation, extraScale)
+
+    def getRenderParameters(self, extraRotation=[0.0, 0.0, 0.0], extraScale=1.0):
+        """ Return the (display list, scale, rotation, extra rotation) initSize draws this part with. """
         rotation = SubmodelPreview.defaultRotation if self.isSubmodel else PLI.defaultRotation
         scaling = SubmodelPreview.defaultScale if self.isSubmodel else PLI.defaultScale
-        params = LicGLHelpers.initImgSize(size, self.glDispID, self.filename, scaling * extraScale, rotation, extraRotation)
+        return (self.glDispID, scaling * extraScale, rotation, extraRotation)
+
+    def setSize(self, params, extraRotation=[0.0, 0.0, 0.0], extraScale=1.0):
+        """
+        Store the (width, height, center, leftInset, bottomInset) LicGLHelpers.initImgSize returned for this part,
+        and cache them.  Returns False if params is None, because the part rendered out of frame.
+        """
         if params is None:
             return False
 
         self.width, self.height, self.center, self.leftInset, self.bottomInset = params
+
+        key = self.getDimensionKey(extraRotation, extraScale)
+        if key is not None:
+            LDrawCache.dimensionCache.put(key, (self.width, self.height, self.center.x(), self.center.y(), self.leftInset, self.bottomInset))
+        return True
+
+    def predictBufferSize(self, sizes, extraRotation=[0.0, 0.0, 0.0], extraScale=1.0):
+        """ Return the index of the buffer size in sizes this part should first render at, see LicGLHelpers.predictBufferSize. """
+        if not sizes or not LicGLHelpers.analyticDimensions:
+            return 0
+        rotation = SubmodelPreview.defaultRotation if self.isSubmodel else PLI.defaultRotation
+        scaling = SubmodelPreview.defaultScale if self.isSubmodel else PLI.defaultScale
+        extents = LicGeometry.projectedExtents(self.getVertices(), LicGeometry.viewTransform(rotation, extraRotation))
+        return LicGLHelpers.predictBufferSize(extents * scaling * extraScale if extents is not None else None, sizes)
+
+    def getDimensionKey(self, extraRotation=[0.0, 0.0, 0.0], extraScale=1.0):
+        """
+        Return the key this part's dimensions are cached under in LDrawCache.dimensionCache, drawn with this extra
+        rotation and scale.  Edges are drawn with the current line thickness, which widens the image, so that's
+        part of the key too.  None for submodels, which belong to a single book.
+        """
+        if self.isSubmodel:
+            return None
+        geometryHash = hashlib.md5(self.getVertices().tostring()).hexdigest()
+        return (unicode(self.filename), geometryHash, tuple(float(v) for v in PLI.defaultRotation), float(PLI.defaultScale),
+                tuple(float(v) for v in extraRotation), float(extraScale), float(LicGLHelpers.getLightParameters()[2]))
+
+    def initSizeFromCache(self, extraRotation=[0.0, 0.0, 0.0], extraScale=1.0):
+        """ Like initSize, but takes this part's dimensions from a previous session.  Returns False if they weren't cached. """
+        key = self.getDimensionKey(extraRotation, extraScale)
+        dimensions = LDrawCache.dimensionCache.get(key) if key is not None else None
+        if dimensions is None:
+            return False
+
+        self.width, self.height, x, y, self.leftInset, self.bottomInset = dimensions
+        self.center = QPointF(x, y)
         return True
 
     def paintGL(self, dx, dy, rotation=[0.0, 0.0, 0.0], scaling=1.0, color=None):
@@ -2343,6 +2733,12 @@ class AbstractPart(object):
         GL.glDisable(GL_LIGHTING)
         
         GL.glCallList(self.glEdgeDispID)
+
+        if LicGeometry.conditionalLinesEnabled:
+            if color is not None:
+                self.drawConditionalLines(LicGeometry.viewTransform(dr, rotation, self.pliRotation))
+            else:
+                self.drawConditionalLines(LicGeometry.viewTransform(dr, rotation))
         
         GL.glPopAttrib()
         
@@ -2360,39 +2756,54 @@ class AbstractPart(object):
          This parameter is useful when part as base plate or other must be ignored 
          to properly calculate of dimensions of model.
         """
-        if self._boundingBox and excluded is None:
+        if self._boundingBoxCached and excluded is None:
             return self._boundingBox
         
-        box = None
-        for primitive in self.primitives:
-            p = primitive.getBoundingBox()
-            if p:
-                if box:
-                    box.growByBoudingBox(p)
-                else:
-                    box = p.duplicate()
-            
+        # Every child box is transformed into this part's space in one batch
+        boxes, parts = [], []
         for part in self.parts:
             if excluded and excluded.contains(part.filename, cs=Qt.CaseInsensitive):
                 continue
-            else:
-                p = part.abstractPart.getBoundingBox(excluded)
-                if p:
-                    if box:
-                        box.growByBoudingBox(p, part.matrix)
-                    else:
-                        box = p.duplicate(part.matrix)
+            p = part.abstractPart.getBoundingBox(excluded)
+            if p:
+                boxes.append(p.corners())
+                parts.append(part)
+
+        corners = []
+        if boxes:
+            corners.append(LicGeometry.unionBoxes(LicGeometry.transformBoxes(boxes, getPartMatrices(parts))))
+        primitiveCorners = self.primitives.getBoundingBox()
+        if primitiveCorners is not None:
+            corners.append(primitiveCorners)
 
+        box = BoundingBox.fromCorners(LicGeometry.unionBoxes(numpy.array(corners))) if corners else None
         if excluded is None:
             self._boundingBox = box
+            self._boundingBoxCached = True
         return box
 
     def resetBoundingBox(self):
-        for primitive in self.primitives:
-            primitive.resetBoundingBox()
-        for part in self.parts:
-            part.abstractPart.resetBoundingBox()
+        """ Forget this part's cached box after its own primitives changed.  Its sub parts are library parts, whose boxes never change. """
+        self.primitives.pointsChanged()
         self._boundingBox = None
+        self._boundingBoxCached = False
+        self._vertices = None
+
+    def getVertices(self):
+        """ Return every distinct vertex of this part and all its sub parts, as one (count, 3) array in this part's space. """
+        if self._vertices is None:
+            points = [self.primitives.arrays(t)[0].reshape(-1, 3) for t in LicGeometry.PrimitiveTypes]
+
+            partGroups = {}  # {AbstractPart: [Part]}, so each sub part's vertices are placed in one batch
+            for part in self.parts:
+                partGroups.setdefault(part.abstractPart, []).append(part)
+            for abstractPart, parts in partGroups.items():
+                vertices = abstractPart.getVertices()
+                if len(vertices):
+                    points.append(LicGeometry.placePoints(vertices, getPartMatrices(parts)))
+
+            self._vertices = LicGeometry.uniquePoints(numpy.concatenate(points))
+        return self._vertices
 
 class BoundingBox(object):
     
@@ -2404,18 +2815,22 @@ class BoundingBox(object):
     def __str__(self):
         return "%.0f %.0f | %.0f %.0f | %.0f %.0f" % (self.x1, self.x2, self.y1, self.y2, self.z1, self.z2)
     
-    def duplicate(self, matrix=None):
-        b = BoundingBox()
-        if matrix:
-            b.x1, b.y1, b.z1 = self.transformPoint(matrix, self.x1, self.y1, self.z1)
-            b.x2, b.y2, b.z2 = self.transformPoint(matrix, self.x2, self.y2, self.z2)
-            if b.y1 > b.y2:
-                b.y1, b.y2 = b.y2, b.y1
-        else:
-            b.x1, b.y1, b.z1 = self.x1, self.y1, self.z1
-            b.x2, b.y2, b.z2 = self.x2, self.y2, self.z2
+    @staticmethod
+    def fromCorners(corners):
+        """ Create a BoundingBox from a (min corner, max corner) pair of xyz points. """
+        (x1, y1, z1), (x2, y2, z2) = corners
+        b = BoundingBox(float(x1), float(y1), float(z1))
+        b.x2, b.y2, b.z2 = float(x2), float(y2), float(z2)
         return b
-        
+
+    def corners(self):
+        return numpy.array([[self.x1, self.y1, self.z1], [self.x2, self.y2, self.z2]])
+
+    def duplicate(self, matrix=None):
+        if matrix is not None:
+            return BoundingBox.fromCorners(LicGeometry.transformBoxes([self.corners()], LicGeometry.glMatrices([matrix]))[0])
+        return BoundingBox.fromCorners(self.corners())
+
     def vertices(self):
         yield (self.x1, self.y1, self.z1)
         yield (self.x1, self.y1, self.z2)
@@ -2435,16 +2850,10 @@ class BoundingBox(object):
         self.z2 = max(z, self.z2)
         
     def growByBoudingBox(self, box, matrix=None):
-        if matrix:
-            if matrix[5] < 0:
-                self.growByPoints(*self.transformPoint(matrix, box.x1, box.y2, box.z1))
-                self.growByPoints(*self.transformPoint(matrix, box.x2, box.y1, box.z2))
-            else:
-                self.growByPoints(*self.transformPoint(matrix, box.x1, box.y1, box.z1))
-                self.growByPoints(*self.transformPoint(matrix, box.x2, box.y2, box.z2))
-        else:
-            self.growByPoints(box.x1, box.y1, box.z1)
-            self.growByPoints(box.x2, box.y2, box.z2)
+        if matrix is not None:
+            box = box.duplicate(matrix)
+        self.growByPoints(box.x1, box.y1, box.z1)
+        self.growByPoints(box.x2, box.y2, box.z2)
 
     def transformPoint(self, matrix, x, y, z):
         x2 = (matrix[0] * x) + (matrix[4] * y) + (matrix[8] * z) + matrix[12]
@@ -2461,6 +2870,91 @@ class BoundingBox(object):
     def zSize(self):
         return abs(self.z2 - self.z1)
 
+def getPartMatrices(partList):
+    """
+    Return the matrix of each Part in partList as one (count, 4, 4) array, like LicGeometry.glMatrices returns.
+    Matrices are gathered from each TransformTable in one batch; a Part without a matrix gets identity.
+    """
+    matrices = numpy.empty((len(partList), 4, 4))
+    matrices[:] = numpy.identity(4)
+
+    tableRows = {}  # {TransformTable: ([index into partList], [row in table])}
+    for i, part in enumerate(partList):
+        if part._transformTable is not None:
+            indexes, rows = tableRows.setdefault(part._transformTable, ([], []))
+            indexes.append(i)
+            rows.append(part._transformRow)
+
+    for table, (indexes, rows) in tableRows.items():
+        matrices[indexes] = table.gather(rows)
+    return matrices
+
+def getPartExtents(partList, view, useDisplacement=False):
+    """
+    Return the unscaled window extents, like LicGeometry.projectedExtents, of every Part in partList seen through view.
+    useDisplacement moves each part by its displacement first, like drawing it in its own step does.
+    """
+    partGroups = {}  # {AbstractPart: [Part]}
+    for part in partList:
+        partGroups.setdefault(part.abstractPart, []).append(part)
+
+    extents = []
+    for abstractPart, parts in partGroups.items():
+        vertices = abstractPart.getVertices()
+        if not len(vertices):
+            continue
+        matrices = getPartMatrices(parts)
+        if useDisplacement:
+            for i, part in enumerate(parts):
+                if part.displacement:
+                    matrices[i, 3, :3] += part.displacement
+        extents.append(LicGeometry.projectedExtents(LicGeometry.placePoints(vertices, matrices), view))
+    return LicGeometry.unionExtents(extents)
+
+def getPartBoundingBoxes(partList):
+    """
+    Return the bounding box of each Part in partList, in model space and including its displacement.
+    All the boxes are transformed in one batch, so prefer this to calling getPartBoundingBox for each part.
+    """
+    if not partList:
+        return []
+
+    origin = numpy.zeros((2, 3))
+    boxes = []
+    for part in partList:
+        box = part.abstractPart.getBoundingBox()
+        boxes.append(box.corners() if box else origin)
+
+    matrices = getPartMatrices(partList)
+    for i, part in enumerate(partList):
+        if part.displacement:
+            matrices[i, 3, :3] += part.displacement
+
+    return [BoundingBox.fromCorners(c) for c in LicGeometry.transformBoxes(boxes, matrices)]
+
+class InstanceTable(object):
+    """
+    The flattened contents of one Submodel: one row per non-submodel Part placed anywhere inside it,
+    repeated once per instance of each nested submodel, in the order getFullPartList always used.
+        parts: the Part placed by each row
+        matrices: (count, 4, 4) array placing each row's part in the submodel, like LicGeometry.glMatrices
+        colors: the LicColor of each row, with inherited (None) colors taken from the enclosing submodel instance
+        paths: for each row, the tuple of submodel instance Parts it was placed through, outermost first
+        references: {filename: number of Parts referring to it} over the submodel and its child submodels
+    Built by Submodel.getInstanceTable, and never changed after; a change to the submodel builds a new table.
+    """
+
+    def __init__(self, parts, matrices, colors, paths, references, children):
+        self.parts = parts
+        self.matrices = matrices
+        self.colors = colors
+        self.paths = paths
+        self.references = references
+        self.children = children  # {Submodel: the InstanceTable of that submodel this table was built from}
+
+    def __len__(self):
+        return len(self.parts)
+
 class Submodel(SubmodelTreeManager, AbstractPart):
     """ A Submodel is just an AbstractPart that also has pages & steps, and can be inserted into a tree. """
     itemClassName = "Submodel"
@@ -2478,6 +2972,8 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         self._parent = parent
         self.isSubmodel = True
         self.isSubAssembly = False
+        self._instanceTable = None  # InstanceTable of this submodel, see getInstanceTable
+        self._childSubmodels = None  # Set of Submodels this submodel places instances of, see getChildSubmodels
 
     def getSimpleName(self):
         name = os.path.splitext(os.path.basename(self.name))[0]
@@ -2537,90 +3033,114 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             csi = self.pages[0].steps[0].csi
             self.populateStepsWithParts(csi, PARTS_PER_STEP_MAX)
 
-    def populateStepsWithParts(self, sourceCSI, maxParts):      
-        while sourceCSI.partCount() > maxParts:
-            
-            partList = sourceCSI.getPartList()
-            partList.sort(cmp=LicHelpers.compareParts)
-            
-            part = partList[0]
-            y, dy = part.by(), part.ySize()
-            currentPartIndex = 1
-            
-            if len(partList) > 1:
-                
+    def populateStepsWithParts(self, sourceCSI, maxParts):
+        """
+        Split the parts of sourceCSI into steps of about maxParts parts each, adding one new page per new step.
+        Parts are grouped into steps first (see partitionParts), then each part is moved once, straight to its final step.
+        """
+        stepPartLists = self.partitionParts(sourceCSI.getPartBoundingBoxes(), maxParts)
+        sourceStep = sourceCSI.parentItem()
+
+        for partList in stepPartLists[1:]:  # First list stays in sourceCSI
+            newPage = self.instructions.spawnNewPage(self, self.pages[-1]._number + 1, self.pages[-1]._row + 1)
+            newPage.addBlankStep()
+            self.addPage(newPage)
+
+            newStep = newPage.steps[-1]
+            for part in partList:
+                part.setParentItem(newPage)
+                sourceStep.removePart(part)
+                newStep.addPart(part)
+
+    def partitionParts(self, partBoxes, maxParts):
+        """
+        Split partBoxes, a [(Part, BoundingBox)] list, into a list of part lists, one per step, in step order.
+        Boxes are sorted once, then a single sweep through that order takes each step's parts off the front
+        of what's left: usually the next layer of parts, up to about maxParts of them.
+        compareBoxes compares with tolerances, so on near ties the leftover parts can come out in a slightly
+        different order than sorting them again for each step would give.
+        """
+        partBoxes = sorted(partBoxes, cmp=LicHelpers.compareBoxes, key=lambda partBox: partBox[1])
+        partList = [part for part, box in partBoxes]
+        boxes = [box for part, box in partBoxes]
+
+        order = range(len(partList))  # order[start:] indexes the parts not yet in a step, in sorted order
+        start = 0
+        stepIndexes = []
+
+        while len(order) - start > maxParts:
+            count = len(order) - start
+            first = order[start]
+            y, dy = boxes[first].y2, boxes[first].ySize()
+            split = 1  # Keep the next 'split' parts in this step, unless 'kept' is set below
+            kept = None
+
+            if count > 1:
+
                 # Advance part list splice point forward until we find the next 'layer' of parts
-                nextPart = partList[currentPartIndex]
-                while y == nextPart.by() and abs(dy - nextPart.ySize()) <= 4.0:
-                    currentPartIndex += 1
-                    if currentPartIndex >= len(partList):
+                while split < count:
+                    nextBox = boxes[order[start + split]]
+                    if y != nextBox.y2 or abs(dy - nextBox.ySize()) > 4.0:
                         break
-                    nextPart = partList[currentPartIndex]
-                    
-                # Here, currentPartIndex points to the next potential splice point
-                if currentPartIndex > maxParts:
-                    
+                    split += 1
+
+                # Here, split points to the next potential splice point
+                if split > maxParts:
+
                     # Have lots of parts in this layer: keep most popular part here, bump rest to next step
                     partCounts = {}
-                    for part in partList[:currentPartIndex]:
-                        if part.abstractPart.name in partCounts:
-                            partCounts[part.abstractPart.name] += 1
-                        else:
-                            partCounts[part.abstractPart.name] = 1
+                    for i in order[start:start + split]:
+                        name = partList[i].abstractPart.name
+                        partCounts[name] = partCounts.get(name, 0) + 1
                     popularPartName = max(partCounts, key=partCounts.get)
-                    partList = [x for x in partList[:currentPartIndex] if x.abstractPart.name != popularPartName] + partList[currentPartIndex:]
-                    currentPartIndex = 0
-                    
-                elif currentPartIndex == 1 and not partList[0].isSubmodel():
-                    
+                    kept = [i for i in order[start:start + split] if partList[i].abstractPart.name == popularPartName]
+
+                elif split == 1 and not partList[first].isSubmodel():
+
                     # Have only one part in this layer: search forward until we hit a layer with several parts
-                    part = partList[0]
-                    nextPart = partList[1]
-                    while (abs(part.by2() - nextPart.by()) <= 4.0) and \
-                          (currentPartIndex < maxParts - 1) and \
-                          (currentPartIndex < len(partList) - 1):
-                        part = partList[currentPartIndex]
-                        nextPart = partList[currentPartIndex + 1]
-                        currentPartIndex += 1
-                        
-                    if currentPartIndex > 1:
+                    box = boxes[first]
+                    nextBox = boxes[order[start + 1]]
+                    while (abs(box.y1 - nextBox.y2) <= 4.0) and (split < maxParts - 1) and (split < count - 1):
+                        box = boxes[order[start + split]]
+                        nextBox = boxes[order[start + split + 1]]
+                        split += 1
+
+                    if split > 1:
                         # Add an up displacement to last part, if it's basically above previous part
-                        p1 = partList[currentPartIndex - 1]
-                        p2 = partList[currentPartIndex]
-                        px1, pz1, px2, pz2 = p1.x(), p1.z(), p2.x(), p2.z()
-                        if abs(px1 - px2) < 2 and abs(pz1 - pz2) < 2:
+                        p1 = partList[order[start + split - 1]]
+                        p2 = partList[order[start + split]]
+                        if abs(p1.x() - p2.x()) < 2 and abs(p1.z() - p2.z()) < 2:
                             p2.addNewDisplacement(Qt.Key_PageUp)
-                        currentPartIndex += 1
-            
-            if len(partList[currentPartIndex: ]) == 0:
-                break  # All done
+                            boxes[order[start + split]] = p2.getPartBoundingBox()  # Re-measure, now it's displaced
+                        split += 1
 
-            # Create a new page, give it a step, then push all remaining parts to that step
-            newPage = self.instructions.spawnNewPage(self, self.pages[-1]._number + 1, self.pages[-1]._row + 1)
-            newPage.addBlankStep()
-            self.addPage(newPage)
+            if kept is None:
+                if split >= count:
+                    break  # All done
 
-            # Want submodels to be inserted in their own Step, so split those off
-            submodelList = [part for part in partList[:currentPartIndex] if part.isSubmodel()]
-            if submodelList and len(submodelList) != currentPartIndex:
-                partList = submodelList + partList[currentPartIndex:]
-                currentPartIndex = 0
-            
-            # Want all identical submodels inserted in same step, so group them all
-            if partList[0].isSubmodel() and currentPartIndex > 0:
-                partList = [part for part in partList if part.filename != partList[0].filename]
-                currentPartIndex = 0
-            
-            # Here, partList is all parts not yet allocated to a Step, and currentPartIndex is an index into  
-            # that list; parts before currentPartIndex stay in this Step, parts after get bumped to next Step
-            for part in partList[currentPartIndex: ]:  # Move all but the first x parts to next step
-                currentStep = part.getStep()
-                part.setParentItem(newPage)
-                currentStep.removePart(part)
-                newPage.steps[-1].addPart(part)
+                kept = order[start:start + split]
+
+                # Want submodels to be inserted in their own Step, so split those off
+                submodels = [i for i in kept if partList[i].isSubmodel()]
+                if submodels and len(submodels) != len(kept):
+                    kept = [i for i in kept if not partList[i].isSubmodel()]
+
+                # Want all identical submodels inserted in same step, so group them all
+                elif partList[first].isSubmodel():
+                    filename = partList[first].filename
+                    kept = [i for i in order[start:] if partList[i].filename == filename]
+
+            stepIndexes.append(kept)
+            if kept == order[start:start + len(kept)]:
+                start += len(kept)
+            else:
+                keptSet = set(kept)
+                order = [i for i in order[start:] if i not in keptSet]
+                start = 0
+
+        stepIndexes.append(order[start:])
+        return [[partList[i] for i in indexes] for indexes in stepIndexes if indexes]
 
-            sourceCSI = newPage.steps[-1].csi
-            
     def mergeInitialPages(self):
         
         for submodel in self.submodels:
@@ -2712,6 +3232,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             submodel._parent = self
             submodel._row = self.rowCount()
             self.submodels.append(submodel)
+            self.partsChanged()
             self.reOrderSubmodelPages()
             self.instructions.mainModel.syncPageNumbers()
             for page in submodel.pages:
@@ -2721,6 +3242,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
     def removeSubmodel(self, submodel):
         self.removeRow(submodel._row)
         self.submodels.remove(submodel)
+        self.partsChanged()
         for page in submodel.pages:
             page.scene().removeItem(page)
         self.instructions.mainModel.syncPageNumbers()
@@ -2790,7 +3312,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         index = len([p for p in self.pages if p._row < page._row])
         self.pages.insert(index, page)
 
-        if page in self.instructions.scene.items():
+        if page.scene() is self.instructions.scene:
             self.instructions.scene.removeItem(page)  # Need to re-add page to trigger scene page layout
         self.instructions.scene.addItem(page)
 
@@ -2939,10 +3461,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         return res
 
     def submodelInstanceCount(self, submodelName):
-        count = len([p for p in self.parts if p.filename == submodelName])
-        for submodel in self.submodels:
-            count += submodel.submodelInstanceCount(submodelName)
-        return count
+        return self.getInstanceTable().references.get(submodelName, 0)
 
     def submodelCount(self):
         return self._genericIterator('submodels', len)
@@ -2953,12 +3472,112 @@ class Submodel(SubmodelTreeManager, AbstractPart):
     def getPageList(self):
         return self._genericIterator('pages', list)
 
+    def partMoved(self, part):
+        """ Call after part, one of self.parts, moved or changed shape. """
+        self._instanceTable = None
+        self.resetBoundingBox()
+
+    def partRecolored(self, part):
+        self._instanceTable = None
+
+    def partsChanged(self):
+        """ Call after adding or removing parts in self.parts, or changing self.submodels. """
+        self._instanceTable = None
+        self._childSubmodels = None
+        self.resetBoundingBox()
+
+    def getChildSubmodels(self):
+        """ Return the set of Submodels this submodel places at least one instance of. """
+        if self._childSubmodels is None:
+            self._childSubmodels = set(part.abstractPart for part in self.parts if part.isSubmodel())
+        return self._childSubmodels
+
+    def getUsers(self):
+        """ Return the Submodels that place at least one instance of this submodel, ie, whose geometry depends on it. """
+        mainModel = self.instructions.mainModel if self.instructions else None
+        if mainModel is None:
+            return []
+        models = [mainModel] + mainModel._genericIterator('submodels', list)
+        return [model for model in models if self in model.getChildSubmodels()]
+
+    def resetBoundingBox(self):
+        """
+        Forget the cached box and vertices of this submodel and of every submodel that depends on it.
+        Library part boxes stay valid, since their geometry can't change.  A submodel's box is only cached
+        while all its child submodels' boxes are, so a submodel with no cached box has no cached ancestors either.
+        """
+        if not self._boundingBoxCached and self._vertices is None:
+            return
+        self._boundingBox = None
+        self._boundingBoxCached = False
+        self._vertices = None
+        for model in self.getUsers():
+            model.resetBoundingBox()
+
+    def getPlacedParts(self):
+        """
+        Return (partList, matrices): every non-submodel Part placed anywhere in this submodel, once per
+        instance of each nested submodel, and the (count, 4, 4) matrix placing it in this submodel.
+        """
+        table = self.getInstanceTable()
+        return table.parts, table.matrices
+
+    def getInstanceTable(self):
+        """
+        Return the InstanceTable of this submodel.  Tables are cached per submodel: a cached table is reused
+        as long as this submodel's parts haven't changed (see partsChanged) and every child submodel still
+        returns the table it was built from, so an edit only rebuilds the edited submodel and its ancestors.
+        """
+        table = self._instanceTable
+        if table is not None and all(child.getInstanceTable() is childTable for child, childTable in table.children.items()):
+            return table
+
+        matrices = getPartMatrices(self.parts)
+        children = {}
+        blocks = []  # [(index in self.parts, parts, matrices, colors, paths)], put back in self.parts order below
+
+        instances = collections.OrderedDict()  # {Submodel: [index of each instance in self.parts]}
+        for i, part in enumerate(self.parts):
+            if part.isSubmodel():
+                instances.setdefault(part.abstractPart, []).append(i)
+
+        # Each nested submodel is placed under all of its instances in one batch
+        for submodel, indexes in instances.items():
+            childTable = children[submodel] = submodel.getInstanceTable()
+            if not len(childTable):
+                continue
+            composed = LicGeometry.composeTransforms(childTable.matrices, matrices[indexes]).reshape(len(indexes), -1, 4, 4)
+            for i, placed in zip(indexes, composed):
+                instance = self.parts[i]
+                colors = [instance.color if c is None else c for c in childTable.colors]
+                paths = [(instance,) + path for path in childTable.paths]
+                blocks.append((i, childTable.parts, placed, colors, paths))
+
+        blocks.sort(key=lambda block: block[0])
+        leaves = [i for i, part in enumerate(self.parts) if not part.isSubmodel()]
+        leafParts = [self.parts[i] for i in leaves]
+        blocks.append((len(self.parts), leafParts, matrices[leaves], [part.color for part in leafParts], [()] * len(leaves)))
+
+        partList, colors, paths = [], [], []
+        for unused, blockParts, blockMatrices, blockColors, blockPaths in blocks:
+            partList += blockParts
+            colors += blockColors
+            paths += blockPaths
+
+        references = {}
+        for part in self.parts:
+            references[part.filename] = references.get(part.filename, 0) + 1
+        for submodel in self.submodels:
+            childTable = children[submodel] = submodel.getInstanceTable()
+            for filename, count in childTable.references.items():
+                references[filename] = references.get(filename, 0) + count
+
+        placedMatrices = numpy.concatenate([block[2] for block in blocks])
+        self._instanceTable = InstanceTable(partList, placedMatrices, colors, paths, references, children)
+        return self._instanceTable
+
     def getFullPartList(self):
-        partList = [] 
-        for part in [p for p in self.parts if p.isSubmodel()]:
-            partList += part.abstractPart.getFullPartList()
-        partList += [p for p in self.parts if not p.isSubmodel()]
-        return partList
+        return list(self.getInstanceTable().parts)
 
     def addSubmodelImages(self):
         count = self.instructions.mainModel.submodelInstanceCount(self.filename)
@@ -3207,6 +3826,7 @@ class Part(PartTreeManager, QGraphicsRectItem):
 
         self.filename = filename  # Needed for save / load
         self.color = color
+        self._transformTable = self._transformRow = self._matrix = None
         self.matrix = matrix
         self.inverted = invert
         self.abstractPart = None
@@ -3223,14 +3843,32 @@ class Part(PartTreeManager, QGraphicsRectItem):
 
         self.setFlags(NoMoveFlags)
         
+    def __getMatrix(self):
+        return self._matrix
+
+    def __setMatrix(self, matrix):
+        # The matrix lives in a row of the model's LicGeometry.TransformTable; self._matrix is a view of that row,
+        # so in place edits like part.matrix[12] += 1 go straight to the table.  Assigning copies the values in.
+        if matrix is None:
+            if self._transformRow is not None:
+                self._transformTable.release(self._transformRow)
+            self._transformTable = self._transformRow = self._matrix = None
+            return
+
+        if self._transformRow is None:
+            self._transformTable = LicGeometry.transformTable
+            self._transformRow, self._matrix = self._transformTable.allocate(self)
+        self._matrix[:] = matrix
+
+    matrix = property(__getMatrix, __setMatrix)
+
     def initializeAbstractPart(self, instructions):
         
         fn = self.filename
         pd = instructions.partDictionary
-        if fn in pd:
-            self.abstractPart = pd[fn]
-        elif fn.upper() in pd:
-            self.abstractPart = pd[fn.upper()]
+        abstractPart = pd.find(fn)
+        if abstractPart is not None:
+            self.abstractPart = abstractPart
         else:
             # Set up dynamic module to be used for import 
             importerName = LicImporters.getImporter(os.path.splitext(fn)[1][1:])
@@ -3253,16 +3891,7 @@ class Part(PartTreeManager, QGraphicsRectItem):
         return (-b.y1, b.ySize(), -b.z1, b.x1)
 
     def getPartBoundingBox(self):
-        m = list(self.matrix)
-        if self.displacement:
-            m[12] += self.displacement[0]
-            m[13] += self.displacement[1]
-            m[14] += self.displacement[2]
-
-        box = self.abstractPart.getBoundingBox()
-        if box:
-            return box.duplicate(m)
-        return BoundingBox(self.xyz()[0] , self.xyz()[1] , self.xyz()[2]).duplicate(m)
+        return getPartBoundingBoxes([self])[0]
     
     def xyz(self):
         return [self.matrix[12], self.matrix[13], self.matrix[14]]
@@ -3377,27 +4006,37 @@ class Part(PartTreeManager, QGraphicsRectItem):
         self.arrows = []
         self._dataString = None
 
+    def geometryChanged(self):
+        """ Let this part's Submodel know this part's position, rotation or shape changed. """
+        page = self.getPage()
+        if page is not None and page.submodel is not None:
+            page.submodel.partMoved(self)
+
+    def updateInstanceTable(self):
+        """ Let this part's Submodel know its color changed. """
+        page = self.getPage()
+        if page is not None and page.submodel is not None:
+            page.submodel.partRecolored(self)
+
     def isSubmodel(self):
         return isinstance(self.abstractPart, Submodel)
 
     def toBlack(self):
         self.color = LicHelpers.LicColor.black()
 
-    def callGLDisplayList(self, useDisplacement, paintingEdge):
+    def callGLDisplayList(self, useDisplacement, paintingEdge, conditionalView=None):
 
         # must be called inside a glNewList/EndList pair
+        # conditionalView: rotation from the parent's coordinates to the view, to draw visible conditional lines
         if self.inverted:
             GL.glPushAttrib(GL.GL_POLYGON_BIT)
             GL.glFrontFace(GL.GL_CW)
 
-        if self.matrix:
-            matrix = list(self.matrix)
-            if useDisplacement and self.displacement:
-                matrix[12] += self.displacement[0]
-                matrix[13] += self.displacement[1]
-                matrix[14] += self.displacement[2]
+        if self.matrix is not None:
             GL.glPushMatrix()
-            GL.glMultMatrixf(matrix)
+            if useDisplacement and self.displacement:
+                GL.glTranslatef(*self.displacement)  # Same as adding displacement to the matrix's translation
+            GL.glMultMatrixd(self.matrix)
 
         if useDisplacement and (self.isSelected() or CSI.highlightNewParts):
             GL.glPushAttrib(GL.GL_CURRENT_BIT)
@@ -3416,6 +4055,8 @@ class Part(PartTreeManager, QGraphicsRectItem):
                 GL.glColor4fv(color)
                     
             GL.glCallList(self.abstractPart.glEdgeDispID)
+            if conditionalView is not None:
+                self.abstractPart.drawConditionalLines(LicGeometry.linearTransform(conditionalView, self.matrix))
 
         else:
             if self.color is not None:
@@ -3428,10 +4069,8 @@ class Part(PartTreeManager, QGraphicsRectItem):
         
         if self.color is not None:
             GL.glPopAttrib()
-        
-        # self.abstractPart.drawConditionalLines()
 
-        if self.matrix:
+        if self.matrix is not None:
             GL.glPopMatrix()
 
         if self.inverted:
@@ -3441,6 +4080,24 @@ class Part(PartTreeManager, QGraphicsRectItem):
             for arrow in self.arrows:
                 arrow.callGLDisplayList(useDisplacement)
 
+    def callConditionalLines(self, transform):
+        """ Draw this part's visible conditional lines; transform is the rotation from the parent's coordinates to the view. """
+        if self.matrix is not None:
+            GL.glPushMatrix()
+            GL.glMultMatrixd(self.matrix)
+
+        if self.color is not None and self.color.edgeRgba is not None:
+            GL.glPushAttrib(GL.GL_CURRENT_BIT)
+            GL.glColor4fv(self.color.edgeRgba)
+
+        self.abstractPart.drawConditionalLines(LicGeometry.linearTransform(transform, self.matrix))
+
+        if self.color is not None and self.color.edgeRgba is not None:
+            GL.glPopAttrib()
+
+        if self.matrix is not None:
+            GL.glPopMatrix()
+
     def drawGLBoundingBox(self):
         b = self.abstractPart.getBoundingBox()
         GL.glBegin(GL.GL_LINE_LOOP)
@@ -3711,8 +4368,8 @@ class Part(PartTreeManager, QGraphicsRectItem):
 
     def changeColor(self, newColor):
         self.color = newColor
-        self.getCSI().isDirty = True
-        self.getCSI().nextCSIIsDirty = True
+        self.updateInstanceTable()
+        self.getCSI().isDirty = True  # Later steps call this CSI's lists, so they pick up the new color as is
         self._dataString = None
 
         self.update()
@@ -3742,6 +4399,7 @@ class Part(PartTreeManager, QGraphicsRectItem):
             self.calloutPart.changeAbstractPart(filename)
 
         step.addPart(self)
+        self.geometryChanged()
         step.csi.isDirty = True
         step.csi.nextCSIIsDirty = True
         if self.originalPart:
@@ -3781,6 +4439,7 @@ class Part(PartTreeManager, QGraphicsRectItem):
         self.matrix[14] = newPosition[2]
 
         self.setXYZRotation(*newRotation)
+        self.geometryChanged()
 
         self.getCSI().isDirty = True
         self.getCSI().nextCSIIsDirty = True
@@ -3822,13 +4481,9 @@ class Arrow(Part):
         br = [x[3], y[3], 0.0]
         bl = [x[1], y[3], 0.0]
         
-        tip1 = Primitive(red(), tip + topEnd + joint, GL.GL_TRIANGLES)
-        tip2 = Primitive(red(), tip + joint + botEnd, GL.GL_TRIANGLES)
-        base = Primitive(red(), tl + tr + br + bl, GL.GL_QUADS)
-
-        self.abstractPart.primitives.append(tip1)
-        self.abstractPart.primitives.append(tip2)
-        self.abstractPart.primitives.append(base)
+        self.abstractPart.primitives.add(red(), tip + topEnd + joint, GL.GL_TRIANGLES)
+        self.abstractPart.primitives.add(red(), tip + joint + botEnd, GL.GL_TRIANGLES)
+        self.abstractPart.primitives.add(red(), tl + tr + br + bl, GL.GL_QUADS)
         self.abstractPart.createGLDisplayList()
 
     def data(self, index):
@@ -3899,13 +4554,10 @@ class Arrow(Part):
             GL.glPushAttrib(GL.GL_CURRENT_BIT)
             GL.glColor4fv(color)
 
-        matrix = list(self.matrix)
-        if self.displacement:
-            matrix[12] += self.displacement[0]
-            matrix[13] += self.displacement[1]
-            matrix[14] += self.displacement[2]
         GL.glPushMatrix()
-        GL.glMultMatrixf(matrix)
+        if self.displacement:
+            GL.glTranslatef(*self.displacement)
+        GL.glMultMatrixd(self.matrix)
 
         # LicGLHelpers.drawCoordLines()
         self.doGLRotation()
@@ -3943,7 +4595,7 @@ class Arrow(Part):
 
     def getLength(self):
         p = self.abstractPart.primitives[-1]
-        return p.points[3]
+        return float(p.points[3])
 
     def setLength(self, length):
         p = self.abstractPart.primitives[-1]
@@ -3998,152 +4650,6 @@ class Arrow(Part):
         self.scene().undoStack.push(AdjustArrowRotation(self, oldRotation, self.axisRotation))
         stack.endMacro()
 
-class Primitive(object):
-    """
-    Not a primitive in the LDraw sense, just a single line/triangle/quad.
-    Used mainly to construct a GL display list for a set of points.
-    """
-
-    def __init__(self, color, points, gltype, winding=GL.GL_CW):
-        self.color = color
-        self.type = gltype
-        self.points = points
-        self.winding = winding
-        self._boundingBox = None
-
-    def getBoundingBox(self):
-        if self._boundingBox:
-            return self._boundingBox
-        
-        p = self.points
-        box = BoundingBox(p[0], p[1], p[2])
-        box.growByPoints(p[3], p[4], p[5])
-        if self.type != GL.GL_LINES:
-            box.growByPoints(p[6], p[7], p[8])
-            if self.type == GL.GL_QUADS:
-                box.growByPoints(p[9], p[10], p[11])
-                
-        self._boundingBox = box
-        return box
-
-    def resetBoundingBox(self):
-        self._boundingBox = None
-
-    def addNormal(self, p1, p2, p3):
-        Bx = p2[0] - p1[0]
-        By = p2[1] - p1[1]
-        Bz = p2[2] - p1[2]
-
-        Cx = p3[0] - p1[0]
-        Cy = p3[1] - p1[1]
-        Cz = p3[2] - p1[2]
-
-        Ax = (By * Cz) - (Bz * Cy)
-        Ay = (Bz * Cx) - (Bx * Cz)
-        Az = (Bx * Cy) - (By * Cx)
-        l = math.sqrt((Ax * Ax) + (Ay * Ay) + (Az * Az))
-        if l != 0:
-            Ax /= l
-            Ay /= l
-            Az /= l
-        return [Ax, Ay, Az]
-
-    def pointWinding(self, p0, p1, p2):
-        
-        dx1 = p1[0] - p0[0]
-        dy1 = p1[1] - p0[1]
-        dx2 = p2[0] - p0[0]
-        dy2 = p2[1] - p0[1]
-        
-        if (dx1 * dy2 > dy1 * dx2):
-            return +1
-        if (dx1 * dy2 < dy1 * dx2):
-            return -1
-        if ((dx1 * dx2 < 0) or (dy1 * dy2 < 0)):
-            return -1
-        if ((dx1 * dx1 + dy1 * dy1) < (dx2 * dx2 + dy2 * dy2)):
-            return +1
-        return 0
-    
-    def callGLDisplayList(self, paintingEdge):
-
-        # must be called inside a glNewList/EndList pair
-        p = self.points
-        if self.type == GL.GL_LINES:
-            if len(self.points) > 6 or not paintingEdge:  # This is a conditional line or we are not painting edges
-                return
-
-            GL.glBegin(self.type)
-            GL.glVertex3f(p[0], p[1], p[2])
-            GL.glVertex3f(p[3], p[4], p[5])
-            GL.glEnd()
-            return
-
-        if paintingEdge:
-            return
-
-        if self.color is not None:
-            GL.glPushAttrib(GL.GL_CURRENT_BIT)
-            GL.glColor4fv(self.color.rgba)
-
-        if self.winding == GL.GL_CCW:
-            normal = self.addNormal(p[0:3], p[3:6], p[6:9])
-            # GL.glBegin( GL.GL_LINES )
-            # GL.glVertex3f(p[3], p[4], p[5])
-            # GL.glVertex3f(p[3] + normal[0], p[4] + normal[1], p[5] + normal[2])
-            # GL.glEnd()
-
-            GL.glBegin(self.type)
-            GL.glNormal3fv(normal)
-            GL.glVertex3f(p[0], p[1], p[2])
-            GL.glVertex3f(p[3], p[4], p[5])
-            GL.glVertex3f(p[6], p[7], p[8])
-            if self.type == GL.GL_QUADS:
-                GL.glVertex3f(p[9], p[10], p[11])
-            GL.glEnd()
-            
-        elif self.winding == GL.GL_CW:
-            normal = self.addNormal(p[0:3], p[6:9], p[3:6])
-            # GL.glBegin( GL.GL_LINES )
-            # GL.glVertex3f(p[3], p[4], p[5])
-            # GL.glVertex3f(p[3] + normal[0], p[4] + normal[1], p[5] + normal[2])
-            # GL.glEnd()
-
-            GL.glBegin(self.type)
-            GL.glNormal3fv(normal)
-            GL.glVertex3f(p[0], p[1], p[2])
-            if self.type == GL.GL_QUADS:
-                GL.glVertex3f(p[9], p[10], p[11])
-            GL.glVertex3f(p[6], p[7], p[8])
-            GL.glVertex3f(p[3], p[4], p[5])
-            GL.glEnd()
-
-        if self.color is not None:
-            GL.glPopAttrib()
-
-    def drawConditionalLines(self):
-        if self.type != GL.GL_LINES or len(self.points) != 12:
-            return  # Not a conditional line
-        
-        p = self.points
-        p0 = GLU.gluProject(p[0], p[1], p[2])
-        p1 = GLU.gluProject(p[3], p[4], p[5])
-        c0 = GLU.gluProject(p[6], p[7], p[8])
-        c1 = GLU.gluProject(p[9], p[10], p[11])
-        
-        winding1 = self.pointWinding(p0, p1, c0)
-        winding2 = self.pointWinding(p0, p1, c1)
-        if winding1 != winding2:
-            return
-    
-        GL.glPushAttrib(GL.GL_CURRENT_BIT)
-        GL.glColor4f(1.0, 1.0, 0.0, 1.0)
-        GL.glBegin(self.type)
-        GL.glVertex3f(p[0], p[1], p[2])
-        GL.glVertex3f(p[3], p[4], p[5])
-        GL.glEnd()
-        GL.glPopAttrib()
-
 class Ruler(QWidget):
     
     _step = 20.0
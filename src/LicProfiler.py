@@ -0,0 +1,135 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (LicProfiler.py) is part of LIC.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import time
+
+import config
+
+
+class ImportProfiler(object):
+    """
+    Times each phase of an import, and records how many objects (parts, CSIs, pages, ...) each phase left behind.
+    Phases are reported in the order they first ran.  A phase that runs several times accumulates its time.
+
+    When disabled, every method is a cheap no-op, so importers can be instrumented unconditionally.
+    Call writeReport() once the import is finished to write the JSON report (and optional cProfile dump)
+    next to licreator.log, named after the imported model so parallel batch imports don't overwrite each other.
+    """
+
+    reportFilename = "licreator-import-%s.json"  # % imported model's base name
+    profileFilename = "licreator-import-%s.prof"
+
+    def __init__(self, filename, enabled=False, useCProfile=False):
+        self.filename = filename
+        self.enabled = enabled
+        self.phases = []  # [phase name], in the order they first ran
+        self.times = {}  # {phase name: seconds}
+        self.counts = {}  # {phase name: {counter name: value}}
+        self.counters = {}  # Free form, import wide counters - see increment()
+        self.startTime = time.time()
+        self.__profile = cProfile.Profile() if (enabled and useCProfile) else None
+
+    def __addTime(self, name, seconds):
+        if name not in self.times:
+            self.phases.append(name)
+            self.times[name] = 0.0
+        self.times[name] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the body of a with statement as part of phase 'name'. """
+        if not self.enabled:
+            yield
+            return
+
+        if self.__profile:
+            self.__profile.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.__addTime(name, time.time() - start)
+            if self.__profile:
+                self.__profile.disable()
+
+    def timeGenerator(self, name, generator):
+        """
+        Pass through every value of generator, timing it as part of phase 'name'.
+        Only the time spent inside the generator counts, not the time the caller spends between values.
+        """
+        if not self.enabled:
+            for value in generator:
+                yield value
+            return
+
+        while True:
+            with self.phase(name):
+                try:
+                    value = generator.next()
+                except StopIteration:
+                    return
+            yield value
+
+    def count(self, name, **counts):
+        """ Record object counts after phase 'name', like count('parse', parts=10, pages=2). """
+        if self.enabled:
+            self.counts.setdefault(name, {}).update(counts)
+
+    def increment(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        phases = []
+        for name in self.phases:
+            phases.append({"name": name, "seconds": round(self.times[name], 4), "counts": self.counts.get(name, {})})
+        for name in self.counts:
+            if name not in self.times:
+                phases.append({"name": name, "seconds": 0.0, "counts": self.counts[name]})
+
+        return {"filename": self.filename,
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "totalSeconds": round(time.time() - self.startTime, 4),
+                "phaseSeconds": round(sum(self.times.values()), 4),
+                "phases": phases,
+                "counters": self.counters}
+
+    def __getReportPath(self, template):
+        name = os.path.splitext(os.path.basename(self.filename))[0] if self.filename else "untitled"
+        return os.path.join(config.appDataPath(), template % name)
+
+    def writeReport(self):
+        if not self.enabled:
+            return
+
+        try:
+            with open(self.__getReportPath(self.reportFilename), 'w') as fh:
+                json.dump(self.report(), fh, indent=4)
+
+            if self.__profile:
+                self.__profile.dump_stats(self.__getReportPath(self.profileFilename))
+        except (IOError, OSError), e:
+            logging.error('------------------------------------------------------\n ImportProfiler => Could not write import report: %s' % e)
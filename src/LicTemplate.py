@@ -264,14 +264,15 @@ class TemplatePage(TemplateRectItem, Page):
     def initGLDimension(self, part, glContext):
 
         glContext.makeCurrent()
-        for size in [512, 1024, 2048]:
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), glContext)
-            pBuffer.makeCurrent()
-
-            # Render CSI and calculate its size
-            if part.initSize(size, pBuffer):
-                break
+        sizes = [512, 1024, 2048]
+        for size in sizes[part.predictBufferSize(sizes):]:
+            # Borrow a pooled buffer tied to the existing GLWidget, to get access to its display lists
+            with LicGLHelpers.renderTargets.pixelBuffer(size, glContext) as pBuffer:
+                pBuffer.makeCurrent()
+
+                # Render CSI and calculate its size
+                if part.initSize(size, pBuffer):
+                    break
         glContext.makeCurrent()
 
     def applyFullTemplate(self, useUndo):
@@ -344,6 +344,7 @@ class AddRemovePartCommand(QUndoCommand):
             self.part.setParentItem(None)
             step.removePart(self.part)
             submodel.parts.remove(self.part)
+        submodel.partsChanged()
 
         step.scene().emit(SIGNAL("layoutChanged()"))
 
@@ -1191,6 +1192,8 @@ class SubmodelToCalloutCommand(QUndoCommand):
                             
             calloutDone = True
                         
+        self.submodel.partsChanged()  # Its parts' matrices now include the instance matrix
+        
         if len(self.submodelInstanceList) > 1:
             self.targetCallout.setQuantity(len(self.submodelInstanceList))
             
@@ -1262,6 +1265,7 @@ class CalloutToSubmodelCommand(SubmodelToCalloutCommand):
             submodel.parts.append(part)
             submodel.pages[0].steps[0].addPart(part)
             self.targetStep.removePart(part)
+        submodel.partsChanged()
 
         submodel.addInitialPagesAndSteps(False)
         submodel.mergeInitialPages()
@@ -137,6 +137,13 @@ filename = ""  # Set when a file is loaded
 writeL3PActivity = False
 writePOVRayActivity = False
 
+# SET to True ImportProfileLog | ImportCProfile in configuration file; to find out where a slow import spends its time
+writeImportProfile = False
+writeImportCProfile = False
+
+# SET to True FlattenLibraryParts in configuration file; to bake each library part's sub parts into one vertex set on import
+flattenLibraryParts = False
+
 def checkPath(pathName, root=None):
     root = root if root else modelCachePath()
     path = os.path.join(root, pathName)